@@ -14,6 +14,7 @@ install_requires = [
     'django-environ>=0.4.0,<1.0.0',
     'requests[security]<3',
     'beautifulsoup4',
+    'numpy',
     'raven<7',
 ]
 
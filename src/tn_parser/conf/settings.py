@@ -168,6 +168,16 @@ USE_TZ = True
 STATIC_URL = '/static/'
 
 
+# Raw payloads of data providers, empty value switches storing off
+PAYLOAD_STORE_ROOT = env('PAYLOAD_STORE_ROOT', default=root('payloads'))
+
+# Serialized API documents rebuilt after each sync
+API_SNAPSHOT_ROOT = env('API_SNAPSHOT_ROOT', default=root('snapshots'))
+# Seconds between checks whether API snapshot was rebuilt
+API_SNAPSHOT_CHECK_INTERVAL = env.float('API_SNAPSHOT_CHECK_INTERVAL',
+                                        default=5.0)
+
+
 # Logging
 LOGLEVEL = 'DEBUG' if DEBUG else 'ERROR'
 
@@ -1,13 +1,106 @@
 # coding=utf-8
-from django.db import models
+from django.db import connections, models
 
 from django.contrib import admin
+from django.core.paginator import Paginator
+from django.utils.functional import cached_property
 
 from .models import DataProviderUrl, \
     Route, RoutePoint, RouteSchedule, \
     RouteWeekDimension, RouteDateDimension, \
     Platform, PlatformAlias, Stop
 
+# tables with less rows are counted exactly
+ESTIMATED_COUNT_THRESHOLD = 10000
+
+_ESTIMATED_COUNT_SQL = {
+    'postgresql': 'SELECT reltuples::bigint FROM pg_class WHERE relname = %s',
+    'mysql': 'SELECT table_rows FROM information_schema.tables '
+             'WHERE table_schema = DATABASE() AND table_name = %s',
+}
+
+
+def get_estimated_count(queryset):
+    """
+    return count of rows of model table from DB statistics
+    or None if DB has no statistics
+
+    :rtype: int|None
+    """
+    connection = connections[queryset.db]
+    sql = _ESTIMATED_COUNT_SQL.get(connection.vendor)
+    if sql is None:
+        return None
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [queryset.model._meta.db_table])
+        row = cursor.fetchone()
+    return int(row[0]) if row and row[0] is not None else None
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator of changelists of large tables: not filtered lists
+    are counted by DB statistics instead of a full table scan.
+    """
+
+    @cached_property
+    def count(self):
+        query = getattr(self.object_list, 'query', None)
+        if query is not None and not query.where:
+            estimated = get_estimated_count(self.object_list)
+            if estimated is not None \
+                    and estimated >= ESTIMATED_COUNT_THRESHOLD:
+                return estimated
+        return super(EstimatedCountPaginator, self).count
+
+
+class InputFilter(admin.SimpleListFilter):
+    """
+    Filter by value typed in, so the sidebar does not list every
+    object of a large table.
+    """
+    template = 'admin/transport/input_filter.html'
+    lookup = None
+
+    def lookups(self, request, model_admin):
+        return ()
+
+    def has_output(self):
+        return True
+
+    def queryset(self, request, queryset):
+        value = (self.value() or '').strip()
+        if value:
+            return queryset.filter(**{self.lookup: value})
+        return queryset
+
+    def choices(self, changelist):
+        yield {
+            'value': self.value() or '',
+            'params': [(name, value)
+                       for name, value in changelist.params.items()
+                       if name not in (self.parameter_name, 'p')],
+            'clear_query_string': changelist.get_query_string(
+                remove=[self.parameter_name]),
+        }
+
+
+class RouteCodeFilter(InputFilter):
+    title = 'route code'
+    parameter_name = 'route_code'
+    lookup = 'route__code'
+
+
+class PlatformNameFilter(InputFilter):
+    title = 'platform name'
+    parameter_name = 'platform_name'
+    lookup = 'platform__name__istartswith'
+
+
+class StopPlatformNameFilter(PlatformNameFilter):
+    lookup = 'stop__platform__name__istartswith'
+
 
 class DataProviderUrlAdmin(admin.ModelAdmin):
     pass
@@ -24,29 +117,42 @@ class RoutePointAdmin(admin.ModelAdmin):
                     'time',
                     'lap', 'order', 'direction', 'geo_direction',
                     'on_demand', 'skip')
-    list_filter = ('route', 'stop', 'week_dimension', 'direction', )
+    list_filter = (RouteCodeFilter, StopPlatformNameFilter,
+                   'week_dimension', 'direction', )
+    list_select_related = ('route', 'stop__platform', 'week_dimension')
+    raw_id_fields = ('route', 'stop', 'week_dimension')
     ordering = ('route', 'lap', 'order')
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
 
 
-class RouteScheduleAdmin(admin.ModelAdmin):
-    pass
+class RouteScheduleAdmin(RoutePointAdmin):
+    raw_id_fields = RoutePointAdmin.raw_id_fields + ('date_dimension', )
 
 
 class StopAdmin(admin.ModelAdmin):
     list_display = ('platform', 'latitude', 'longitude')
-    list_filter = ('platform', )
+    list_filter = (PlatformNameFilter, )
+    list_select_related = ('platform', )
+    raw_id_fields = ('platform', 'alias')
     ordering = ('platform', )
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
 
 
 class PlatformAdmin(admin.ModelAdmin):
     list_display = ('name', 'stops_count', )
     ordering = ('name', )
+    search_fields = ('name', )
+
+    def get_queryset(self, request):
+        qs = super(PlatformAdmin, self).get_queryset(request)
+        return qs.annotate(stops_count=models.Count('stops'))
 
     def stops_count(self, obj):
-        # return obj.stops__count
-        return obj.stops.count()
+        return obj.stops_count
 
-    # stops_count.admin_order_field = 'stops_count'
+    stops_count.admin_order_field = 'stops_count'
 
 
 admin.site.register(DataProviderUrl, DataProviderUrlAdmin)
@@ -61,7 +167,3 @@ admin.site.register(RouteDateDimension, admin.ModelAdmin)
 admin.site.register(Platform, PlatformAdmin)
 admin.site.register(Stop, StopAdmin)
 admin.site.register(PlatformAlias, admin.ModelAdmin)
-
-
-
-
@@ -0,0 +1,344 @@
+# coding=utf-8
+
+import datetime
+import gc
+import json
+import platform
+import random
+import subprocess
+import time
+import tracemalloc
+from collections import OrderedDict, deque
+
+from django.core.management import call_command
+from django.db import connection
+
+from .models import Route, RouteTypes
+from .parsers import get_routes_by_type_from_page, parse_schedule_page
+from .resolvers import PlatformResolver, StopIndex
+from .sync import process_platform_inputs, process_route_2gis_data
+
+# roughly Veliky Novgorod
+_CITY_LON = 31.27
+_CITY_LAT = 58.52
+
+_STREETS = ('Ломоносова', 'Большая Московская', 'Великая', 'Псковская',
+            'Державина', 'Б. Санкт-Петербургская', 'Германа', 'Кочетова',
+            'Октябрьская', 'Черняховского', 'Менделеева', 'Зелинского',
+            'Студенческая', 'Хутынская', 'Рахманинова', 'Волховская')
+_PLACES = ('Софийская пл.', 'Вокзал', 'Кремль', 'Поликлиника', 'ТЦ Русь',
+           'Школа', 'Рынок', 'Универмаг', 'Парк', 'Политехнический колледж',
+           'Педиатрическая больница', 'Стадион')
+_PREFIXES = ('ул.', 'ул', 'пр.', 'пл.', 'пер.', '')
+_MONTHS = ('января', 'февраля', 'марта', 'апреля', 'мая', 'июня', 'июля',
+           'августа', 'сентября', 'октября', 'ноября', 'декабря')
+
+
+class Fixtures(object):
+    """
+    Synthetic but realistic payloads of data providers,
+    generated with fixed seed so runs are comparable.
+    """
+
+    def __init__(self, seed=0):
+        self.random = random.Random(seed)
+        self.stops = [self._make_stop(i) for i in range(600)]
+
+    def _make_stop(self, index):
+        rnd = self.random
+        if index % 3:
+            name = '{} {}'.format(rnd.choice(_PREFIXES),
+                                  rnd.choice(_STREETS)).strip()
+            if index % 7 == 0:
+                name = '{} ({})'.format(name, rnd.choice(_PLACES))
+        else:
+            name = rnd.choice(_PLACES)
+        if index % 29 == 0:
+            name += ' (по требованию)'
+
+        return {
+            'name': '{} {}'.format(name, index),
+            'lon': _CITY_LON + rnd.uniform(-0.08, 0.08),
+            'lat': _CITY_LAT + rnd.uniform(-0.05, 0.05),
+        }
+
+    def route_codes(self, count):
+        return ['{}{}'.format(i, self.random.choice(('', 'a', 'k', 'cr')))
+                for i in range(1, count + 1)]
+
+    def routes_page(self, options_count=300):
+        """
+        return routes HTML page with bus and trolleybus selects
+        """
+        def select(name, count):
+            options = '\n'.join(
+                "<option value='{0}_{1}'>{0}</option>".format(
+                    code, self.random.choice('rv'))
+                for code in self.route_codes(count))
+            return "<select class='sel' name='{}' size='1'>\n{}\n</select>"\
+                .format(name, options)
+
+        return (
+            '<html><head><title>Городской транспорт</title></head><body>'
+            '<form method=get action="/urban_trans/1/">'
+            '<table><tr><td>Автобусы</td><td>{}</td></tr>'
+            '<tr><td>Троллейбусы</td><td>{}</td></tr></table>'
+            '</form></body></html>'.format(
+                select('avt', options_count),
+                select('trol', options_count // 3)))
+
+    def route_stops(self, count):
+        start = self.random.randint(0, len(self.stops) - count)
+        return self.stops[start:start + count]
+
+    def twogis_payload(self, platforms_count):
+        """
+        return 2GIS route API payload with forward and backward
+        directions of platforms_count platforms each
+        """
+        directions = []
+        stops = self.route_stops(platforms_count)
+        for direction_type in ('forward', 'backward'):
+            directions.append({
+                'type': direction_type,
+                'platforms': [{
+                    'name': stop['name'],
+                    'geometry': {
+                        'centroid': 'POINT({:.13f} {:.13f})'.format(
+                            stop['lon'], stop['lat']),
+                    },
+                } for stop in stops],
+            })
+            stops = list(reversed(stops))
+
+        return {
+            'meta': {'code': 200, 'issue_date': '20170625'},
+            'result': {'items': [{'directions': directions}], 'total': 1},
+        }
+
+    def schedule_page(self, stops_count=30, trips_count=60):
+        """
+        return route schedule page with header row of stops
+        and trips_count rows of departure times
+        """
+        stops = self.route_stops(stops_count)
+        headers = []
+        for index, stop in enumerate(stops):
+            extreme = ''
+            if index == 0:
+                extreme = ' отпр.'
+            elif index == len(stops) - 1:
+                extreme = ' приб.'
+            headers.append('<td>{}{}</td>'.format(stop['name'], extreme))
+
+        rows = []
+        for trip in range(trips_count):
+            minutes = 5 * 60 + trip * 15
+            cells = []
+            for index in range(stops_count):
+                minutes += self.random.randint(1, 4)
+                value = '{}:{:02d}'.format(minutes // 60 % 24, minutes % 60)
+                if self.random.random() < 0.05:
+                    value = '-'
+                elif self.random.random() < 0.03:
+                    value = 'к {}'.format(value)
+                cells.append('<td>{}</td>'.format(value))
+            rows.append('<tr>{}</tr>'.format(''.join(cells)))
+
+        return (
+            '<html><body>'
+            '<table class="top">'
+            '<tr><td align="center"><b>Маршрут</b></td></tr>'
+            '<tr><td align="center">Расписание по состоянию на '
+            '<font>{day} {month} 2017</font></td></tr>'
+            '<tr><td><table align="center"><tr>'
+            '<td><a href="?mar=1_r">Будни</a></td>'
+            '<td><a href="?mar=1_v">Выходные</a></td>'
+            '</tr></table></td></tr>'
+            '</table>'
+            '<table class="t"><tr>{headers}</tr>{rows}</table>'
+            '</body></html>'.format(
+                day=self.random.randint(1, 28),
+                month=self.random.choice(_MONTHS),
+                headers=''.join(headers),
+                rows=''.join(rows)))
+
+
+class Benchmark(object):
+
+    def __init__(self, name, run, setup=None, db=False):
+        """
+        :param name: name of benchmark in results
+        :param run: function to measure, gets setup result
+        :param setup: function preparing input, not measured
+        :param db: benchmark writes to DB, so DB is flushed before it
+        """
+        self.name = name
+        self.run = run
+        self.setup = setup
+        self.db = db
+
+
+def _routes_page(fixtures):
+    return fixtures.routes_page(300)
+
+
+def _parse_routes_page(page):
+    get_routes_by_type_from_page(page)
+
+
+def _schedule_headers(fixtures):
+    headers = []
+    for _ in range(40):
+        headers.extend(parse_schedule_page(fixtures.schedule_page())['stops'])
+    return headers
+
+
+def _normalize_platforms(headers):
+    process_platform_inputs(headers)
+
+
+def _schedule_pages(fixtures):
+    return [fixtures.schedule_page() for _ in range(10)]
+
+
+def _parse_schedule_pages(pages):
+    for page in pages:
+        parse_schedule_page(page)
+
+
+def _twogis_payloads(fixtures):
+    payloads = []
+    for code, count in zip(fixtures.route_codes(12),
+                           (50, 80, 120, 200) * 3):
+        route = Route.objects.create(
+            name=code, code='bench-{}'.format(code), type=RouteTypes.BUS)
+        payloads.append((route, fixtures.twogis_payload(count)))
+    return payloads
+
+
+def _sync_2gis(payloads):
+    resolver = PlatformResolver.load()
+    stop_index = StopIndex.load()
+    for route, payload in payloads:
+        process_route_2gis_data(route, payload, resolver, stop_index)
+
+
+def _synced_twogis_payloads(fixtures):
+    payloads = _twogis_payloads(fixtures)
+    _sync_2gis(payloads)
+    return payloads
+
+
+BENCHMARKS = (
+    Benchmark('parse_routes_page', _parse_routes_page, _routes_page),
+    Benchmark('parse_schedule_pages', _parse_schedule_pages, _schedule_pages),
+    Benchmark('normalize_platforms', _normalize_platforms, _schedule_headers),
+    Benchmark('sync_2gis_new', _sync_2gis, _twogis_payloads, db=True),
+    Benchmark('sync_2gis_existing', _sync_2gis, _synced_twogis_payloads,
+              db=True),
+)
+
+
+def _measure(benchmark, fixtures, trace_memory=False):
+    if benchmark.db:
+        call_command('flush', verbosity=0, interactive=False)
+    data = benchmark.setup(fixtures) if benchmark.setup else None
+    gc.collect()
+
+    queries_log = connection.queries_log
+    force_debug_cursor = connection.force_debug_cursor
+    # query log is bounded by default
+    connection.queries_log = deque()
+    connection.force_debug_cursor = True
+    if trace_memory:
+        tracemalloc.start()
+    try:
+        started = time.perf_counter()
+        benchmark.run(data)
+        wall_time = time.perf_counter() - started
+        queries = len(connection.queries_log)
+        peak_memory = tracemalloc.get_traced_memory()[1] \
+            if trace_memory else None
+    finally:
+        if trace_memory:
+            tracemalloc.stop()
+        connection.queries_log = queries_log
+        connection.force_debug_cursor = force_debug_cursor
+
+    return wall_time, peak_memory, queries
+
+
+def run_benchmark(benchmark, repeat=3, seed=0):
+    """
+    return measurements of benchmark: the best wall time in seconds,
+    peak traced memory in bytes and count of SQL queries. Memory is
+    traced in a separate run, as tracing slows the code down
+
+    :param benchmark: benchmark to run
+    :type benchmark: Benchmark
+    :param repeat: count of timed runs
+    :type repeat: int
+    :param seed: seed of fixtures
+    :type seed: int
+    :rtype: dict
+    """
+    runs = [_measure(benchmark, Fixtures(seed))
+            for _ in range(max(repeat, 1))]
+    _, peak_memory, _ = _measure(benchmark, Fixtures(seed), trace_memory=True)
+
+    return OrderedDict((
+        ('wall_time', min(run[0] for run in runs)),
+        ('peak_memory', peak_memory),
+        ('queries', max(run[2] for run in runs)),
+        ('repeat', len(runs)),
+    ))
+
+
+def _get_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def run_benchmarks(names=None, repeat=3, seed=0):
+    """
+    return results of benchmarks ready to be dumped as JSON,
+    DB benchmarks are run on a test database
+
+    :param names: names of benchmarks to run, all by default
+    :type names: list|None
+    :rtype: dict
+    """
+    benchmarks = [benchmark for benchmark in BENCHMARKS
+                  if not names or benchmark.name in names]
+
+    old_name = None
+    if any(benchmark.db for benchmark in benchmarks):
+        old_name = connection.creation.create_test_db(
+            verbosity=0, autoclobber=True, serialize=False)
+
+    results = OrderedDict()
+    try:
+        for benchmark in benchmarks:
+            results[benchmark.name] = run_benchmark(benchmark, repeat, seed)
+    finally:
+        if old_name is not None:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    return OrderedDict((
+        ('revision', _get_revision()),
+        ('created', datetime.datetime.utcnow().isoformat()),
+        ('python', platform.python_version()),
+        ('db_vendor', connection.vendor),
+        ('seed', seed),
+        ('results', results),
+    ))
+
+
+def dump_results(results, fp):
+    json.dump(results, fp, indent=2)
+    fp.write('\n')
@@ -0,0 +1,198 @@
+# coding=utf-8
+
+from collections import defaultdict, deque
+
+from django.db import connections, router, transaction
+from django.db.models import Case, Value, When
+
+BATCH_SIZE = 500
+
+
+def _lock_last_pk(model):
+    """
+    return the greatest pk of model rows, the row is locked up to the end
+    of transaction, so concurrent writers do not insert rows after it
+    while created rows are read back. Backends without SELECT ... FOR
+    UPDATE serialize writing transactions anyway
+
+    :rtype: int
+    """
+    pks = list(model.objects.select_for_update()
+               .order_by('-pk').values_list('pk', flat=True)[:1])
+    return pks[0] if pks else 0
+
+
+def bulk_create_with_pks(model, objs, key, batch_size=BATCH_SIZE):
+    """
+    bulk create objects and set their pks,
+    even if DB backend does not return them back
+
+    :param model: model class
+    :param objs: not saved instances
+    :type objs: list
+    :param key: function returning value which is unique among
+    created objects, to map rows read back onto the objects
+    :type key: callable
+    :return: created objects
+    :rtype: list
+    """
+    if not objs:
+        return objs
+
+    connection = connections[router.db_for_write(model)]
+    if connection.features.can_return_ids_from_bulk_insert:
+        return model.objects.bulk_create(objs, batch_size=batch_size)
+
+    with transaction.atomic(using=connection.alias):
+        last_pk = _lock_last_pk(model)
+        model.objects.bulk_create(objs, batch_size=batch_size)
+
+        created = dict((key(obj), obj) for obj in objs)
+        for obj in model.objects.filter(pk__gt=last_pk):
+            target = created.get(key(obj))
+            if target is not None:
+                target.pk = obj.pk
+
+    return objs
+
+
+def bulk_update(objs, fields, batch_size=BATCH_SIZE):
+    """
+    update fields of saved objects with one UPDATE per batch,
+    each field is set through CASE WHEN pk = ... expression
+
+    :param objs: saved instances of the same model
+    :type objs: list
+    :param fields: names of fields to update
+    :type fields: iterable
+    :return: count of updated rows
+    :rtype: int
+    """
+    if not objs:
+        return 0
+
+    model = type(objs[0])
+    updated = 0
+    for start in range(0, len(objs), batch_size):
+        batch = objs[start:start + batch_size]
+
+        values = {}
+        for name in fields:
+            field = model._meta.get_field(name)
+            values[field.attname] = Case(
+                *[When(pk=obj.pk,
+                       then=Value(getattr(obj, field.attname),
+                                  output_field=field))
+                  for obj in batch],
+                output_field=field)
+
+        updated += model.objects\
+            .filter(pk__in=[obj.pk for obj in batch])\
+            .update(**values)
+
+    return updated
+
+
+def _get_parent_link(model):
+    if len(model._meta.parents) != 1:
+        raise ValueError(
+            '{} should inherit exactly one concrete model'.format(
+                model.__name__))
+    return next(iter(model._meta.parents.items()))
+
+
+def _insert_rows(connection, model, fields, objs, batch_size):
+    sql = 'INSERT INTO {} ({}) VALUES ({})'.format(
+        connection.ops.quote_name(model._meta.db_table),
+        ', '.join(connection.ops.quote_name(field.column)
+                  for field in fields),
+        ', '.join(['%s'] * len(fields)))
+
+    prepares = [(field.attname, field.get_db_prep_save) for field in fields]
+    with connection.cursor() as cursor:
+        for start in range(0, len(objs), batch_size):
+            cursor.executemany(sql, [
+                [prepare(getattr(obj, attname), connection)
+                 for attname, prepare in prepares]
+                for obj in objs[start:start + batch_size]])
+
+
+def bulk_create_inherited(model, objs, key_fields, batch_size=BATCH_SIZE):
+    """
+    bulk create objects of multi-table inherited model, which
+    bulk_create refuses to do: parent rows are inserted first and
+    read back for their pks, then own rows of model are inserted,
+    one query per table and batch
+
+    :param model: model class inheriting one concrete model
+    :param objs: not saved instances
+    :type objs: list
+    :param key_fields: names of parent model fields to map rows read
+    back onto objects, objects with the same values of them get pks
+    in the order they are created
+    :type key_fields: tuple
+    :return: created objects
+    :rtype: list
+    """
+    if not objs:
+        return objs
+
+    parent_model, link = _get_parent_link(model)
+    connection = connections[router.db_for_write(model)]
+    key_attnames = [parent_model._meta.get_field(name).attname
+                    for name in key_fields]
+
+    with transaction.atomic(using=connection.alias):
+        last_pk = _lock_last_pk(parent_model)
+        _insert_rows(connection, parent_model,
+                     [field for field in parent_model._meta.concrete_fields
+                      if not field.primary_key],
+                     objs, batch_size)
+
+        created = defaultdict(deque)
+        for obj in objs:
+            created[tuple(getattr(obj, attname)
+                          for attname in key_attnames)].append(obj)
+        for row in parent_model.objects\
+                .filter(pk__gt=last_pk)\
+                .order_by('pk')\
+                .values_list('pk', *key_attnames):
+            same = created.get(row[1:])
+            if same:
+                setattr(same.popleft(), link.attname, row[0])
+
+        _insert_rows(connection, model, model._meta.local_concrete_fields,
+                     objs, batch_size)
+
+    return objs
+
+
+def bulk_delete_inherited(queryset, batch_size=BATCH_SIZE):
+    """
+    delete objects of multi-table inherited model with their parent
+    rows, one query per table and batch, without collecting instances.
+    Objects of other models referencing deleted rows are not handled
+
+    :param queryset: objects to delete
+    :type queryset: django.db.models.QuerySet
+    :return: count of deleted objects
+    :rtype: int
+    """
+    model = queryset.model
+    parent_model, link = _get_parent_link(model)
+    pks = list(queryset.values_list('pk', flat=True))
+
+    connection = connections[router.db_for_write(model)]
+    tables = ((model._meta.db_table, link.column),
+              (parent_model._meta.db_table, parent_model._meta.pk.column))
+
+    with connection.cursor() as cursor:
+        for start in range(0, len(pks), batch_size):
+            batch = pks[start:start + batch_size]
+            for table, column in tables:
+                cursor.execute('DELETE FROM {} WHERE {} IN ({})'.format(
+                    connection.ops.quote_name(table),
+                    connection.ops.quote_name(column),
+                    ', '.join(['%s'] * len(batch))), batch)
+
+    return len(pks)
@@ -0,0 +1,176 @@
+# coding=utf-8
+
+import datetime
+import logging
+from array import array
+from bisect import bisect_left
+from collections import defaultdict, namedtuple
+
+from django.utils import timezone
+
+from .snapshots import loader
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DEPARTURES = 5
+MAX_DEPARTURES = 50
+
+# days of week from 1 to 7, first is monday
+WEEK_DAYS = tuple(range(1, 8))
+
+Departure = namedtuple('Departure', ('time', 'route', 'direction'))
+
+
+def get_schedule_day(days, weekday):
+    """
+    return day of schedule serving day of week: workdays are served
+    by monday schedule, sunday by saturday one unless it has own,
+    see parsers.VARIANT_DAYS
+
+    :param days: days route has schedule for
+    :type days: collections.Container
+    :param weekday: day of week from 1 to 7
+    :type weekday: int
+    :rtype: int|None
+    """
+    first = 6 if weekday >= 6 else 1
+    for day in range(weekday, first - 1, -1):
+        if day in days:
+            return day
+    return None
+
+
+def parse_minutes(value):
+    """
+    return minutes since midnight of time like 5:07
+
+    :rtype: int
+    """
+    hours, minutes = value.split(':')
+    return int(hours) * 60 + int(minutes)
+
+
+class DeparturesIndex(object):
+    """
+    Departures of every stop by day of week kept in sorted arrays of
+    minutes since midnight with route and direction of each departure
+    alongside, so the next departures are found by bisect.
+    """
+
+    def __init__(self, departures=(), routes=None, stops=()):
+        """
+        :param departures: iterable of
+        (stop id, day of week, minutes, route id, direction)
+        :type departures: iterable
+        :param routes: route codes by route id
+        :type routes: dict
+        :param stops: ids of known stops
+        :type stops: iterable
+        """
+        self.routes = routes or {}
+        self.stops = frozenset(stops)
+
+        rows = defaultdict(list)
+        for stop_id, weekday, minutes, route_id, direction in departures:
+            rows[(stop_id, weekday)].append((minutes, route_id, direction))
+
+        self._times = {}
+        self._entries = {}
+        for key, items in rows.items():
+            items.sort()
+            self._times[key] = array('H', (item[0] for item in items))
+            self._entries[key] = [item[1:] for item in items]
+
+    @classmethod
+    def load(cls, snapshot):
+        """
+        return index of schedules of not canceled routes of snapshot
+
+        :type snapshot: .snapshots.Snapshot
+        :rtype: DeparturesIndex
+        """
+        routes = {}
+        departures = []
+        for route in snapshot.get_data('routes', ()):
+            if route['canceled'] is not None:
+                continue
+            routes[route['id']] = route['code']
+
+            document = snapshot.get_data('routes/{}'.format(route['id']), {})
+            schedule = dict((int(day), trips) for day, trips
+                            in document.get('schedule', {}).items())
+            for weekday in WEEK_DAYS:
+                day = get_schedule_day(schedule, weekday)
+                if day is None:
+                    continue
+                for trip in schedule[day]:
+                    departures.extend(
+                        (stop_id, weekday, parse_minutes(time),
+                         route['id'], trip['direction'])
+                        for stop_id, time in trip['stops'])
+
+        index = cls(departures, routes,
+                    (stop['id'] for stop in snapshot.get_data('stops', ())))
+        logger.debug('Departures index loaded: departures: %s'
+                     % len(departures))
+        return index
+
+    def next_departures(self, stop_id, when, n=DEFAULT_DEPARTURES):
+        """
+        return the next n departures from stop since the moment,
+        departures of the next days are taken if the day has not enough
+
+        :param stop_id: id of stop
+        :type stop_id: int
+        :param when: moment to look departures after, inclusive
+        :type when: datetime.datetime
+        :param n: count of departures
+        :type n: int
+        :rtype: list
+        """
+        midnight = when.replace(hour=0, minute=0, second=0, microsecond=0)
+        minutes = when.hour * 60 + when.minute
+
+        result = []
+        # a week later the schedule repeats itself
+        for offset in range(len(WEEK_DAYS) + 1):
+            if len(result) >= n:
+                break
+
+            day = midnight + datetime.timedelta(days=offset)
+            key = (stop_id, day.isoweekday())
+            times = self._times.get(key)
+            if times is None:
+                continue
+
+            entries = self._entries[key]
+            start = bisect_left(times, minutes) if offset == 0 else 0
+            for i in range(start, min(len(times), start + n - len(result))):
+                result.append(Departure(
+                    day + datetime.timedelta(minutes=times[i]),
+                    *entries[i]))
+
+        return result
+
+
+def get_departures_index():
+    """
+    return departures index of the current API snapshot
+
+    :rtype: DeparturesIndex
+    """
+    return loader.get().get_index(DeparturesIndex)
+
+
+def next_departures(stop_id, when=None, n=DEFAULT_DEPARTURES):
+    """
+    return the next n departures from stop, see
+    DeparturesIndex.next_departures
+
+    :param when: moment to look departures after, now by default
+    :type when: datetime.datetime
+    :rtype: list
+    """
+    if when is None:
+        when = timezone.localtime(timezone.now())
+    return get_departures_index().next_departures(stop_id, when, n)
@@ -0,0 +1,359 @@
+# coding=utf-8
+
+import asyncio
+import hashlib
+import json
+import logging
+import re
+import threading
+from collections import defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from queue import Queue
+from urllib.parse import parse_qsl, urlencode, urlparse, urlsplit, \
+    urlunsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.compat import chardet
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_PER_HOST = 6
+DEFAULT_TIMEOUT = 30
+
+_DONE = object()
+
+_CHARSET_RE = re.compile(r'''charset\s*=\s*["']?([\w.:-]+)''', re.I)
+
+# query params which must not get into logs and the payload store
+_SECRET_PARAMS = ('key', )
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def normalize_url(url):
+    """
+    return url without secret query params, so API keys do not get
+    into logs and payloads fetched with different keys are stored
+    under the same url
+    """
+    parts = urlsplit(url)
+    query = [(name, value)
+             for name, value in parse_qsl(parts.query, keep_blank_values=True)
+             if name not in _SECRET_PARAMS]
+    return urlunsplit(parts._replace(query=urlencode(query)))
+
+
+def make_session(pool_size=DEFAULT_POOL_SIZE):
+    """
+    return keep-alive session with connection pool big enough
+    to be shared between all fetching workers
+
+    :param pool_size: max connections kept open per host
+    :type pool_size: int
+    :return: session
+    :rtype: requests.Session
+    """
+    pool_size = max(pool_size, 1)
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size,
+                          pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_session(pool_size=DEFAULT_POOL_SIZE):
+    """
+    return keep-alive session shared in process by all fetches
+    with the same pool size, so connections to transport.nov.ru
+    and 2GIS are reused between fetches and sync runs
+
+    :param pool_size: max connections kept open per host
+    :type pool_size: int
+    :rtype: requests.Session
+    """
+    pool_size = max(pool_size, 1)
+    with _sessions_lock:
+        session = _sessions.get(pool_size)
+        if session is None:
+            session = _sessions[pool_size] = make_session(pool_size)
+    return session
+
+
+def get_header_charset(response):
+    """
+    return charset sent in Content-Type header of response or None
+    """
+    match = _CHARSET_RE.search(response.headers.get('Content-Type', ''))
+    if match is None:
+        return None
+    return match.group(1).strip().lower()
+
+
+def detect_charset(content):
+    """
+    return charset detected from payload, runs over the whole payload
+    so should be the last resort
+    """
+    return (chardet.detect(content)['encoding'] or 'utf-8').lower()
+
+
+class CharsetCache(object):
+    """
+    Charsets of payloads known per data provider type and host. It is
+    seeded with codings of data providers, charset sent in Content-Type
+    header overrides it, and payload failed to decode with known charset
+    is detected once and the detected charset is remembered. So pages
+    are decoded exactly once, without detection in the common case.
+    """
+
+    def __init__(self):
+        self._charsets = {}
+
+    @staticmethod
+    def _key(provider_type, url):
+        return provider_type, urlparse(url).netloc.lower()
+
+    def seed(self, providers):
+        """
+        remember codings of data providers unless charset of their
+        provider type and host is known already
+
+        :param providers: data providers
+        :type providers: iterable
+        """
+        for provider in providers:
+            if provider.coding:
+                self._charsets.setdefault(
+                    self._key(provider.type, provider.link),
+                    provider.coding.lower())
+
+    def get(self, provider_type, url):
+        return self._charsets.get(self._key(provider_type, url))
+
+    def learn(self, provider_type, url, charset):
+        self._charsets[self._key(provider_type, url)] = charset
+
+    def get_encoding(self, response, provider_type, url):
+        """
+        return charset response should be decoded with, None if unknown
+
+        :param response: fetched response
+        :type response: requests.Response
+        :param provider_type: type of data provider
+        :type provider_type: str
+        :param url: fetched url
+        :type url: str
+        :rtype: str|None
+        """
+        charset = get_header_charset(response)
+        if charset is not None:
+            self.learn(provider_type, url, charset)
+            return charset
+        return self.get(provider_type, url)
+
+    def decode(self, response, provider_type, url):
+        """
+        return payload of response decoded once with known charset,
+        the charset is detected if there is no one or it does not fit
+
+        :param response: fetched response
+        :type response: requests.Response
+        :param provider_type: type of data provider
+        :type provider_type: str
+        :param url: fetched url
+        :type url: str
+        :rtype: str
+        """
+        text, charset = decode_content(
+            response.content, self.get_encoding(response, provider_type, url))
+        self.learn(provider_type, url, charset)
+        return text
+
+
+def decode_content(content, charset=None):
+    """
+    return payload decoded with charset, or with detected one
+    if charset is not set or payload does not decode with it
+
+    :param content: raw payload
+    :type content: bytes
+    :param charset: expected charset
+    :type charset: str
+    :return: (text, charset used)
+    :rtype: tuple
+    """
+    if charset is not None:
+        try:
+            return content.decode(charset), charset
+        except (UnicodeDecodeError, LookupError):
+            logger.info('Payload is not in {}, detecting charset'.format(
+                charset))
+
+    charset = detect_charset(content)
+    return content.decode(charset, 'replace'), charset
+
+
+charsets = CharsetCache()
+
+
+def get_digest(content):
+    """
+    return digest of payload
+
+    :param content: raw payload or parsed json
+    :type content: bytes|dict|list
+    :rtype: str
+    """
+    if not isinstance(content, bytes):
+        content = json.dumps(content, sort_keys=True, ensure_ascii=False,
+                             separators=(',', ':')).encode('utf-8')
+    return hashlib.sha1(content).hexdigest()
+
+
+def get_conditional_headers(data_provider):
+    """
+    return headers of conditional request for payload
+    fetched from data provider before
+
+    :param data_provider: data provider with stored fetch state
+    :type data_provider: .models.DataProviderUrl
+    :rtype: dict
+    """
+    headers = {}
+    if data_provider.etag:
+        headers['If-None-Match'] = data_provider.etag
+    if data_provider.last_modified:
+        headers['If-Modified-Since'] = data_provider.last_modified
+    return headers
+
+
+def is_not_modified(response):
+    return response.status_code == 304
+
+
+class FetchResult(namedtuple('FetchResult',
+                             ('key', 'url', 'response', 'error'))):
+
+    @property
+    def ok(self):
+        return self.error is None and self.response.ok
+
+
+class AsyncFetcher(object):
+    """
+    Downloads batch of urls on asyncio event loop running
+    in background thread, so the caller is able to parse
+    and write to DB already completed pages while the rest
+    are still downloading.
+    """
+
+    def __init__(self, concurrency=DEFAULT_POOL_SIZE,
+                 per_host=DEFAULT_PER_HOST, timeout=DEFAULT_TIMEOUT,
+                 session=None):
+        """
+        :param concurrency: max count of requests in flight
+        :type concurrency: int
+        :param per_host: max count of requests in flight to one host
+        :type per_host: int
+        :param timeout: connect and read timeout of request, seconds
+        :type timeout: float
+        :param session: shared keep-alive session
+        :type session: requests.Session
+        """
+        self.concurrency = max(concurrency, 1)
+        self.per_host = max(per_host, 1)
+        self.timeout = timeout
+        self.session = session or get_session(self.concurrency)
+
+    def iter_results(self, jobs, ordered=False):
+        """
+        fetch jobs concurrently and yield results
+
+        :param jobs: pairs of (key, url) or triples of (key, url, headers),
+        key is returned back in result
+        :type jobs: iterable
+        :param ordered: yield results in jobs order instead
+        of completion order
+        :type ordered: bool
+        :return: generator of FetchResult
+        """
+        jobs = list(jobs)
+        if not jobs:
+            return
+
+        results = Queue()
+        thread = threading.Thread(target=self._run, args=(jobs, results))
+        thread.daemon = True
+        thread.start()
+
+        pending = {}
+        expected = 0
+        while True:
+            item = results.get()
+            if item is _DONE:
+                break
+
+            index, result = item
+            if not ordered:
+                yield result
+                continue
+
+            pending[index] = result
+            while expected in pending:
+                yield pending.pop(expected)
+                expected += 1
+
+        thread.join()
+
+    def fetch_all(self, jobs):
+        """
+        return results of all jobs in jobs order
+
+        :param jobs: pairs of (key, url) or triples of (key, url, headers)
+        :type jobs: iterable
+        :rtype: list
+        """
+        return list(self.iter_results(jobs, ordered=True))
+
+    def _run(self, jobs, results):
+        loop = asyncio.new_event_loop()
+        executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        try:
+            loop.run_until_complete(
+                self._crawl(loop, executor, jobs, results))
+        finally:
+            executor.shutdown(wait=False)
+            loop.close()
+            results.put(_DONE)
+
+    async def _crawl(self, loop, executor, jobs, results):
+        limit = asyncio.Semaphore(self.concurrency)
+        hosts = defaultdict(lambda: asyncio.Semaphore(self.per_host))
+
+        async def fetch(index, key, url, headers=None):
+            response = None
+            error = None
+            async with hosts[urlparse(url).netloc]:
+                async with limit:
+                    try:
+                        response = await loop.run_in_executor(
+                            executor,
+                            partial(self.session.get, url,
+                                    headers=headers,
+                                    timeout=self.timeout))
+                    except requests.RequestException as e:
+                        # error message has url with API key in it
+                        logger.warning('Fetch failed: {} {}'.format(
+                            normalize_url(url), type(e).__name__))
+                        error = e
+
+            results.put((index, FetchResult(key, url, response, error)))
+
+        await asyncio.gather(*[fetch(index, *job)
+                               for index, job in enumerate(jobs)])
@@ -0,0 +1,438 @@
+# coding=utf-8
+
+import datetime
+import heapq
+import math
+from collections import namedtuple
+
+import numpy as np
+
+from .models import GeoDirections, Point
+
+EARTH_RADIUS = 6371008.8
+
+SECONDS_PER_DAY = 24 * 60 * 60
+
+# roughly seconds of travel per degree between stops
+TRAVEL_TIME_FACTOR = 10000
+
+# max count of points in a leaf of k-d tree, leaves are scanned at once
+KD_LEAF_SIZE = 16
+
+# meters per minute, about 4.5 km/h
+WALK_SPEED = 75.0
+
+# max distance in meters of walking transfer between stops
+WALK_RADIUS = 400.0
+
+_WKT_PUNCTUATION = {ord('('): ' ', ord(')'): ' '}
+
+_GEO_DIRECTION_CODES = [key for key, _ in GeoDirections.as_tuple]
+
+
+RouteGeometry = namedtuple('RouteGeometry',
+                           ('angles', 'geo_directions', 'offsets'))
+
+
+def compute_route_geometry(lons, lats):
+    """
+    return geometry of route stops sequence calculated in one pass,
+    results are the same as calculating stop by stop with
+    Point.angle, GeoDirections.from_angle and accumulating time
+
+    :param lons: longitudes of stops in route order
+    :type lons: list|np.ndarray
+    :param lats: latitudes of stops in route order
+    :type lats: list|np.ndarray
+    :return: cumulative angles, geo direction codes and
+    offsets in seconds from the first stop
+    :rtype: RouteGeometry
+    """
+    lons = np.asarray(lons, dtype=float)
+    lats = np.asarray(lats, dtype=float)
+    if not len(lons):
+        return RouteGeometry(np.zeros(0), [], np.zeros(0, dtype=np.int64))
+
+    lengths = np.hypot(lons, lats)
+
+    # angle between each stop and the previous one, the same as Point.angle
+    steps = np.zeros(len(lons))
+    steps[1:] = np.degrees(
+        (lons[1:] * lons[:-1] + lats[1:] * lats[:-1])
+        / (lengths[1:] * lengths[:-1]))
+    angles = accumulate_angles(steps)
+
+    geo_directions = [_GEO_DIRECTION_CODES[index]
+                      for index in get_geo_direction_indexes(angles)]
+
+    deltas = np.zeros(len(lons), dtype=np.int64)
+    deltas[1:] = np.trunc(
+        np.hypot(np.diff(lons), np.diff(lats)) * TRAVEL_TIME_FACTOR)
+    offsets = np.cumsum(deltas) % SECONDS_PER_DAY
+
+    return RouteGeometry(angles, geo_directions, offsets)
+
+
+def accumulate_angles(steps):
+    """
+    return angles accumulated from steps and normalized at every step
+    with GeoDirections.normalize_angle, computed without Python loop
+
+    normalize_angle keeps non-negative angle modulo 360, but turns
+    negative one into 360 + angle % 360. So every angle is the sum of
+    steps modulo 360, plus 360 where the previous angle and the step
+    sum up to negative. That happens only if the previous angle
+    is below 360, as steps are less than 180 in absolute value.
+
+    :param steps: angles between stops in degrees, the first is 0
+    :type steps: np.ndarray
+    :rtype: np.ndarray
+    """
+    angles = np.cumsum(steps) % 360
+    angles[1:] += 360 * (angles[:-1] + steps[1:] < 0)
+    return angles
+
+
+def get_geo_direction_indexes(angles):
+    """
+    return indexes of GeoDirections.as_tuple for angles,
+    the same as GeoDirections.from_angle
+
+    :param angles: angles in degrees
+    :type angles: np.ndarray
+    :rtype: np.ndarray
+    """
+    count = len(_GEO_DIRECTION_CODES)
+    step = 360 / count
+    comp_angles = np.round(np.mod(angles, 360) + step / 2, 1)
+    return (np.floor_divide(comp_angles, step).astype(int)) % count
+
+
+def offset_to_time(offset):
+    """
+    return time of day of offset in seconds from midnight
+
+    :param offset: seconds
+    :type offset: int
+    :rtype: datetime.time
+    """
+    offset = int(offset)
+    return datetime.time(offset // 3600, offset % 3600 // 60, offset % 60)
+
+
+def haversine(lons1, lats1, lons2, lats2):
+    """
+    return great circle distances between WGS84 points,
+    arguments are scalars or arrays of the same shape
+
+    :return: distances in meters
+    :rtype: float|np.ndarray
+    """
+    lons1, lats1, lons2, lats2 = map(np.radians, (lons1, lats1, lons2, lats2))
+    a = np.sin((lats2 - lats1) / 2) ** 2 \
+        + np.cos(lats1) * np.cos(lats2) * np.sin((lons2 - lons1) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(a))
+
+
+def bearing(lons1, lats1, lons2, lats2):
+    """
+    return initial bearings from first points to second ones,
+    arguments are scalars or arrays of the same shape
+
+    :return: bearings in degrees from north, clockwise, 0 - 360
+    :rtype: float|np.ndarray
+    """
+    lons1, lats1, lons2, lats2 = map(np.radians, (lons1, lats1, lons2, lats2))
+    dlon = lons2 - lons1
+    x = np.sin(dlon) * np.cos(lats2)
+    y = np.cos(lats1) * np.sin(lats2) \
+        - np.sin(lats1) * np.cos(lats2) * np.cos(dlon)
+    return np.mod(np.degrees(np.arctan2(x, y)), 360)
+
+
+def to_unit_vectors(lons, lats):
+    """
+    return points on unit sphere, straight line distance between them
+    grows with great circle distance, see chord_to_meters
+
+    :rtype: np.ndarray
+    """
+    lons = np.radians(np.asarray(lons, dtype=float))
+    lats = np.radians(np.asarray(lats, dtype=float))
+    return np.column_stack((np.cos(lats) * np.cos(lons),
+                            np.cos(lats) * np.sin(lons),
+                            np.sin(lats)))
+
+
+def chord_to_meters(chord):
+    """
+    return great circle distance of chord between unit vectors
+    """
+    return 2 * EARTH_RADIUS * np.arcsin(np.minimum(np.asarray(chord) / 2, 1))
+
+
+def meters_to_chord(meters):
+    """
+    return chord between unit vectors of great circle distance
+    """
+    return 2 * math.sin(min(meters / (2 * EARTH_RADIUS), math.pi / 2))
+
+
+class KDTree(object):
+    """
+    Static k-d tree over points of any dimension. Nodes are split
+    by median of the widest axis and keep bounding boxes, so searches
+    skip nodes farther than the found points. Points of a leaf are
+    measured in one numpy call.
+    """
+
+    def __init__(self, points, leaf_size=KD_LEAF_SIZE):
+        """
+        :param points: array of shape (count, dimensions)
+        :type points: np.ndarray
+        :param leaf_size: max count of points in leaf
+        :type leaf_size: int
+        """
+        self.points = np.ascontiguousarray(points, dtype=float)
+        self.leaf_size = max(leaf_size, 1)
+        self.indexes = np.arange(len(self.points))
+        # (start, end, lower, upper, left, right), left is -1 for leaves
+        self._nodes = []
+        if len(self.points):
+            self._build(0, len(self.points))
+
+    def __len__(self):
+        return len(self.points)
+
+    def _build(self, start, end):
+        points = self.points[self.indexes[start:end]]
+        lower = points.min(axis=0)
+        upper = points.max(axis=0)
+        node = len(self._nodes)
+        self._nodes.append(None)
+
+        left = right = -1
+        if end - start > self.leaf_size:
+            axis = int(np.argmax(upper - lower))
+            middle = (start + end) // 2
+            order = np.argpartition(points[:, axis], middle - start)
+            self.indexes[start:end] = self.indexes[start:end][order]
+            left = self._build(start, middle)
+            right = self._build(middle, end)
+
+        self._nodes[node] = (start, end, tuple(lower.tolist()),
+                             tuple(upper.tolist()), left, right)
+        return node
+
+    def _box_distance(self, node, point):
+        _, _, lower, upper, _, _ = self._nodes[node]
+        total = 0.0
+        for low, high, value in zip(lower, upper, point):
+            if value < low:
+                total += (low - value) ** 2
+            elif value > high:
+                total += (value - high) ** 2
+        return math.sqrt(total)
+
+    def _leaf_distances(self, start, end, point):
+        indexes = self.indexes[start:end]
+        distances = np.sqrt(((self.points[indexes] - point) ** 2).sum(axis=1))
+        return zip(distances.tolist(), indexes.tolist())
+
+    def query(self, point, k=1):
+        """
+        return k nearest points
+
+        :param point: point of the same dimension as tree points
+        :type point: iterable
+        :param k: count of points
+        :type k: int
+        :return: list of (distance, index of point) sorted by distance
+        :rtype: list
+        """
+        if not self._nodes or k < 1:
+            return []
+
+        point = tuple(float(value) for value in point)
+        # the farthest of found points is on top
+        found = []
+        nodes = [(0.0, 0)]
+        while nodes:
+            distance, node = heapq.heappop(nodes)
+            if len(found) == k and distance > -found[0][0]:
+                break
+
+            start, end, _, _, left, right = self._nodes[node]
+            if left < 0:
+                for distance, index in self._leaf_distances(start, end,
+                                                            point):
+                    if len(found) < k:
+                        heapq.heappush(found, (-distance, index))
+                    elif distance < -found[0][0]:
+                        heapq.heapreplace(found, (-distance, index))
+            else:
+                for child in (left, right):
+                    heapq.heappush(
+                        nodes, (self._box_distance(child, point), child))
+
+        return sorted((-distance, index) for distance, index in found)
+
+    def query_radius(self, point, radius):
+        """
+        return points not farther than radius
+
+        :param point: point of the same dimension as tree points
+        :type point: iterable
+        :param radius: max distance
+        :type radius: float
+        :return: list of (distance, index of point) sorted by distance
+        :rtype: list
+        """
+        if not self._nodes:
+            return []
+
+        point = tuple(float(value) for value in point)
+        found = []
+        nodes = [0]
+        while nodes:
+            node = nodes.pop()
+            if self._box_distance(node, point) > radius:
+                continue
+
+            start, end, _, _, left, right = self._nodes[node]
+            if left < 0:
+                found.extend(item for item in self._leaf_distances(
+                    start, end, point) if item[0] <= radius)
+            else:
+                nodes.extend((left, right))
+
+        found.sort()
+        return found
+
+
+def walk_minutes(meters, speed=WALK_SPEED):
+    """
+    return whole minutes to walk the distance, at least one
+
+    :rtype: int
+    """
+    return max(1, int(math.ceil(meters / speed)))
+
+
+def get_walking_transfers(lons, lats, radius=WALK_RADIUS, speed=WALK_SPEED):
+    """
+    return walking transfers between points not farther than radius
+    from each other, both ways
+
+    :param lons: longitudes of points
+    :type lons: list|np.ndarray
+    :param lats: latitudes of points
+    :type lats: list|np.ndarray
+    :return: list of (index of point, index of other point, minutes)
+    :rtype: list
+    """
+    tree = KDTree(to_unit_vectors(lons, lats))
+    chord = meters_to_chord(radius)
+
+    transfers = []
+    for index, point in enumerate(tree.points):
+        for distance, other in tree.query_radius(point, chord):
+            if other != index:
+                transfers.append(
+                    (index, other,
+                     walk_minutes(float(chord_to_meters(distance)), speed)))
+    return transfers
+
+
+class PointArray(object):
+    """
+    Sequence of points kept in two contiguous float arrays,
+    so a whole route or city of stops is just two buffers.
+    Items are returned as models.Point.
+    """
+
+    __slots__ = ('lons', 'lats')
+
+    def __init__(self, lons=(), lats=()):
+        self.lons = np.ascontiguousarray(lons, dtype=float)
+        self.lats = np.ascontiguousarray(lats, dtype=float)
+        if self.lons.shape != self.lats.shape:
+            raise ValueError('Longitudes and latitudes differ in length')
+
+    @classmethod
+    def from_points(cls, points):
+        points = list(points)
+        return cls([point.lon for point in points],
+                   [point.lat for point in points])
+
+    @classmethod
+    def from_wkt(cls, strings):
+        """
+        return points parsed from WKT strings like 'POINT(31.27 58.52)'
+        in one pass over all of them
+
+        :param strings: WKT points
+        :type strings: list
+        :rtype: PointArray
+        """
+        strings = list(strings)
+        try:
+            values = np.array(
+                ' '.join(strings).replace('POINT', '')
+                .translate(_WKT_PUNCTUATION).split(),
+                dtype=float)
+        except ValueError:
+            raise ValueError('Wrong WKT points: {}'.format(strings))
+
+        if len(values) != 2 * len(strings):
+            raise ValueError('Wrong WKT points: {}'.format(strings))
+
+        return cls(values[0::2], values[1::2])
+
+    def __len__(self):
+        return len(self.lons)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return PointArray(self.lons[index], self.lats[index])
+        return Point(float(self.lons[index]), float(self.lats[index]))
+
+    def __iter__(self):
+        for lon, lat in zip(self.lons.tolist(), self.lats.tolist()):
+            yield Point(lon, lat)
+
+    def distances(self):
+        """
+        return distances in meters between neighbour points
+
+        :rtype: np.ndarray
+        """
+        return haversine(self.lons[:-1], self.lats[:-1],
+                         self.lons[1:], self.lats[1:])
+
+    def bearings(self):
+        """
+        return bearings in degrees between neighbour points
+
+        :rtype: np.ndarray
+        """
+        return bearing(self.lons[:-1], self.lats[:-1],
+                       self.lons[1:], self.lats[1:])
+
+    def length(self):
+        """
+        return length in meters of polyline through the points
+
+        :rtype: float
+        """
+        return float(self.distances().sum())
+
+    def distances_to(self, point):
+        """
+        return distances in meters from every point to point
+
+        :param point: point to measure distance to
+        :type point: models.Point
+        :rtype: np.ndarray
+        """
+        return haversine(self.lons, self.lats, point.lon, point.lat)
@@ -0,0 +1,191 @@
+# coding=utf-8
+
+import datetime
+import logging
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+from .geometry import WALK_RADIUS, walk_minutes
+from .journeys import MAX_TRANSFERS, get_journey_planner
+from .nearest import get_nearest_stop_index
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DURATION = 30
+MAX_DURATION = 180
+
+# origins per task of batch worker
+BATCH_CHUNK_SIZE = 16
+
+Isochrone = namedtuple('Isochrone', ('departure', 'duration', 'arrivals'))
+
+
+def get_arrivals(planner, timetable, sources, limit,
+                 max_transfers=MAX_TRANSFERS):
+    """
+    return the earliest arrivals at stops reachable not later than limit
+
+    :param planner: journey planner
+    :type planner: .journeys.JourneyPlanner
+    :param timetable: timetable of the day
+    :type timetable: .journeys.Timetable
+    :param sources: minutes of departure by stop id
+    :type sources: dict
+    :param limit: max minutes of arrival
+    :type limit: int
+    :return: minutes since midnight of arrival by stop id
+    :rtype: dict
+    """
+    arrivals = {}
+    # every round labels only stops it reaches earlier
+    for label in planner.search(timetable, sources,
+                                max_transfers=max_transfers, limit=limit):
+        for stop_id, (arrival, _, _) in label.items():
+            arrivals[stop_id] = arrival
+    return arrivals
+
+
+def get_stop_sources(planner, stop_id, minutes):
+    """
+    return departure minutes of stops of the platform of stop
+    """
+    return dict((other, minutes)
+                for other in planner.get_platform_stops(stop_id))
+
+
+def get_point_sources(nearest_index, lon, lat, minutes, radius=WALK_RADIUS):
+    """
+    return departure minutes of stops reached from point by walk
+    """
+    return dict((stop.stop, minutes + walk_minutes(stop.distance))
+                for stop in nearest_index.within(lon, lat, radius))
+
+
+def get_isochrone(when, duration=DEFAULT_DURATION, stop_id=None, lon=None,
+                  lat=None, max_transfers=MAX_TRANSFERS):
+    """
+    return stops reachable from stop or point within duration
+    departing at the moment, schedule of the day of the moment
+    only is used
+
+    :param when: moment of departure
+    :type when: datetime.datetime
+    :param duration: minutes of journey
+    :type duration: int
+    :param stop_id: id of stop to depart from
+    :type stop_id: int
+    :param lon: longitude of point to depart from, if stop is not set
+    :type lon: float
+    :param lat: latitude of point to depart from
+    :type lat: float
+    :return: isochrone with arrivals as list of (stop id, datetime)
+    sorted by arrival
+    :rtype: Isochrone
+    """
+    planner = get_journey_planner()
+    minutes = when.hour * 60 + when.minute
+    if stop_id is not None:
+        sources = get_stop_sources(planner, stop_id, minutes)
+    else:
+        sources = get_point_sources(get_nearest_stop_index(), lon, lat,
+                                    minutes)
+
+    timetable = planner.get_timetable(when.isoweekday())
+    arrivals = get_arrivals(planner, timetable, sources, minutes + duration,
+                            max_transfers)
+
+    midnight = when.replace(hour=0, minute=0, second=0, microsecond=0)
+    return Isochrone(when, duration, [
+        (stop, midnight + datetime.timedelta(minutes=arrival))
+        for arrival, stop in sorted((arrival, stop)
+                                    for stop, arrival in arrivals.items())])
+
+
+def to_geojson(isochrone):
+    """
+    return isochrone as GeoJSON feature collection of reachable stops
+
+    :type isochrone: Isochrone
+    :rtype: dict
+    """
+    index = get_nearest_stop_index()
+    features = []
+    for stop_id, arrival in isochrone.arrivals:
+        stop = index.get(stop_id)
+        if stop is None:
+            continue
+        features.append({
+            'type': 'Feature',
+            'geometry': {'type': 'Point',
+                         'coordinates': [stop['lon'], stop['lat']]},
+            'properties': {
+                'stop': stop_id,
+                'platform': stop['platform'],
+                'name': index.platform_names.get(stop['platform']),
+                'arrival': arrival.isoformat(),
+                'minutes': int((arrival - isochrone.departure)
+                               .total_seconds() // 60),
+            },
+        })
+    return {'type': 'FeatureCollection', 'features': features}
+
+
+def _get_batch_arrivals(task):
+    weekday, minutes, duration, max_transfers, origins = task
+    planner = get_journey_planner()
+    timetable = planner.get_timetable(weekday)
+
+    result = []
+    for origin in origins:
+        arrivals = get_arrivals(planner, timetable,
+                                get_stop_sources(planner, origin, minutes),
+                                minutes + duration, max_transfers)
+        result.append((origin, dict((stop, arrival - minutes)
+                                    for stop, arrival in arrivals.items())))
+    return result
+
+
+def iter_batch_isochrones(when, duration=DEFAULT_DURATION, origins=None,
+                          jobs=1, max_transfers=MAX_TRANSFERS):
+    """
+    return isochrones of many stops computed by processes, for
+    accessibility maps of the whole city
+
+    :param when: moment of departure
+    :type when: datetime.datetime
+    :param duration: minutes of journey
+    :type duration: int
+    :param origins: ids of stops to depart from, all stops by default
+    :type origins: iterable
+    :param jobs: count of processes
+    :type jobs: int
+    :return: iterator of (origin stop id, dict of minutes of journey
+    by reachable stop id) in the order of origins
+    :rtype: iterator
+    """
+    weekday = when.isoweekday()
+    minutes = when.hour * 60 + when.minute
+
+    # compiled before workers are forked, so they share it
+    planner = get_journey_planner()
+    planner.get_timetable(weekday)
+
+    if origins is None:
+        origins = sorted(planner.stop_platforms)
+    origins = list(origins)
+    tasks = [(weekday, minutes, duration, max_transfers,
+              origins[i:i + BATCH_CHUNK_SIZE])
+             for i in range(0, len(origins), BATCH_CHUNK_SIZE)]
+
+    if jobs > 1:
+        executor = ProcessPoolExecutor(jobs)
+        try:
+            for result in executor.map(_get_batch_arrivals, tasks):
+                for item in result:
+                    yield item
+        finally:
+            executor.shutdown()
+    else:
+        for task in tasks:
+            for item in _get_batch_arrivals(task):
+                yield item
@@ -0,0 +1,137 @@
+# coding=utf-8
+
+import logging
+
+from django.db import IntegrityError, transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from .bulk import BATCH_SIZE
+from .models import ChangeOperations as ops, ChangeRecord, SyncRun
+
+logger = logging.getLogger(__name__)
+
+# runs finished at the same moment get the same next sequence,
+# all but one of them take the next one again
+FINISH_ATTEMPTS = 10
+
+
+class Journal(object):
+    """
+    Change records of one sync run. Records are kept in memory and
+    written in bulk when the run is finished, so consumers asking
+    for changes since a run never see a run half written. Finished
+    run gets the next sequence number in the same transaction, runs
+    are paged by it, so a run started before but finished after
+    the run consumer has seen is not missed.
+    """
+
+    def __init__(self, run):
+        self.run = run
+        self._records = []
+
+    @classmethod
+    def start(cls, command):
+        """
+        return journal of new sync run
+
+        :param command: name of sync command
+        :type command: str
+        :rtype: Journal
+        """
+        return cls(SyncRun.objects.create(command=command))
+
+    def record(self, entity, ids, operation, fields=()):
+        """
+        remember change of entities
+
+        :param entity: name of changed model
+        :type entity: str
+        :param ids: pks of changed objects
+        :type ids: iterable
+        :param operation: one of ChangeOperations
+        :type operation: str
+        :param fields: changed fields, or scope of replace
+        :type fields: iterable
+        """
+        fields = ','.join(fields)
+        self._records.extend(
+            ChangeRecord(run=self.run, entity=entity, entity_id=pk,
+                         operation=operation, fields=fields)
+            for pk in ids)
+
+    def created(self, objs):
+        self._record_objs(objs, ops.CREATE)
+
+    def deleted(self, objs):
+        self._record_objs(objs, ops.DELETE)
+
+    def updated(self, objs, fields):
+        self._record_objs(objs, ops.UPDATE, fields)
+
+    def _record_objs(self, objs, operation, fields=()):
+        objs = list(objs)
+        if objs:
+            self.record(type(objs[0]).__name__, [obj.pk for obj in objs],
+                        operation, fields)
+
+    def finish(self):
+        """
+        write change records and mark run finished with the next
+        sequence number
+
+        :return: count of change records
+        :rtype: int
+        """
+        for attempt in range(FINISH_ATTEMPTS):
+            try:
+                with transaction.atomic():
+                    ChangeRecord.objects.bulk_create(self._records,
+                                                     batch_size=BATCH_SIZE)
+                    self.run.finished = timezone.now()
+                    self.run.sequence = get_last_sequence() + 1
+                    self.run.save(update_fields=['finished', 'sequence'])
+                break
+            except IntegrityError:
+                if attempt + 1 == FINISH_ATTEMPTS:
+                    raise
+                for record in self._records:
+                    record.pk = None
+                logger.info('Sync run #%s: sequence %s is taken'
+                            % (self.run.pk, self.run.sequence))
+
+        logger.info('Sync run #%s: %s changes, sequence %s'
+                    % (self.run.pk, len(self._records), self.run.sequence))
+        count = len(self._records)
+        self._records = []
+        return count
+
+
+def get_last_sequence():
+    """
+    return sequence of the last finished sync run, 0 if there is none
+
+    :rtype: int
+    """
+    return SyncRun.objects.aggregate(last=Max('sequence'))['last'] or 0
+
+
+def get_changes_since(sequence, entities=None):
+    """
+    return changes of sync runs finished after run
+
+    :param sequence: sequence of the last run consumer has seen,
+    0 for all
+    :type sequence: int
+    :param entities: names of models to return changes of
+    :type entities: iterable
+    :return: change records in the order they were made
+    :rtype: django.db.models.QuerySet
+    """
+    qs = ChangeRecord.objects\
+        .filter(run__sequence__gt=sequence)\
+        .select_related('run')\
+        .order_by('run__sequence', 'pk')
+    if entities is not None:
+        qs = qs.filter(entity__in=list(entities))
+    return qs
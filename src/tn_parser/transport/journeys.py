@@ -0,0 +1,454 @@
+# coding=utf-8
+
+import datetime
+import logging
+from array import array
+from bisect import bisect_left
+from collections import defaultdict, namedtuple
+
+from .departures import get_schedule_day, parse_minutes
+from .snapshots import loader
+
+logger = logging.getLogger(__name__)
+
+MINUTES_PER_DAY = 24 * 60
+
+# every round of search is one more ride
+MAX_TRANSFERS = 4
+
+# minutes to go between stops of the same platform
+PLATFORM_TRANSFER_TIME = 2
+
+_INFINITY = float('inf')
+
+# kinds of search labels
+_ORIGIN = 'origin'
+_RIDE = 'ride'
+_WALK = 'walk'
+
+Leg = namedtuple('Leg', ('route', 'direction', 'from_stop', 'to_stop',
+                         'departure', 'arrival'))
+
+Journey = namedtuple('Journey', ('departure', 'arrival', 'transfers',
+                                 'legs'))
+
+
+def get_trip_minutes(times):
+    """
+    return minutes since midnight of trip stops growing along the trip:
+    times after midnight are moved to the next day, times going back
+    a little (typos of timetable) are taken equal to the previous one
+
+    :param times: times of trip stops like 5:07
+    :type times: iterable
+    :rtype: list
+    """
+    result = []
+    last = None
+    for value in times:
+        minutes = parse_minutes(value)
+        if last is not None:
+            while minutes < last - MINUTES_PER_DAY // 2:
+                minutes += MINUTES_PER_DAY
+            minutes = max(minutes, last)
+        result.append(minutes)
+        last = minutes
+    return result
+
+
+def split_overtaking(trips):
+    """
+    return trips split into chains where no trip overtakes another,
+    so the first trip departing after a moment is the first to arrive
+
+    :param trips: minutes of trips at the same stops
+    :type trips: iterable
+    :rtype: list
+    """
+    chains = []
+    for trip in sorted(trips):
+        for chain in chains:
+            if all(a <= b for a, b in zip(chain[-1], trip)):
+                chain.append(trip)
+                break
+        else:
+            chains.append([trip])
+    return chains
+
+
+class Pattern(object):
+    """
+    Trips of route following the same stops without overtaking each
+    other. Minutes of all trips are kept in one int array stop by stop,
+    so departures from a stop are a sorted slice of it to bisect.
+    """
+
+    __slots__ = ('route', 'direction', 'stops', 'times', 'trips')
+
+    def __init__(self, route, direction, stops, trips):
+        """
+        :param route: id of route
+        :type route: int
+        :param direction: direction of trips
+        :type direction: str
+        :param stops: ids of stops in trip order
+        :type stops: iterable
+        :param trips: minutes of trips at stops, see split_overtaking
+        :type trips: list
+        """
+        self.route = route
+        self.direction = direction
+        self.stops = array('i', stops)
+        self.trips = len(trips)
+        self.times = array('i', (trip[position]
+                                 for position in range(len(self.stops))
+                                 for trip in trips))
+
+    def time(self, trip, position):
+        return self.times[position * self.trips + trip]
+
+    def find_trip(self, position, minutes):
+        """
+        return the first trip departing from stop at position
+        not earlier than minutes, -1 if there is none
+
+        :rtype: int
+        """
+        start = position * self.trips
+        trip = bisect_left(self.times, minutes, start,
+                           start + self.trips) - start
+        return trip if trip < self.trips else -1
+
+
+class Timetable(object):
+    """
+    Route patterns of one day of week and patterns serving each stop.
+    """
+
+    def __init__(self, patterns):
+        self.patterns = patterns
+        self.stop_patterns = defaultdict(list)
+        for index, pattern in enumerate(patterns):
+            for position, stop_id in enumerate(pattern.stops):
+                self.stop_patterns[stop_id].append((index, position))
+
+    @classmethod
+    def compile(cls, schedules, weekday):
+        """
+        return timetable of routes for day of week
+
+        :param schedules: trips of routes by day of schedule,
+        see JourneyPlanner
+        :type schedules: dict
+        :param weekday: day of week from 1 to 7
+        :type weekday: int
+        :rtype: Timetable
+        """
+        groups = defaultdict(list)
+        for route_id, schedule in sorted(schedules.items()):
+            day = get_schedule_day(schedule, weekday)
+            if day is None:
+                continue
+            for trip in schedule[day]:
+                if len(trip['stops']) < 2:
+                    continue
+                stops = tuple(stop_id for stop_id, _ in trip['stops'])
+                groups[(route_id, trip['direction'], stops)].append(
+                    get_trip_minutes(time for _, time in trip['stops']))
+
+        patterns = []
+        for (route_id, direction, stops), trips in sorted(groups.items()):
+            for chain in split_overtaking(trips):
+                patterns.append(Pattern(route_id, direction, stops, chain))
+
+        logger.debug('Timetable compiled: day: %s, patterns: %s'
+                     % (weekday, len(patterns)))
+        return cls(patterns)
+
+
+class JourneyPlanner(object):
+    """
+    Earliest arrival journeys between stops found by rounds like RAPTOR
+    does: round k scans once every route pattern serving stops reached
+    in round k - 1, so it finds journeys of k rides, then transfers
+    from the reached stops are relaxed, one walk between rides.
+    Timetables are compiled from snapshot schedules per day of week once.
+    """
+
+    def __init__(self, schedules=None, routes=None, platform_stops=None,
+                 walking_transfers=()):
+        """
+        :param schedules: trips of routes by day of schedule, dict of
+        route id -> day -> trips as in snapshot route documents
+        :type schedules: dict
+        :param routes: route codes by route id
+        :type routes: dict
+        :param platform_stops: stop ids by platform id
+        :type platform_stops: dict
+        :param walking_transfers: (stop id, other stop id, minutes)
+        of nearby stops, see geometry.get_walking_transfers
+        :type walking_transfers: iterable
+        """
+        self.schedules = schedules or {}
+        self.routes = routes or {}
+        self.platform_stops = platform_stops or {}
+
+        self.stop_platforms = {}
+        transfers = defaultdict(dict)
+        for platform_id, stops in self.platform_stops.items():
+            for stop_id in stops:
+                self.stop_platforms[stop_id] = platform_id
+                for other in stops:
+                    if other != stop_id:
+                        transfers[stop_id][other] = PLATFORM_TRANSFER_TIME
+        for stop_id, other, minutes in walking_transfers:
+            transfers[stop_id][other] = min(
+                minutes, transfers[stop_id].get(other, minutes))
+
+        # list of (stop id, minutes) by stop id
+        self.transfers = dict((stop_id, sorted(others.items()))
+                              for stop_id, others in transfers.items())
+
+        self._timetables = {}
+
+    @classmethod
+    def load(cls, snapshot):
+        """
+        return planner of not canceled routes of snapshot
+
+        :type snapshot: .snapshots.Snapshot
+        :rtype: JourneyPlanner
+        """
+        schedules = {}
+        routes = {}
+        for route in snapshot.get_data('routes', ()):
+            if route['canceled'] is not None:
+                continue
+            routes[route['id']] = route['code']
+            document = snapshot.get_data('routes/{}'.format(route['id']), {})
+            schedules[route['id']] = dict(
+                (int(day), trips)
+                for day, trips in document.get('schedule', {}).items())
+
+        platform_stops = dict(
+            (platform['id'], platform['stops'])
+            for platform in snapshot.get_data('platforms', ()))
+        return cls(schedules, routes, platform_stops,
+                   snapshot.get_data('transfers', ()))
+
+    def get_timetable(self, weekday):
+        """
+        return timetable of day of week, compiled on first use
+
+        :rtype: Timetable
+        """
+        timetable = self._timetables.get(weekday)
+        if timetable is None:
+            timetable = self._timetables[weekday] = Timetable.compile(
+                self.schedules, weekday)
+        return timetable
+
+    def get_platform_stops(self, stop_id):
+        """
+        return ids of all stops of platform of stop
+        """
+        return self.platform_stops.get(self.stop_platforms.get(stop_id),
+                                       [stop_id])
+
+    def search(self, timetable, sources, targets=frozenset(),
+               max_transfers=MAX_TRANSFERS, limit=None):
+        """
+        return labels of stops reached in each round, a label is
+        (arrival minutes, kind, data): data of ride is (pattern index,
+        trip, boarding position, alighting position), data of walk
+        is (stop it starts from, label of the stop)
+
+        :param timetable: timetable of the day
+        :type timetable: Timetable
+        :param sources: minutes since midnight journey starts at
+        from each stop, by stop id
+        :type sources: dict
+        :param targets: ids of stops journey ends at
+        :type targets: collections.Container
+        :param max_transfers: max count of transfers between routes
+        :type max_transfers: int
+        :param limit: max minutes of arrival, stops reached later
+        are not labeled
+        :type limit: int
+        :rtype: list of dicts of stop id -> label
+        """
+        best = {}
+        labels = [{}]
+        marked = set()
+        for stop_id, minutes in sources.items():
+            best[stop_id] = minutes
+            labels[0][stop_id] = (minutes, _ORIGIN, None)
+            marked.add(stop_id)
+        # nothing arriving later than the best arrival at targets
+        # or the limit is of interest
+        target_best = min([best[stop_id] for stop_id in targets
+                           if stop_id in best]
+                          + [_INFINITY if limit is None else limit + 1])
+        target_best = self._relax_transfers(labels[0], best, marked,
+                                            targets, target_best)
+
+        patterns = timetable.patterns
+        for _ in range(max_transfers + 1):
+            if not marked:
+                break
+
+            # the earliest position of each pattern to scan from
+            queue = {}
+            for stop_id in marked:
+                for index, position in timetable.stop_patterns.get(stop_id,
+                                                                   ()):
+                    if position < queue.get(index, _INFINITY):
+                        queue[index] = position
+
+            previous = dict(best)
+            label = {}
+            marked = set()
+            for index, start in queue.items():
+                pattern = patterns[index]
+                trip = -1
+                boarding = None
+                for position in range(start, len(pattern.stops)):
+                    stop_id = pattern.stops[position]
+                    if trip >= 0:
+                        arrival = pattern.time(trip, position)
+                        if arrival < best.get(stop_id, _INFINITY) \
+                                and arrival < target_best:
+                            best[stop_id] = arrival
+                            label[stop_id] = (arrival, _RIDE,
+                                              (index, trip, boarding,
+                                               position))
+                            marked.add(stop_id)
+                            if stop_id in targets:
+                                target_best = arrival
+
+                    reached = previous.get(stop_id)
+                    if reached is not None and (
+                            trip < 0 or reached < pattern.time(trip,
+                                                               position)):
+                        found = pattern.find_trip(position, reached)
+                        if found >= 0 and (trip < 0 or found < trip):
+                            trip = found
+                            boarding = position
+
+            target_best = self._relax_transfers(label, best, marked,
+                                                targets, target_best)
+            labels.append(label)
+
+        return labels
+
+    def _relax_transfers(self, label, best, marked, targets, target_best):
+        # walks start from stops reached by ride only,
+        # the labels they start from are kept with them
+        for stop_id, start in [(stop_id, label[stop_id])
+                               for stop_id in marked]:
+            for other, walk in self.transfers.get(stop_id, ()):
+                arrival = start[0] + walk
+                if arrival < best.get(other, _INFINITY) \
+                        and arrival < target_best:
+                    best[other] = arrival
+                    label[other] = (arrival, _WALK, (stop_id, start))
+                    marked.add(other)
+                    if other in targets:
+                        target_best = arrival
+        return target_best
+
+    def _get_legs(self, timetable, labels, round_, stop_id):
+        legs = []
+        label = labels[round_][stop_id]
+        while True:
+            arrival, kind, data = label
+            if kind == _ORIGIN:
+                break
+
+            if kind == _WALK:
+                start_stop, label = data
+                legs.append(Leg(None, None, start_stop, stop_id,
+                                label[0], arrival))
+                stop_id = start_stop
+                continue
+
+            index, trip, boarding, position = data
+            pattern = timetable.patterns[index]
+            legs.append(Leg(pattern.route, pattern.direction,
+                            pattern.stops[boarding], stop_id,
+                            pattern.time(trip, boarding), arrival))
+            stop_id = pattern.stops[boarding]
+            # the round stop was reached last before boarding
+            round_ -= 1
+            while stop_id not in labels[round_]:
+                round_ -= 1
+            label = labels[round_][stop_id]
+
+        legs.reverse()
+        return legs
+
+    def plan(self, origin, destination, when, max_transfers=MAX_TRANSFERS):
+        """
+        return journeys from stop to stop departing not earlier than
+        the moment, the fastest one for each count of transfers which
+        arrives earlier than journeys with less transfers. Journeys
+        start and end at any stop of platforms of the stops, schedule
+        of the day of the moment only is used
+
+        :param origin: id of stop to start from
+        :type origin: int
+        :param destination: id of stop to get to
+        :type destination: int
+        :param when: moment to depart after
+        :type when: datetime.datetime
+        :param max_transfers: max count of transfers between routes
+        :type max_transfers: int
+        :return: journeys with times as datetimes, by transfers count
+        :rtype: list of Journey
+        """
+        timetable = self.get_timetable(when.isoweekday())
+        midnight = when.replace(hour=0, minute=0, second=0, microsecond=0)
+        targets = frozenset(self.get_platform_stops(destination))
+        minutes = when.hour * 60 + when.minute
+        labels = self.search(
+            timetable,
+            dict((stop_id, minutes)
+                 for stop_id in self.get_platform_stops(origin)),
+            targets, max_transfers)
+
+        journeys = []
+        # journey of round 0 is a walk to a stop nearby
+        for round_ in range(len(labels)):
+            reached = [(labels[round_][stop_id][0], stop_id)
+                       for stop_id in targets if stop_id in labels[round_]
+                       and labels[round_][stop_id][1] != _ORIGIN]
+            if not reached:
+                continue
+
+            legs = [leg._replace(
+                departure=midnight + datetime.timedelta(
+                    minutes=leg.departure),
+                arrival=midnight + datetime.timedelta(minutes=leg.arrival))
+                for leg in self._get_legs(timetable, labels, round_,
+                                          min(reached)[1])]
+            journeys.append(Journey(
+                legs[0].departure, legs[-1].arrival,
+                max(sum(1 for leg in legs if leg.route is not None) - 1,
+                    0),
+                legs))
+
+        return journeys
+
+
+def get_journey_planner():
+    """
+    return journey planner of the current API snapshot
+
+    :rtype: JourneyPlanner
+    """
+    return loader.get().get_index(JourneyPlanner)
+
+
+def plan_journeys(origin, destination, when, max_transfers=MAX_TRANSFERS):
+    return get_journey_planner().plan(origin, destination, when,
+                                      max_transfers)
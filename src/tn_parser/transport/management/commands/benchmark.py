@@ -0,0 +1,50 @@
+# coding=utf8
+
+import logging
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...benchmarks import BENCHMARKS, dump_results, run_benchmarks
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Benchmark parsers, platforms normalization and 2GIS sync ' \
+           'on synthetic data, DB benchmarks use a test database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('names', nargs='*', type=str,
+                            help='Benchmarks to run, all by default: ' +
+                                 ', '.join(b.name for b in BENCHMARKS))
+        parser.add_argument('--repeat', type=int, default=3,
+                            help='Count of runs of each benchmark')
+        parser.add_argument('--seed', type=int, default=0,
+                            help='Seed of synthetic data')
+        parser.add_argument('--output', type=str, default='',
+                            help='File to write JSON results to, '
+                                 'stdout by default')
+
+    def handle(self, *args, **options):
+        known = set(b.name for b in BENCHMARKS)
+        unknown = [name for name in options['names'] if name not in known]
+        if unknown:
+            raise CommandError(
+                'Unknown benchmarks: {}'.format(', '.join(unknown)))
+
+        results = run_benchmarks(options['names'],
+                                 repeat=options['repeat'],
+                                 seed=options['seed'])
+
+        if options['output']:
+            with open(options['output'], 'w') as fp:
+                dump_results(results, fp)
+        else:
+            dump_results(results, sys.stdout)
+
+        for name, result in results['results'].items():
+            self.stderr.write(
+                '{}\t{:.4f}s\t{:.1f}KiB\tqueries: {}'.format(
+                    name, result['wall_time'],
+                    result['peak_memory'] / 1024.0, result['queries']))
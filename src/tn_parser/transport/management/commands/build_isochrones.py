@@ -0,0 +1,67 @@
+# coding=utf8
+
+import json
+import logging
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from ...isochrones import DEFAULT_DURATION, iter_batch_isochrones
+from ...journeys import MAX_TRANSFERS
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Compute isochrones of all stops of API snapshot ' \
+           'as JSON lines, for accessibility maps'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--when', type=str, default='',
+                            help='Moment of departure in ISO 8601, '
+                                 'now by default')
+        parser.add_argument('--duration', type=int, default=DEFAULT_DURATION,
+                            help='Minutes of journey')
+        parser.add_argument('--transfers', type=int, default=MAX_TRANSFERS,
+                            help='Max count of transfers')
+        parser.add_argument('--jobs', type=int, default=1,
+                            help='Count of processes computing isochrones')
+        parser.add_argument('--output', type=str, default='',
+                            help='File to write JSON lines to, '
+                                 'stdout by default')
+
+    def handle(self, *args, **options):
+        when = timezone.localtime(timezone.now())
+        if options['when']:
+            try:
+                when = parse_datetime(options['when'])
+            except ValueError:
+                when = None
+            if when is None:
+                raise CommandError('Wrong --when: {}'.format(options['when']))
+            if timezone.is_naive(when):
+                when = timezone.make_aware(when)
+
+        if options['jobs'] < 1:
+            raise CommandError('--jobs should be positive')
+
+        fp = open(options['output'], 'w') if options['output'] \
+            else sys.stdout
+        count = 0
+        try:
+            for origin, arrivals in iter_batch_isochrones(
+                    when, options['duration'], jobs=options['jobs'],
+                    max_transfers=options['transfers']):
+                fp.write(json.dumps({
+                    'stop': origin,
+                    'reachable': len(arrivals),
+                    'minutes': arrivals,
+                }, sort_keys=True) + '\n')
+                count += 1
+        finally:
+            if fp is not sys.stdout:
+                fp.close()
+
+        self.stderr.write('isochrones: {}'.format(count))
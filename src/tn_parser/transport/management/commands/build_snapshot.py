@@ -0,0 +1,27 @@
+# coding=utf8
+
+import logging
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...snapshots import publish_snapshot
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Build snapshot of read-only API from DB'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--root', metavar='PATH',
+                            help='Directory of snapshots, '
+                                 'API_SNAPSHOT_ROOT by default')
+
+    def handle(self, *args, **options):
+        path = publish_snapshot(root=options['root'])
+        if path is None:
+            raise CommandError('API_SNAPSHOT_ROOT is not set')
+
+        self.stdout.write(
+            'Build API snapshot ' + self.style.SUCCESS('DONE'))
+        self.stdout.write('\tsnapshot: {}\n'.format(path))
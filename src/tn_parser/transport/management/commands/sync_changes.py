@@ -0,0 +1,37 @@
+# coding=utf8
+
+import json
+import logging
+
+from django.core.management.base import BaseCommand
+
+from ...journal import get_changes_since, get_last_sequence
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Print changes made by sync runs as JSON lines'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--since', type=int, default=0,
+                            help='Sequence of the last sync run already '
+                                 'seen, changes of runs finished later '
+                                 'are printed')
+        parser.add_argument('--entity', action='append',
+                            help='Print changes of the entity only, '
+                                 'could be repeated')
+
+    def handle(self, *args, **options):
+        changes = get_changes_since(options['since'], options['entity'])
+        for change in changes.iterator():
+            self.stdout.write(json.dumps({
+                'run': change.run_id,
+                'sequence': change.run.sequence,
+                'entity': change.entity,
+                'id': change.entity_id,
+                'operation': change.operation,
+                'fields': change.fields.split(',') if change.fields else [],
+            }))
+
+        self.stderr.write('last sequence: {}'.format(get_last_sequence()))
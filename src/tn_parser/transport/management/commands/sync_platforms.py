@@ -4,7 +4,11 @@ import logging
 
 from django.core.management.base import BaseCommand, CommandError
 
+from ...journal import Journal
 from ...models import RouteTypes
+from ...resolvers import STOP_TOLERANCE
+from ...snapshots import publish_run_snapshot
+from ...store import open_payload_store
 from ...sync import sync_platforms_from_2gis_api
 
 logger = logging.getLogger(__name__)
@@ -17,6 +21,18 @@ class Command(BaseCommand):
         parser.add_argument('api_key', nargs=1, type=str,
                             help='2GIS API key got from browser request,'
                                  ' expiring after a while')
+        parser.add_argument('--workers', type=int, default=1,
+                            help='Count of concurrent requests to 2GIS API')
+        parser.add_argument('--stop-tolerance', type=float,
+                            default=STOP_TOLERANCE,
+                            help='Max distance in meters between coordinates '
+                                 'of the same stop, 0 for exact match')
+        parser.add_argument('--force', action='store_true', default=False,
+                            help='Sync routes not changed since the last sync')
+        parser.add_argument('--replay', metavar='SNAPSHOT',
+                            help='Read payloads from stored snapshot '
+                                 'instead of fetching them, '
+                                 '"latest" for the most recent ones')
 
     def handle(self, *args, **options):
         if not options['api_key']:
@@ -26,16 +42,53 @@ class Command(BaseCommand):
                 'api_key arg is not defined')
 
         key = options['api_key'][0] if isinstance(options['api_key'], (list, tuple)) else options['api_key']
+        try:
+            store, replay = open_payload_store(options['replay'])
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        journal = Journal.start('sync_platforms')
+        try:
+            self.sync(key, journal, store, replay, options)
+        finally:
+            changes = journal.finish()
+
+        publish_run_snapshot(journal.run, changes)
+
+        self.stdout.write('\tsync run: #{}, changes: {}\n'.format(
+            journal.run.pk, changes))
+
+    def sync(self, key, journal, store, replay, options):
         # bus routes
-        stats = sync_platforms_from_2gis_api(key, RouteTypes.BUS)
+        stats = sync_platforms_from_2gis_api(
+            key, RouteTypes.BUS, workers=options['workers'],
+            stop_tolerance=options['stop_tolerance'],
+            force=options['force'], store=store, replay=replay,
+            journal=journal)
 
         self.stdout.write(
             'Sync bus routes platforms for bus ' +
             self.style.SUCCESS('DONE'))
+        self.write_skipped(stats)
 
         # bus routes
-        stats = sync_platforms_from_2gis_api(key, RouteTypes.TROLLEYBUS)
+        stats = sync_platforms_from_2gis_api(
+            key, RouteTypes.TROLLEYBUS, workers=options['workers'],
+            stop_tolerance=options['stop_tolerance'],
+            force=options['force'], store=store, replay=replay,
+            journal=journal)
 
         self.stdout.write(
             'Sync bus routes platforms for bus ' +
             self.style.SUCCESS('DONE'))
+        self.write_skipped(stats)
+
+    def write_skipped(self, stats):
+        self.stdout.write('\tskipped: {}\n'.format(
+            len([st for st in stats if st and st['skipped']])))
+
+        failed = [st['failed'] for st in stats if st and st.get('failed')]
+        if failed:
+            self.stdout.write('\tfailed: {}\n'.format(len(failed)))
+            for error in failed:
+                self.stderr.write(error)
@@ -5,8 +5,10 @@ import logging
 from django.core.management.base import BaseCommand, CommandError
 
 from tn_parser.transport.models import RouteTypes
-from tn_parser.transport.parsers import \
-    get_bus_routes_from_page, get_trolleybus_routes_from_page
+from tn_parser.transport.parsers import get_routes_by_type_from_page
+from ...journal import Journal
+from ...snapshots import publish_run_snapshot
+from ...store import open_payload_store
 from ...sync import get_routes_raw_data, process_parsed_routes
 
 logger = logging.getLogger(__name__)
@@ -15,45 +17,52 @@ logger = logging.getLogger(__name__)
 class Command(BaseCommand):
     help = 'Parse, collect new and update existing routes'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--replay', metavar='SNAPSHOT',
+                            help='Read payloads from stored snapshot '
+                                 'instead of fetching them, '
+                                 '"latest" for the most recent ones')
+
     def handle(self, *args, **options):
-        raw_data = get_routes_raw_data()
-
-        # bus routes
-        routes = get_bus_routes_from_page(raw_data)
-        stats = process_parsed_routes(routes, RouteTypes.BUS)
-
-        if 'verbosity' in options.keys() and options['verbosity'] > 1:
-            print('Bus routes:')
-            for rt in routes:
-                print(rt)
-
-        self.stdout.write(
-            'Sync bus routes ' +
-            self.style.SUCCESS('DONE'))
-        self.stdout.write(
-            '\tadded: {added_count}\n'
-            '\tupdated: {updated_count}\n'
-            '\texists: {exists_count}\n'
-            '\tcanceled: {canceled_count}\n'
-            '\tcanceled total: {canceled_total_count}\n'.format(**stats),
-        )
-
-        # trolleybus routes
-        routes = get_trolleybus_routes_from_page(raw_data)
-        stats = process_parsed_routes(routes, RouteTypes.TROLLEYBUS)
-
-        if 'verbosity' in options.keys() and options['verbosity'] > 1:
-            print('Trolleybus routes:')
-            for rt in routes:
-                print(rt)
-
-        self.stdout.write(
-            'Sync trolleybus routes ' +
-            self.style.SUCCESS('DONE'))
-        self.stdout.write(
-            '\tadded: {added_count}\n'
-            '\tupdated: {updated_count}\n'
-            '\texists: {exists_count}\n'
-            '\tcanceled: {canceled_count}\n'
-            '\tcanceled total: {canceled_total_count}\n'.format(**stats),
-        )
+        try:
+            store, replay = open_payload_store(options['replay'])
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        raw_data = get_routes_raw_data(store=store, replay=replay)
+
+        routes_by_type = get_routes_by_type_from_page(raw_data)
+
+        journal = Journal.start('sync_routes')
+        try:
+            stats_by_type = process_parsed_routes(routes_by_type, journal)
+        finally:
+            changes = journal.finish()
+
+        publish_run_snapshot(journal.run, changes)
+
+        for route_type, title in ((RouteTypes.BUS, 'bus'),
+                                  (RouteTypes.TROLLEYBUS, 'trolleybus')):
+            routes = routes_by_type[route_type]
+            stats = stats_by_type[route_type]
+
+            if 'verbosity' in options.keys() and options['verbosity'] > 1:
+                print('{} routes:'.format(title.capitalize()))
+                for rt in routes:
+                    print(rt)
+
+            self.stdout.write(
+                'Sync {} routes '.format(title) +
+                self.style.SUCCESS('DONE'))
+            self.stdout.write(
+                '\tadded: {added_count}\n'
+                '\tupdated: {updated_count}\n'
+                '\trenamed: {renamed_count}\n'
+                '\texists: {exists_count}\n'
+                '\tcanceled: {canceled_count}\n'
+                '\trevived: {revived_count}\n'
+                '\tcanceled total: {canceled_total_count}\n'.format(**stats),
+            )
+
+        self.stdout.write('\tsync run: #{}, changes: {}\n'.format(
+            journal.run.pk, changes))
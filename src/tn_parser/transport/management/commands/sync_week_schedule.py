@@ -1,198 +1,293 @@
 # coding=utf8
 
+import json
 import logging
-import re
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
 
-import requests
-from bs4 import BeautifulSoup
 from django.core.management.base import BaseCommand, CommandError
 
-from tn_parser.transport.sync import process_platform_input
-from ...helpers import parse_rus_date_to_naive_date
+from tn_parser.transport.bulk import bulk_create_with_pks
+from tn_parser.transport.fetch import AsyncFetcher, DEFAULT_POOL_SIZE, \
+    charsets, get_conditional_headers, get_digest, is_not_modified
+from tn_parser.transport.journal import Journal
+from tn_parser.transport.parsers import VARIANT_DAYS, \
+    parse_schedule_content
+from tn_parser.transport.snapshots import publish_run_snapshot
+from tn_parser.transport.store import open_payload_store
+from tn_parser.transport.matchers import AliasMatcher
+from tn_parser.transport.sync import store_fetch_state, \
+    get_schedule_route_points, process_route_schedule
 
-from tn_parser.transport.models import RouteTypes, Route, RoutePoint, Stop
-
-# from tn_parser.transport.parsers import \
-#     get_bus_routes_from_page, get_trolleybus_routes_from_page
-# from tn_parser.transport.sync import get_routes_raw_data, process_parsed_routes
+from tn_parser.transport.models import Route, \
+    DataProviderUrl, DataProviderTypes as p_types
 
 
 logger = logging.getLogger(__name__)
 
 _URL_MASK = 'http://transport.nov.ru/urban_trans/1/?mar={}'
 
+# weekday, weekend and saturday schedule pages
+_DAY_VARIANTS = tuple(VARIANT_DAYS)
+
+
+def get_schedule_page_jobs(routes, variants=_DAY_VARIANTS):
+    """
+    return fetch jobs for every schedule page of routes
+
+    :param routes: routes to fetch schedule for
+    :type routes: iterable
+    :param variants: suffixes of day variants
+    :type variants: iterable
+    :return: list of ((route, variant), url)
+    :rtype: list
+    """
+    return [((route, variant),
+             _URL_MASK.format('{}{}'.format(route.code, variant)))
+            for route in routes
+            for variant in variants]
+
+
+def get_schedule_page_providers(jobs):
+    """
+    return data providers of schedule pages by link,
+    missing providers are created
+
+    :param jobs: schedule page fetch jobs
+    :type jobs: list
+    :rtype: dict
+    """
+    providers = dict(
+        (provider.link, provider)
+        for provider in DataProviderUrl.objects.filter(
+            type=p_types.ROUTE_HTML_PAGE))
+
+    # schedule pages come from the same site as routes page
+    routes_page = DataProviderUrl.objects\
+        .filter(type=p_types.ROUTES_HTML_PAGE).first()
+    coding = routes_page.coding if routes_page is not None \
+        else DataProviderUrl._meta.get_field('coding').default
+
+    missing = [DataProviderUrl(link=url,
+                               type=p_types.ROUTE_HTML_PAGE,
+                               coding=coding,
+                               route=route,
+                               route_code=route.code)
+               for (route, _), url in jobs if url not in providers]
+    bulk_create_with_pks(DataProviderUrl, missing,
+                         key=lambda provider: (provider.type, provider.link))
+    providers.update((provider.link, provider) for provider in missing)
+
+    return providers
+
+
+def _submit(executor, fn, *args):
+    """
+    submit call to executor or make it right away if there is none
+    """
+    if executor is not None:
+        return executor.submit(fn, *args)
+
+    future = Future()
+    try:
+        future.set_result(fn(*args))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
 
 class Command(BaseCommand):
-    help = 'Parse, collect new and update existing routes'
+    help = 'Fetch schedule pages of routes concurrently (--workers), ' \
+           'parse them in processes (--jobs) and replace week schedules. ' \
+           'Pages not changed since the last sync are skipped ' \
+           'unless --force, --replay reads payloads from stored snapshot ' \
+           'and --review writes ambiguous stops to file'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=DEFAULT_POOL_SIZE,
+                            help='Count of concurrent requests '
+                                 'to transport.nov.ru')
+        parser.add_argument('--jobs', type=int, default=1,
+                            help='Count of processes parsing schedule pages')
+        parser.add_argument('--force', action='store_true', default=False,
+                            help='Sync pages not changed since the last sync')
+        parser.add_argument('--replay', metavar='SNAPSHOT',
+                            help='Read payloads from stored snapshot '
+                                 'instead of fetching them, '
+                                 '"latest" for the most recent ones')
+        parser.add_argument('--review', metavar='PATH',
+                            help='Write ambiguous schedule stops '
+                                 'to review to file as JSON lines')
 
     def handle(self, *args, **options):
-        # raw_data = get_routes_raw_data()
-        for route in Route.objects.filter(type=RouteTypes.BUS):
-            resp = requests.get(_URL_MASK.format('{}{}'.format(route.code, '_r')))
-
-            # raw_data = resp.content.decode(resp.apparent_encoding)
-            # to avoid htmlDom parse errors
-            raw_data = resp.content.decode(resp.apparent_encoding).encode('utf-8').decode()
-
-            soup = BeautifulSoup(raw_data, 'html.parser')
-
-            # First table contains switcher for weekday/weekend/certain day.
-            # It's would be using for determine schedule day
-            ttop = soup.find('table', class_='top')
-            tnav = ttop.find('table', align='center')
-            a_tags = tnav.find_all('a')
-
-            # days of week
-            days = []
-            for a in a_tags:
-                if '_r' in a['href']:
-                    days.append(1)
-
-                elif '_v' in a['href']:
-                    if 6 in days:
-                        days.append(7)
-                    else:
-                        days.append(6)
-
-                elif '_s' in a['href']:
-                    if 6 in days:
-                        days.insert(6)
-                    else:
-                        days.append(6)
-
-            print('days: {}'.format(days))
-
-            # Schedule days
-            tr_tags = ttop.find_all('tr', limit=5)
-            on_date = None
-            for tag in tr_tags:
-                td = tag.find('td', align='center')
-                if td and 'по состоянию' in td.text:
-                    on_date = td.find('font')
-
-            # calc on_date date
-            last_update = None
-            if on_date:
-                last_update = parse_rus_date_to_naive_date(on_date.text)
-
-                print('last update: {}'.format(last_update))
-
-            # Schedule itself
-            # Here determines each row of schedule
-            tt = soup.find('table', class_='t')
-
-            # The first row, it is the columns' headers,
-            # which will use to determine bus stop order for correct mapping
-            td_tags = tt.tr.find_all('td', recursive=False)
-            raw_stops = list([td.text.strip() for td in td_tags])
-
-            self.sync_stops_list(raw_stops, route)
-
-            print('\n')
-            # # for each row determine row cell's values
-            # for row in tt.find_all('tr', recursive=False)[1:]:
-            #     td_tags = row.find_all('td', recursive=False)
-            #     # schedule_time = r4.findall(row)
-            #     # print('\t'.join([td.text for td in td_tags]))
-            #
-            #     row_items = []
-            #     # import ipdb; ipdb.set_trace()
-            #     for td in td_tags:
-            #         tdt = td.text.replace('ул.', '').replace('ул', '').strip()
-            #         parts = tdt.split(' ')
-            #         if len(parts) > 1:
-            #             time = parts[-1].strip()
-            #             desc = parts[0].strip().strip('-')
-            #             row_items.append((time, desc))
-            #             continue
-            #
-            #         parts = tdt.split('-')
-            #         if len(parts) > 1 and all([p.strip() for p in parts]):
-            #             time = parts[-1].strip()
-            #             desc = parts[0].strip()
-            #             row_items.append((time, desc))
-            #             continue
-            #
-            #         time = tdt
-            #         desc = ''
-            #         row_items.append((time, desc))
-            #
-            #     print('\t'.join([str(td) for td, _ in row_items]))
-            #     print('\t'.join([str(de) for _, de in row_items]))
-            #
-            #     #print(td.text)
-            #     # print('\n')
-
-            print(route)
-
-            break
-
-    def sync_stops_list(self, stops_list, route):
-        rpqs = RoutePoint.objects.filter(route=route, lap=0)
-        rplst = list(RoutePoint.objects.filter(route=route, lap=0).order_by('route', 'lap', 'order'))
-        stop_ids = set([tpl[0] for tpl in RoutePoint.objects.filter(route=route, lap=0).values_list('stop_id')])
-        print(stop_ids)
-        stop_qs = Stop.objects.filter(id__in=stop_ids)
-
-        for stop in stops_list:
-            parsed = process_platform_input(stop)
-
-            res = list(stop_qs.filter(alias__name__in=parsed['raw_aliases']))
-            if res:
-                if len(res) > 1:
-                    self.stdout.write(parsed['raw'])
-                    self.stdout.write(self.style.SUCCESS('has few stop for alias\n'))
-                    self.stdout.write('{}\n'.format(res))
-                else:
-                    rps = rpqs.filter(stop=res[0])
-                    for rp in rps:
-                        rplst.remove(rp)
-
-                    self.stdout.write(parsed['raw'])
-                    self.stdout.write(self.style.SUCCESS('exists'))
-
-            else:
-                alias_for = self.suggest_alias(parsed, rplst)
-
-                if alias_for == 0:
-                    break
-
-                if isinstance(alias_for, list):
-                    for to in alias_for:
-                        rplst.remove(to)
-                        print(to)
-
-    def suggest_alias(self, stopd, rplst):
-        print('-'*10)
-        print(stopd)
-
-        print('May by one of:')
-        for i in range(len(rplst)):
-            rp = rplst[i]
-            self.stdout.write(
-                self.style.SUCCESS('  {}'.format(str(rp.stop.id).rjust(3))) +
-                ': {}\t\t{}'.format(rp.direction, rp.stop)
-            )
-
-        print('? (input number or 0 for exit)')
-
-        num = input('> ')
-
-        if num in {'0', 0, 'q', 'Q'}:
-            return 0
-
+        try:
+            store, replay = open_payload_store(options['replay'])
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        if options['jobs'] < 1:
+            raise CommandError('--jobs should be positive')
+
+        force = options['force']
+        if replay is not None:
+            fetcher = replay
+            force = True
         else:
-            try:
-                res = []
-                for rp in rplst:
-                    if rp.stop.id == int(num):
-                        res.append(rp)
-
-                if res:
-                    return res
+            fetcher = AsyncFetcher(concurrency=options['workers'])
+
+        routes = list(Route.objects.filter(canceled=None))
+        jobs = get_schedule_page_jobs(routes)
+        providers = get_schedule_page_providers(jobs)
+        charsets.seed(providers.values())
+
+        self.route_points = get_schedule_route_points(routes)
+        self.matchers = {}
+        self.dimensions = {}
+        self.review = []
+        self.stats = dict(pages=0, trips=0, created=0, deleted=0, unknown=0,
+                          review=0, aliases=0)
+        self.failed = []
+
+        executor = None
+        if options['jobs'] > 1:
+            executor = ProcessPoolExecutor(options['jobs'])
+        # parsed pages are merged in the order they were fetched,
+        # while the next ones are still being parsed
+        pending = deque()
+        max_pending = 2 * options['jobs']
+
+        self.journal = Journal.start('sync_week_schedule')
+
+        skipped = 0
+        try:
+            for result in fetcher.iter_results(
+                    [(key, url, {} if force else
+                      get_conditional_headers(providers[url]))
+                     for key, url in jobs]):
+                route, variant = result.key
+                if not result.ok:
+                    error = repr(result.error) if result.error is not None \
+                        else 'HTTP {}'.format(result.response.status_code)
+                    logger.warning('Skip schedule page: {} {}'.format(
+                        result.url, error))
+                    self.failed.append((result.url, error))
+                    continue
+
+                provider = providers[result.url]
+                if store is not None:
+                    store.save(result.url, result.response,
+                               provider=provider.type,
+                               route='{}{}'.format(route.code, variant))
+
+                if is_not_modified(result.response):
+                    digest = provider.digest
                 else:
-                    return 0
-
-            except (IndexError, ValueError):
-                return 0
-
+                    digest = get_digest(result.response.content)
+
+                if not force and digest == provider.digest:
+                    logger.info('Skip not changed schedule page: {}'.format(
+                        result.url))
+                    skipped += 1
+                    continue
+
+                pending.append((
+                    route, variant, provider, result.response, digest,
+                    _submit(executor, parse_schedule_content,
+                            result.response.content,
+                            charsets.get_encoding(result.response,
+                                                  provider.type,
+                                                  result.url))))
+                while len(pending) > max_pending:
+                    self.merge_schedule_page(*pending.popleft())
+
+            while pending:
+                self.merge_schedule_page(*pending.popleft())
+        finally:
+            if executor is not None:
+                executor.shutdown()
+            changes = self.journal.finish()
+
+        publish_run_snapshot(self.journal.run, changes)
+
+        self.stdout.write(
+            'Sync week schedule ' +
+            self.style.SUCCESS('DONE'))
+        self.stdout.write(
+            '\tpages: {pages}\n'
+            '\ttrips: {trips}\n'
+            '\tschedule points: {created}\n'
+            '\treplaced points: {deleted}\n'
+            '\tnot recognized stops: {unknown}\n'
+            '\tstops to review: {review}\n'
+            '\tnew aliases: {aliases}\n'.format(**self.stats))
+        self.stdout.write('\tskipped: {}\n'.format(skipped))
+        self.stdout.write('\tsync run: #{}, changes: {}\n'.format(
+            self.journal.run.pk, changes))
+
+        if options['review']:
+            self.write_review(options['review'])
+
+        if self.failed:
+            self.stdout.write('\tfailed: {}\n'.format(len(self.failed)))
+            for url, error in self.failed:
+                self.stderr.write('{}\t{}'.format(url, error))
+
+    def merge_schedule_page(self, route, variant, provider, resp, digest,
+                            future):
+        try:
+            page = future.result()
+        except Exception as e:
+            logger.exception('Failed to parse schedule page: {} {}'.format(
+                route, variant))
+            self.failed.append((provider.link, repr(e)))
+            return
+
+        coding = None
+        if page is not None:
+            coding = page['encoding']
+            charsets.learn(provider.type, provider.link, coding)
+
+        self.process_schedule_page(route, variant, page)
+        store_fetch_state(provider, resp, digest, coding)
+
+    def process_schedule_page(self, route, variant, page):
+        if page is None:
+            logger.warning('No schedule found: {} {}'.format(
+                route, variant))
+            return
+
+        matcher = self.matchers.get(route.pk)
+        if matcher is None:
+            matcher = self.matchers[route.pk] = AliasMatcher(
+                route, self.route_points.get(route.pk, []))
+
+        day = page['variant_days'].get(variant, VARIANT_DAYS[variant])
+        stats = process_route_schedule(
+            route, day, page, matcher,
+            dimensions=self.dimensions, review=self.review,
+            journal=self.journal, matchers=self.matchers.values())
+
+        self.stats['pages'] += 1
+        for key, value in stats.items():
+            self.stats[key] += value
+
+    def write_review(self, path):
+        # the same headers come on every day variant of route
+        written = set()
+        with open(path, 'w') as f:
+            for item in self.review:
+                if (item.route.pk, item.header) in written:
+                    continue
+                written.add((item.route.pk, item.header))
+                f.write(json.dumps({
+                    'route': item.route.code,
+                    'column': item.column,
+                    'header': item.header,
+                    'candidates': [
+                        {'stop': rp.stop_id,
+                         'platform': rp.stop.platform.name,
+                         'direction': rp.direction,
+                         'order': rp.order,
+                         'score': round(score, 3)}
+                        for rp, score in item.candidates],
+                }, ensure_ascii=False) + '\n')
@@ -0,0 +1,253 @@
+# coding=utf-8
+
+import logging
+from collections import OrderedDict, defaultdict, namedtuple
+
+from .bulk import bulk_create_inherited
+from .models import PlatformAlias
+from .resolvers import normalize_name
+
+logger = logging.getLogger(__name__)
+
+NGRAM_SIZE = 3
+
+# matches scored not less are accepted, ones between review
+# and accept scores or too close to the next best are queued for review
+ACCEPT_SCORE = 0.75
+REVIEW_SCORE = 0.4
+AMBIGUITY_MARGIN = 0.05
+
+# share of route order in the score, the rest is name similarity
+ORDER_WEIGHT = 0.2
+
+# candidates kept in review queue entry
+REVIEW_CANDIDATES = 3
+
+
+def get_ngrams(name, size=NGRAM_SIZE):
+    """
+    return character n-grams of normalized name padded with spaces
+
+    :rtype: frozenset
+    """
+    padded = ' {} '.format(name)
+    return frozenset(padded[i:i + size]
+                     for i in range(max(1, len(padded) - size + 1)))
+
+
+def similarity(ngrams, other_ngrams):
+    """
+    return Dice coefficient of two n-gram sets
+
+    :rtype: float
+    """
+    if not ngrams or not other_ngrams:
+        return 0.0
+    return 2.0 * len(ngrams & other_ngrams) \
+        / (len(ngrams) + len(other_ngrams))
+
+
+Match = namedtuple('Match', ('column', 'header', 'route_point',
+                             'score', 'name', 'exact'))
+
+Review = namedtuple('Review', ('route', 'column', 'header', 'candidates'))
+
+
+class AliasMatcher(object):
+    """
+    Matches schedule headers of route with its route points without
+    asking anybody. Names of route points' platforms, stops and aliases
+    are indexed by character n-grams once, every header is scored against
+    the route points sharing n-grams with it by name similarity and by
+    route order.
+    """
+
+    def __init__(self, route, route_points):
+        """
+        :param route: route of route points
+        :type route: .models.Route
+        :param route_points: lap 0 route points with names,
+        see sync.get_schedule_route_points
+        :type route_points: list
+        """
+        self.route = route
+        self.route_points = route_points
+
+        self._names = []
+        self._index = defaultdict(set)
+        for rp in route_points:
+            for name in rp.names:
+                self._add_name(rp, name)
+
+    def _add_name(self, rp, name):
+        ngrams = get_ngrams(name)
+        position = len(self._names)
+        self._names.append((rp, ngrams))
+        for ngram in ngrams:
+            self._index[ngram].add(position)
+
+    def add_name(self, rp, name):
+        """
+        remember one more name of route point
+        """
+        name = normalize_name(name)
+        if name not in rp.names:
+            rp.names.add(name)
+            self._add_name(rp, name)
+
+    def get_candidates(self, names):
+        """
+        return route points similar by name with any of names
+
+        :param names: header names
+        :type names: iterable
+        :return: dict of route point -> (similarity, header name)
+        :rtype: dict
+        """
+        candidates = {}
+        for name in names:
+            key = normalize_name(name)
+            if not key:
+                continue
+
+            ngrams = get_ngrams(key)
+            positions = set()
+            for ngram in ngrams:
+                positions.update(self._index.get(ngram, ()))
+
+            for position in positions:
+                rp, rp_ngrams = self._names[position]
+                score = 1.0 if key in rp.names \
+                    else similarity(ngrams, rp_ngrams)
+                if score > candidates.get(rp, (0.0, None))[0]:
+                    candidates[rp] = (score, name)
+
+        return candidates
+
+    def match(self, parsed_headers):
+        """
+        return route point of each header: headers are matched with
+        route points of the direction most of them are similar to,
+        the next route point of direction scores more
+
+        :param parsed_headers: headers of timetable,
+        see sync.process_platform_inputs
+        :type parsed_headers: list
+        :return: (matches, review), matches are Match | None per header,
+        review is list of Review for ambiguous headers
+        :rtype: tuple
+        """
+        candidates = []
+        directions = defaultdict(float)
+        for parsed in parsed_headers:
+            found = self.get_candidates(
+                {parsed['raw']} | parsed['raw_aliases'] | parsed['aliases'])
+            best = {}
+            for rp, (score, _) in found.items():
+                best[rp.direction] = max(best.get(rp.direction, 0), score)
+            for direction, score in best.items():
+                if score >= REVIEW_SCORE:
+                    directions[direction] += score
+            candidates.append(found)
+
+        if not directions:
+            return [None] * len(parsed_headers), []
+        direction = max(directions, key=directions.get)
+
+        matches = []
+        review = []
+        used = set()
+        last_order = -1
+        for column, (parsed, found) in enumerate(zip(parsed_headers,
+                                                     candidates)):
+            raw = normalize_name(parsed['raw'])
+            scored = []
+            for rp, (name_score, name) in found.items():
+                if rp.direction != direction or rp.pk in used:
+                    continue
+                order_score = 0.0
+                if rp.order > last_order:
+                    order_score = 1.0 / (rp.order - last_order)
+                scored.append((
+                    (1 - ORDER_WEIGHT) * name_score
+                    + ORDER_WEIGHT * order_score,
+                    name_score, name, rp))
+            scored.sort(key=lambda item: (-item[0], item[3].order))
+
+            # the whole header is a known name, route points similar
+            # by parts of it are not candidates then
+            exact = [item for item in scored if raw in item[3].names]
+            if exact:
+                scored = exact
+
+            match = None
+            if scored and (exact or scored[0][0] >= REVIEW_SCORE):
+                score, name_score, name, rp = scored[0]
+                ambiguous = len(scored) > 1 \
+                    and score - scored[1][0] < AMBIGUITY_MARGIN
+                if (exact or score >= ACCEPT_SCORE) and not ambiguous:
+                    match = Match(column, parsed['raw'], rp, score,
+                                  name, name_score == 1.0)
+                    used.add(rp.pk)
+                    last_order = rp.order
+                else:
+                    review.append(Review(
+                        self.route, column, parsed['raw'],
+                        [(rp, score)
+                         for score, _, _, rp
+                         in scored[:REVIEW_CANDIDATES]]))
+            matches.append(match)
+
+        return matches, review
+
+
+def save_aliases(matches, matchers=()):
+    """
+    bulk create platform aliases of not exact matches, names already
+    known for platform or saved to DB before are skipped. Aliases are
+    added to matchers too, so the next pages are matched exactly
+
+    :param matches: accepted matches
+    :type matches: iterable
+    :param matchers: matchers of sync run to add aliases to,
+    the same platform could be on many routes
+    :type matchers: iterable
+    :return: created aliases
+    :rtype: list
+    """
+    candidates = OrderedDict()
+    for match in matches:
+        if match is None or match.exact:
+            continue
+
+        rp = match.route_point
+        key = (rp.stop.platform_id, normalize_name(match.name))
+        if key[1] not in rp.names and key not in candidates:
+            candidates[key] = (match.name.strip(), rp)
+
+    if not candidates:
+        return []
+
+    # aliases saved by other routes of sync run or other runs
+    saved = set(
+        (platform_id, normalize_name(name))
+        for platform_id, name in PlatformAlias.objects
+        .filter(platform_id__in=set(key[0] for key in candidates))
+        .values_list('platform_id', 'name'))
+
+    route_points = defaultdict(list)
+    for matcher in matchers:
+        for rp in matcher.route_points:
+            route_points[rp.stop.platform_id].append((matcher, rp))
+    for platform_id, key in candidates:
+        for matcher, rp in route_points[platform_id]:
+            matcher.add_name(rp, key)
+    for (_, key), (_, rp) in candidates.items():
+        rp.names.add(key)
+
+    aliases = [PlatformAlias(platform_id=platform_id, name=name)
+               for (platform_id, key), (name, _) in candidates.items()
+               if (platform_id, key) not in saved]
+    bulk_create_inherited(PlatformAlias, aliases, key_fields=('name',))
+    logger.debug('Platform aliases created: %s' % len(aliases))
+    return aliases
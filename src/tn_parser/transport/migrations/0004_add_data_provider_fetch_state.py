@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 08:53
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('transport', '0003_add_route_2gis_platforms_data'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dataproviderurl',
+            name='digest',
+            field=models.CharField(blank=True, default='', help_text='Digest of the last synced payload', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='dataproviderurl',
+            name='etag',
+            field=models.CharField(blank=True, default='', max_length=255),
+        ),
+        migrations.AddField(
+            model_name='dataproviderurl',
+            name='fetched',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='dataproviderurl',
+            name='last_modified',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 09:16
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('transport', '0004_add_data_provider_fetch_state'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='routepoint',
+            name='stop',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='route_points', to='transport.Stop'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 09:40
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def number_finished_runs(apps, schema_editor):
+    SyncRun = apps.get_model('transport', 'SyncRun')
+    runs = SyncRun.objects.exclude(finished=None).order_by('finished', 'pk')
+    for sequence, run in enumerate(runs, 1):
+        run.sequence = sequence
+        run.save(update_fields=['sequence'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('transport', '0006_add_sync_journal'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='syncrun',
+            name='sequence',
+            field=models.PositiveIntegerField(blank=True, help_text='Number of run in the order runs were finished', null=True, unique=True),
+        ),
+        migrations.RunPython(number_finished_runs, migrations.RunPython.noop),
+    ]
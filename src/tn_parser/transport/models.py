@@ -98,8 +98,7 @@ class DataProviderTypes(EnumBase):
 
 
 class Point(object):
-    lon = 0.0
-    lat = 0.0
+    __slots__ = ('lon', 'lat')
 
     @property
     def length(self):
@@ -115,13 +114,13 @@ class Point(object):
 
     def __init__(self, lon=0.0, lat=0.0, repr=None):
         if repr is not None:
-            lst = repr.replace('POINT', '').\
-                replace('(', '')\
-                .replace(')', '')\
-                .split(' ')
-
-            self.lon = float(lst[0])
-            self.lat = float(lst[1])
+            start = repr.find('(')
+            end = repr.rfind(')')
+            lst = repr[start + 1:end].split() if 0 <= start < end else []
+            try:
+                self.lon, self.lat = (float(value) for value in lst)
+            except ValueError:
+                raise ValueError('Wrong WKT point: {}'.format(repr))
         else:
             self.lon = lon
             self.lat = lat
@@ -152,16 +151,11 @@ class Point(object):
             self.lon-lon,
             self.lat-lat)
 
-    def __sub__(self, other):
-        return Point(
-            self.lon - other.lon,
-            self.lat - other.lat)
-
     def __repr__(self):
-        return 'POINT({lon:.13f} {lat:.13f})'.format(**self.__dict__)
+        return 'POINT({lon:.13f} {lat:.13f})'.format(lon=self.lon, lat=self.lat)
 
     def __str__(self):
-        return 'Point(lon: {lon:.6f}, lat: {lat:.6f})'.format(**self.__dict__)
+        return 'Point(lon: {lon:.6f}, lat: {lat:.6f})'.format(lon=self.lon, lat=self.lat)
 
     def __unicode__(self):
         return unicode(str(self))
@@ -192,11 +186,6 @@ class Platform(models.Model):
     geo_direction = models.CharField(max_length=16, blank=True,
                                      choices=GeoDirections.as_tuple)
 
-    def get_queryset(self, request):
-        qs = super(Platform, self).get_queryset(request)
-        qs = qs.annotate(models.Count('stops'))
-        return qs
-
     def __eq__(self, other):
         if self.pk:
             return super(Platform, self).__eq__(other)
@@ -269,6 +258,12 @@ class DataProviderUrl(models.Model):
 
     route_code = models.CharField(max_length=32, blank=True, default='')
 
+    digest = models.CharField(max_length=64, blank=True, default='',
+                              help_text='Digest of the last synced payload')
+    etag = models.CharField(max_length=255, blank=True, default='')
+    last_modified = models.CharField(max_length=64, blank=True, default='')
+    fetched = models.DateTimeField(blank=True, null=True)
+
     class META:
         unique_together = ("name", "type")
 
@@ -336,3 +331,46 @@ class RouteSchedule(RoutePoint):
                                        related_name='route_schedules',
                                        on_delete=models.CASCADE)
 
+
+class ChangeOperations(EnumBase):
+    CREATE = 'create'
+    UPDATE = 'update'
+    DELETE = 'delete'
+    # all rows of entity in scope (e.g. schedule of route for a day)
+    # are replaced
+    REPLACE = 'replace'
+
+    as_tuple = (
+        (CREATE, "Создание"),
+        (UPDATE, "Изменение"),
+        (DELETE, "Удаление"),
+        (REPLACE, "Замена"),
+    )
+
+
+class SyncRun(models.Model):
+    command = models.CharField(max_length=64)
+    started = models.DateTimeField(auto_now_add=True)
+    finished = models.DateTimeField(blank=True, null=True)
+    sequence = models.PositiveIntegerField(
+        blank=True, null=True, unique=True,
+        help_text='Number of run in the order runs were finished')
+
+    def __str__(self):
+        return '#%s %s' % (self.pk, self.command)
+
+
+class ChangeRecord(models.Model):
+    run = models.ForeignKey(SyncRun, related_name='changes',
+                            on_delete=models.CASCADE)
+    entity = models.CharField(max_length=32, db_index=True)
+    entity_id = models.IntegerField()
+    operation = models.CharField(max_length=16,
+                                 choices=ChangeOperations.as_tuple)
+    fields = models.CharField(
+        max_length=255, blank=True, default='',
+        help_text='Comma separated changed fields, '
+                  'or field=value scope of replace')
+
+    def __str__(self):
+        return '%s %s #%s' % (self.operation, self.entity, self.entity_id)
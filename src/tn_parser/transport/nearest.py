@@ -0,0 +1,129 @@
+# coding=utf-8
+
+import logging
+from collections import defaultdict, namedtuple
+
+from .geometry import KDTree, chord_to_meters, meters_to_chord, \
+    to_unit_vectors
+from .snapshots import loader
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_NEAREST = 5
+MAX_NEAREST = 50
+
+# meters
+MAX_RADIUS = 5000
+
+NearestStop = namedtuple('NearestStop', ('stop', 'distance', 'lon', 'lat',
+                                         'platform', 'name', 'routes'))
+
+
+class NearestStopIndex(object):
+    """
+    k-d tree over stops of API snapshot. Stops are put on unit sphere,
+    so straight line distance there orders stops as great circle
+    distance does and is converted to meters exactly.
+    """
+
+    def __init__(self, stops=(), platform_names=None, stop_routes=None):
+        """
+        :param stops: stops data, dicts with id, platform, lon and lat
+        :type stops: iterable
+        :param platform_names: names of platforms by id
+        :type platform_names: dict
+        :param stop_routes: routes serving stop, lists of
+        (route id, route code) by stop id
+        :type stop_routes: dict
+        """
+        self.stops = [stop for stop in stops
+                      if stop['lon'] is not None and stop['lat'] is not None]
+        self._stops_by_id = dict((stop['id'], stop) for stop in self.stops)
+        self.platform_names = platform_names or {}
+        self.stop_routes = stop_routes or {}
+        self.tree = KDTree(
+            to_unit_vectors([stop['lon'] for stop in self.stops],
+                            [stop['lat'] for stop in self.stops]))
+
+    @classmethod
+    def load(cls, snapshot):
+        """
+        return index of stops of snapshot with platform names
+        and not canceled routes serving them
+
+        :type snapshot: .snapshots.Snapshot
+        :rtype: NearestStopIndex
+        """
+        platform_names = dict((platform['id'], platform['name'])
+                              for platform in snapshot.get_data('platforms',
+                                                                ()))
+        stop_routes = defaultdict(list)
+        for route in snapshot.get_data('routes', ()):
+            if route['canceled'] is not None:
+                continue
+            document = snapshot.get_data('routes/{}'.format(route['id']), {})
+            for stop_id in sorted(set(point['stop'] for point
+                                      in document.get('stops', ()))):
+                stop_routes[stop_id].append((route['id'], route['code']))
+
+        index = cls(snapshot.get_data('stops', ()), platform_names,
+                    stop_routes)
+        logger.debug('Nearest stop index loaded: stops: %s'
+                     % len(index.stops))
+        return index
+
+    def get(self, stop_id):
+        """
+        return data of located stop by id or None
+
+        :rtype: dict|None
+        """
+        return self._stops_by_id.get(stop_id)
+
+    def _get_results(self, found):
+        result = []
+        for chord, position in found:
+            stop = self.stops[position]
+            result.append(NearestStop(
+                stop['id'], float(chord_to_meters(chord)),
+                stop['lon'], stop['lat'], stop['platform'],
+                self.platform_names.get(stop['platform']),
+                self.stop_routes.get(stop['id'], [])))
+        return result
+
+    def nearest(self, lon, lat, k=DEFAULT_NEAREST):
+        """
+        return k stops nearest to point
+
+        :rtype: list of NearestStop sorted by distance
+        """
+        return self._get_results(
+            self.tree.query(to_unit_vectors(lon, lat)[0], k))
+
+    def within(self, lon, lat, radius):
+        """
+        return stops not farther than radius from point
+
+        :param radius: distance in meters
+        :type radius: float
+        :rtype: list of NearestStop sorted by distance
+        """
+        return self._get_results(self.tree.query_radius(
+            to_unit_vectors(lon, lat)[0], meters_to_chord(radius)))
+
+
+def get_nearest_stop_index():
+    """
+    return nearest stop index of the current API snapshot
+
+    :rtype: NearestStopIndex
+    """
+    return loader.get().get_index(NearestStopIndex)
+
+
+def nearest_stops(lon, lat, k=DEFAULT_NEAREST):
+    return get_nearest_stop_index().nearest(lon, lat, k)
+
+
+def stops_within(lon, lat, radius):
+    return get_nearest_stop_index().within(lon, lat, radius)
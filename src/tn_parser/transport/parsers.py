@@ -1,44 +1,331 @@
 # coding=utf-8
 
+import datetime
+import html
 import re
+from collections import OrderedDict, defaultdict
 
-OPTIONS_RAW = "<select\s.*?name='{0}'.*?>\s*?(?P<options>.*?)</select"
-OPTIONS_RE = re.compile(
-    "<option\s*?value=\'(?P<code>.*?)_?[rv]?\'.*?>(?P<name>.*?)</option",
-    re.I | re.S)
+from bs4 import BeautifulSoup
 
+from .fetch import decode_content
+from .helpers import parse_rus_date_to_naive_date
+from .models import RouteTypes
 
-def get_options_part(raw_data, data_name):
+# names of routes page selects by route type
+ROUTE_TYPE_SELECTS = (
+    (RouteTypes.BUS, 'avt'),
+    (RouteTypes.TROLLEYBUS, 'trol'),
+)
 
-    if not raw_data.strip():
-        raise RuntimeError('Empty input data')
+# tokens of select blocks: opening and closing select tags and options,
+# option text runs till the next option or select tag
+_TOKEN_RE = re.compile(
+    r'<select\b(?P<select>[^>]*)>'
+    r'|</select\s*>'
+    r'|<option\b(?P<option>[^>]*)>'
+    r'(?P<text>[^<]*(?:<(?!/?option\b|/?select\b)[^<]*)*)',
+    re.I)
+_ATTR_VALUE = r'''\s*=\s*(?:'([^']*)'|"([^"]*)"|([^\s'">]+))'''
+_NAME_ATTR_RE = re.compile(r'\bname' + _ATTR_VALUE, re.I)
+_VALUE_ATTR_RE = re.compile(r'\bvalue' + _ATTR_VALUE, re.I)
+_OPTION_END_RE = re.compile(r'</option\s*>\s*$', re.I)
+# the same code cut as the option value regex always did: '1a_r' -> '1a'
+_OPTION_CODE_RE = re.compile(r'(?P<code>.*?)_?[rv]?$', re.S)
 
-    options = re.findall(
-        OPTIONS_RAW.format(data_name),
-        raw_data,
-        re.I | re.S)
 
-    if len(options) != 1:
-        raise RuntimeError('Wrong input data')
+def _get_attr(attr_re, raw_attrs):
+    match = attr_re.search(raw_attrs)
+    if match is None:
+        return ''
+    return ''.join(value for value in match.groups() if value)
 
-    return options[0]
 
+class OptionsScanner(object):
+    """
+    Single pass scanner of named <select> blocks and their options.
+    The page could be fed by chunks as they arrive, only the tail
+    which could be continued by the next chunk is kept between them.
+    """
 
-def get_bus_routes_from_page(page_html):
-    raw = get_options_part(page_html, 'avt')
+    def __init__(self):
+        self.selects = OrderedDict()
+        self.counts = defaultdict(int)
+
+        self._buffer = ''
+        self._select = None
+
+    def feed(self, chunk):
+        self._buffer += chunk
+        self._scan(final=False)
+
+    def close(self):
+        """
+        return options of all named selects
+
+        :return: dict of select name -> list of {'code', 'name'}
+        :rtype: OrderedDict
+        """
+        self._scan(final=True)
+        return self.selects
+
+    def _scan(self, final):
+        buffer = self._buffer
+        keep = None
+        pos = 0
+
+        for match in _TOKEN_RE.finditer(buffer):
+            raw_attrs = match.group('option')
+            if raw_attrs is not None:
+                if match.end() == len(buffer) and not final:
+                    # option text could be continued by the next chunk
+                    keep = match.start()
+                    break
+
+                if self._select is not None:
+                    code = _OPTION_CODE_RE.match(
+                        _get_attr(_VALUE_ATTR_RE, raw_attrs)).group('code')
+                    text = _OPTION_END_RE.sub('', match.group('text'))
+                    self._select.append({'code': code.strip(),
+                                         'name': text.strip()})
+
+            elif match.group('select') is not None:
+                name = _get_attr(_NAME_ATTR_RE, match.group('select'))
+                self.counts[name] += 1
+                self._select = self.selects.setdefault(name, [])
+
+            else:
+                self._select = None
+
+            pos = match.end()
+
+        if keep is None:
+            # nothing to keep but an incomplete tag
+            keep = max(pos, buffer.rfind('<'))
+        self._buffer = '' if final else buffer[keep:]
 
-    options = OPTIONS_RE.findall(raw)
 
-    return [{'code': opt[0].strip(),
-             'name': opt[1].strip()} for opt in options]
+def get_routes_options(chunks):
+    """
+    return options of every named select of routes page,
+    scanned in one pass
+
+    :param chunks: routes page or iterable of its parts
+    :type chunks: str|iterable
+    :return: (options by select name, count of each select on page)
+    :rtype: tuple
+    """
+    if isinstance(chunks, str):
+        chunks = [chunks]
+
+    scanner = OptionsScanner()
+    for chunk in chunks:
+        scanner.feed(chunk)
+    return scanner.close(), scanner.counts
+
+
+def get_routes_by_type_from_page(page_html):
+    """
+    return routes of every route type found on routes page
+
+    :param page_html: routes page or iterable of its parts
+    :type page_html: str|iterable
+    :return: dict of route type -> list of {'code', 'name'}
+    :rtype: dict
+    """
+    if isinstance(page_html, str) and not page_html.strip():
+        raise RuntimeError('Empty input data')
+
+    selects, counts = get_routes_options(page_html)
+
+    result = OrderedDict()
+    for route_type, name in ROUTE_TYPE_SELECTS:
+        if counts[name] != 1:
+            raise RuntimeError('Wrong input data')
+        result[route_type] = selects[name]
+    return result
+
+
+def get_bus_routes_from_page(page_html):
+    return get_routes_by_type_from_page(page_html)[RouteTypes.BUS]
 
 
 def get_trolleybus_routes_from_page(page_html):
-    raw = get_options_part(page_html, 'trol')
+    return get_routes_by_type_from_page(page_html)[RouteTypes.TROLLEYBUS]
+
+
+# schedule day of each schedule page variant:
+# weekday, weekend (or sunday if saturday has own page) and saturday
+VARIANT_DAYS = OrderedDict((('_r', 1), ('_v', 6), ('_s', 6)))
+
+_TABLE_TAG_RE = re.compile(r'<(/?)table\b([^>]*)>', re.I)
+_CLASS_ATTR_RE = re.compile(r'\bclass' + _ATTR_VALUE, re.I)
+_ROW_SPLIT_RE = re.compile(r'<tr\b[^>]*>', re.I)
+_CELL_SPLIT_RE = re.compile(r'<td\b[^>]*>', re.I)
+_MARKUP_RE = re.compile(r'<[^>]*>')
+_CELL_TIME_RE = re.compile(r'(?P<hour>\d{1,2})[:.](?P<minute>\d{2})\s*$')
+
+
+def _find_table(page_html, class_name):
+    """
+    return outer html of the first table of class, nested tables included
+    """
+    start = None
+    depth = 0
+    for match in _TABLE_TAG_RE.finditer(page_html):
+        if match.group(1):
+            depth -= 1
+            if start is not None and depth == 0:
+                return page_html[start:match.end()]
+            continue
+
+        if start is None:
+            classes = _get_attr(_CLASS_ATTR_RE, match.group(2)).split()
+            if class_name not in classes:
+                continue
+            start = match.start()
+            depth = 0
+        depth += 1
+
+    if start is not None:
+        return page_html[start:]
+    return None
+
+
+def _get_cell_text(raw_cell):
+    return html.unescape(_MARKUP_RE.sub('', raw_cell)).strip()
+
+
+def parse_schedule_cell(text):
+    """
+    return departure time and note of timetable cell,
+    time is None if bus skips the stop
+
+    :param text: cell text like '5:47', 'к 5:47' or '-'
+    :type text: str
+    :return: (time, note) | None for empty cell
+    :rtype: tuple|None
+    """
+    match = _CELL_TIME_RE.search(text)
+    if match is None:
+        if text and not text.strip('-–— '):
+            return None, ''
+        return None
+
+    note = text[:match.start()].strip().strip('-').strip()
+    return datetime.time(int(match.group('hour')) % 24,
+                         int(match.group('minute'))), note
+
+
+def parse_schedule_table(table_html):
+    """
+    return stops headers and trips of timetable,
+    scanned without building a DOM
+
+    :param table_html: html of table.t
+    :type table_html: str
+    :return: (headers, trips), each trip is a list
+    of (stop column, departure time, note)
+    :rtype: tuple
+    """
+    rows = _ROW_SPLIT_RE.split(table_html)[1:]
+    if not rows:
+        return [], []
+
+    headers = [_get_cell_text(cell)
+               for cell in _CELL_SPLIT_RE.split(rows[0])[1:]]
+
+    trips = []
+    for row in rows[1:]:
+        trip = []
+        for column, cell in enumerate(_CELL_SPLIT_RE.split(row)[1:]):
+            parsed = parse_schedule_cell(_get_cell_text(cell))
+            if parsed is not None:
+                trip.append((column, parsed[0], parsed[1]))
+        if trip:
+            trips.append(trip)
+
+    return headers, trips
+
+
+def parse_schedule_page(page_html):
+    """
+    return schedule page parts or None if page has no schedule
+
+    :param page_html: schedule page of route
+    :type page_html: str
+    :return: dict with days, day of each page variant, last_update,
+    stops headers and trips
+    :rtype: dict|None
+    """
+    # First table contains switcher for weekday/weekend/certain day.
+    # It's would be using for determine schedule day.
+    # It is small, so only it goes through the DOM parser
+    top_html = _find_table(page_html, 'top')
+    if top_html is None:
+        return None
+    ttop = BeautifulSoup(top_html, 'html.parser')
+
+    tnav = ttop.find('table', align='center')
+    a_tags = tnav.find_all('a')
+
+    # days of week
+    variants = []
+    for a in a_tags:
+        for variant in VARIANT_DAYS:
+            if variant in a['href']:
+                variants.append(variant)
+                break
+
+    variant_days = OrderedDict()
+    for variant in variants:
+        day = VARIANT_DAYS[variant]
+        if variant == '_v' and '_s' in variants:
+            # saturday has own page, so weekend page is for sunday
+            day = 7
+        variant_days[variant] = day
+
+    # Schedule days
+    on_date = None
+    for tag in ttop.find_all('tr', limit=5):
+        td = tag.find('td', align='center')
+        if td and 'по состоянию' in td.text:
+            on_date = td.find('font')
+
+    # calc on_date date
+    last_update = None
+    if on_date:
+        last_update = parse_rus_date_to_naive_date(on_date.text)
+
+    # Schedule itself, its first row is the columns' headers,
+    # which will use to determine bus stop order for correct mapping
+    table_html = _find_table(page_html, 't')
+    if table_html is None:
+        return None
+    raw_stops, trips = parse_schedule_table(table_html)
 
-    options = OPTIONS_RE.findall(raw)
+    return {
+        'days': list(variant_days.values()),
+        'variant_days': variant_days,
+        'last_update': last_update,
+        'stops': raw_stops,
+        'trips': trips,
+    }
 
-    return [{'code': opt[0].strip(),
-             'name': opt[1].strip()} for opt in options]
 
+def parse_schedule_content(content, encoding=None):
+    """
+    return schedule page parts of raw page payload, uses no DB
+    and returns plain structures, so could be run in worker process
 
+    :param content: schedule page payload
+    :type content: bytes
+    :param encoding: encoding of payload, detected if not set
+    or payload does not decode with it
+    :type encoding: str
+    :rtype: dict|None
+    """
+    page_html, encoding = decode_content(content, encoding)
+    page = parse_schedule_page(page_html)
+    if page is not None:
+        page['encoding'] = encoding
+    return page
@@ -0,0 +1,328 @@
+# coding=utf-8
+
+import logging
+import math
+from collections import defaultdict
+
+from django.db.models import Q
+
+from .bulk import bulk_update
+from .geometry import EARTH_RADIUS
+from .models import Platform, PlatformAlias, Stop, DataProviderUrl
+
+logger = logging.getLogger(__name__)
+
+METERS_PER_DEGREE = math.pi * EARTH_RADIUS / 180
+
+# 2GIS jitters stop coordinates in the last decimals,
+# stops closer than that are treated as the same stop
+STOP_TOLERANCE = 2.0
+
+
+def normalize_name(name):
+    return name.strip().lower()
+
+
+def distance_meters(lon1, lat1, lon2, lat2):
+    """
+    return approximate distance between two close WGS84 points
+
+    :return: distance in meters
+    :rtype: float
+    """
+    x = math.radians(lon2 - lon1) * math.cos(math.radians((lat1 + lat2) / 2))
+    y = math.radians(lat2 - lat1)
+    return EARTH_RADIUS * math.hypot(x, y)
+
+
+class PlatformResolver(object):
+    """
+    In-memory index of platforms and platform aliases by normalized
+    name, loaded once per sync run. Platforms created during the run
+    are registered too, so every lookup is a dict access.
+    """
+
+    def __init__(self, platforms=(), aliases=()):
+        self._platforms = {}
+        self._aliases = {}
+
+        for platform in platforms:
+            self.add(platform)
+        for alias in aliases:
+            self.add_alias(alias)
+
+    @classmethod
+    def load(cls):
+        """
+        return resolver filled with all platforms and aliases from DB
+
+        :rtype: PlatformResolver
+        """
+        resolver = cls(
+            Platform.objects.order_by('pk'),
+            PlatformAlias.objects.select_related('platform').order_by('pk'))
+        logger.debug('Platform resolver loaded: platforms: %s, aliases: %s'
+                     % (len(resolver._platforms), len(resolver._aliases)))
+        return resolver
+
+    def add(self, platform):
+        self._platforms.setdefault(normalize_name(platform.name), platform)
+
+    def add_alias(self, alias):
+        self._aliases.setdefault(normalize_name(alias.name), alias)
+
+    def get(self, name):
+        """
+        return platform and alias found by name
+
+        :param name: look up name
+        :type name: str | unicode
+        :return: (platform, alias) | (None, None)
+        :rtype: tuple
+        """
+        key = normalize_name(name)
+
+        platform = self._platforms.get(key)
+        if platform is not None:
+            return platform, None
+
+        alias = self._aliases.get(key)
+        if alias is not None:
+            return alias.platform, alias
+
+        return None, None
+
+    def resolve(self, name):
+        """
+        get or create platform, created platform is registered
+        in index but not saved
+
+        :param name: look up name
+        :type name: str | unicode
+        :return: (platform, alias, created)
+        :rtype: tuple
+        """
+        platform, alias = self.get(name)
+        if platform is not None:
+            return platform, alias, False
+
+        platform = Platform(name=name)
+        self.add(platform)
+        return platform, None, True
+
+
+class ProviderRegistry(object):
+    """
+    In-memory index of data providers by type and route id and by type
+    and route code, loaded once per sync run. Providers found by route
+    code get linked with the route in memory, the links are saved
+    together by save_links.
+    """
+
+    def __init__(self, providers=()):
+        self._by_route = {}
+        self._by_code = {}
+        self._unlinked = {}
+
+        for provider in providers:
+            self.add(provider)
+
+    @classmethod
+    def load(cls, types=None, routes=None):
+        """
+        return registry filled with data providers from DB
+
+        :param types: data provider types to load, all if not set
+        :type types: iterable
+        :param routes: load only providers of routes
+        :type routes: iterable
+        :rtype: ProviderRegistry
+        """
+        qs = DataProviderUrl.objects.order_by('pk')
+        if types is not None:
+            qs = qs.filter(type__in=list(types))
+        if routes is not None:
+            routes = list(routes)
+            qs = qs.filter(Q(route__in=routes) |
+                           Q(route_code__in=[route.code
+                                             for route in routes]))
+
+        registry = cls(qs)
+        logger.debug('Provider registry loaded: by route: %s, by code: %s'
+                     % (len(registry._by_route), len(registry._by_code)))
+        return registry
+
+    def add(self, provider):
+        if provider.route_id is not None:
+            self._by_route.setdefault(
+                (provider.type, provider.route_id), provider)
+        if provider.route_code:
+            self._by_code.setdefault(
+                (provider.type, provider.route_code), provider)
+
+    def get(self, route, type):
+        """
+        return data provider of route, provider with route code
+        is preferred to the one linked with route and gets linked too
+
+        :param route: route to look up data provider of
+        :type route: .models.Route
+        :param type: data provider type
+        :type type: str
+        :return: data provider | None
+        :rtype: DataProviderUrl|None
+        """
+        provider = self._by_code.get((type, route.code))
+        if provider is None:
+            return self._by_route.get((type, route.pk))
+
+        if provider.route_id != route.pk:
+            provider.route = route
+            self._by_route[(type, route.pk)] = provider
+            self._unlinked[provider.pk] = provider
+        return provider
+
+    def save_links(self):
+        """
+        save links of providers with routes found since the last save
+
+        :return: count of linked providers
+        :rtype: int
+        """
+        linked = bulk_update(list(self._unlinked.values()), ('route',))
+        self._unlinked = {}
+        return linked
+
+
+class StopIndex(object):
+    """
+    In-memory index of stops by coordinates, loaded once per sync run.
+    Stops are bucketed into grid cells of tolerance size, so a lookup
+    checks only a few neighbour cells instead of querying DB.
+    """
+
+    def __init__(self, stops=(), tolerance=STOP_TOLERANCE):
+        """
+        :param stops: stops to index
+        :type stops: iterable
+        :param tolerance: max distance in meters between coordinates
+        of the same stop, 0 means exact match only
+        :type tolerance: float
+        """
+        self.tolerance = tolerance
+        self._cell = max(tolerance, 1.0) / METERS_PER_DEGREE
+        self._exact = {}
+        self._grid = defaultdict(list)
+
+        for stop in stops:
+            self.add(stop)
+
+    @classmethod
+    def load(cls, tolerance=STOP_TOLERANCE):
+        """
+        return index filled with all stops from DB
+
+        :rtype: StopIndex
+        """
+        index = cls(Stop.objects.select_related('platform').order_by('pk'),
+                    tolerance=tolerance)
+        logger.debug('Stop index loaded: stops: %s' % len(index._exact))
+        return index
+
+    def _cell_key(self, lon, lat):
+        return (int(math.floor(lon / self._cell)),
+                int(math.floor(lat / self._cell)))
+
+    def add(self, stop):
+        if stop.longitude is None or stop.latitude is None:
+            return
+
+        self._exact.setdefault((stop.longitude, stop.latitude), stop)
+        self._grid[self._cell_key(stop.longitude, stop.latitude)].append(stop)
+
+    def candidates(self, lon, lat):
+        """
+        return stops from cells around point, a superset
+        of stops within tolerance
+
+        :rtype: list
+        """
+        x, y = self._cell_key(lon, lat)
+        # degree of longitude is shorter than degree of latitude
+        dx = int(math.ceil(1 / max(math.cos(math.radians(lat)), 0.01)))
+
+        result = []
+        for i in range(x - dx, x + dx + 1):
+            for j in range(y - 1, y + 2):
+                result.extend(self._grid.get((i, j), ()))
+        return result
+
+    def find(self, lon, lat, platform=None):
+        """
+        return stop with exactly the same coordinates or the nearest
+        stop of platform within tolerance
+
+        :param lon: longitude
+        :type lon: float
+        :param lat: latitude
+        :type lat: float
+        :param platform: platform the stop should belong to
+        :type platform: Platform
+        :return: stop | None
+        :rtype: Stop|None
+        """
+        stop = self._exact.get((lon, lat))
+        if stop is not None or not self.tolerance:
+            return stop
+
+        nearest = None
+        nearest_dist = self.tolerance
+        for candidate in self.candidates(lon, lat):
+            if platform is not None \
+                    and not _is_same_platform(candidate, platform):
+                continue
+
+            dist = distance_meters(
+                lon, lat, candidate.longitude, candidate.latitude)
+            if dist <= nearest_dist:
+                nearest = candidate
+                nearest_dist = dist
+
+        return nearest
+
+    def resolve(self, platform, point, alias=None):
+        """
+        get or create Stop, created stop is registered
+        in index but not saved
+
+        :param platform:
+        :type platform: Platform
+        :param point: GEO point
+        :type point: .models.Point
+        :param alias:
+        :type alias: PlatformAlias
+        :return: return tuple(Stop, created)
+        :rtype: tuple
+        """
+        created = False
+
+        stop = self.find(point.lon, point.lat, platform)
+        if stop is None:
+            stop = Stop(
+                platform=platform,
+                longitude=point.lon,
+                latitude=point.lat,
+            )
+            self.add(stop)
+            created = True
+
+        if alias:
+            stop.alias = alias
+
+        return stop, created
+
+
+def _is_same_platform(stop, platform):
+    if platform.pk:
+        return stop.platform_id == platform.pk
+    return stop.platform is platform
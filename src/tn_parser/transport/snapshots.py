@@ -0,0 +1,292 @@
+# coding=utf-8
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, defaultdict, namedtuple
+
+from django.conf import settings
+from django.utils import timezone
+
+from .geometry import get_walking_transfers
+from .models import Platform, Route, RoutePoint, Stop
+
+logger = logging.getLogger(__name__)
+
+CURRENT = 'current.jsonl'
+
+Document = namedtuple('Document', ('body', 'etag'))
+
+
+def get_snapshot_root():
+    return getattr(settings, 'API_SNAPSHOT_ROOT', '')
+
+
+def serialize(data):
+    """
+    return compact JSON of data, the same data gives the same bytes,
+    so ETags stay stable between rebuilds and processes
+
+    :rtype: bytes
+    """
+    return json.dumps(data, sort_keys=True, ensure_ascii=False,
+                      separators=(',', ':')).encode('utf-8')
+
+
+def _format(value):
+    if value is None:
+        return None
+    return value.isoformat()
+
+
+def build_documents(run=None):
+    """
+    return API documents built from DB: routes, stops and platforms
+    lists, every route with its ordered stops and schedule trips
+    by day of week, one query per table, and walking transfers
+    between nearby stops
+
+    :param run: sync run documents are built after
+    :type run: .models.SyncRun
+    :return: dict of document name -> data
+    :rtype: OrderedDict
+    """
+    routes = [dict(route, canceled=_format(route['canceled']))
+              for route in Route.objects.order_by('pk').values(
+                  'id', 'code', 'name', 'type', 'canceled')]
+
+    stops = [
+        {'id': pk, 'platform': platform_id, 'lon': lon, 'lat': lat}
+        for pk, platform_id, lon, lat in Stop.objects.order_by('pk')
+        .values_list('pk', 'platform_id', 'longitude', 'latitude')]
+
+    platform_stops = defaultdict(list)
+    for stop in stops:
+        platform_stops[stop['platform']].append(stop['id'])
+    platforms = [
+        {'id': pk, 'name': name, 'full_name': full_name,
+         'geo_direction': geo_direction, 'stops': platform_stops[pk]}
+        for pk, name, full_name, geo_direction in Platform.objects
+        .order_by('pk')
+        .values_list('pk', 'name', 'full_name', 'geo_direction')]
+
+    platform_names = dict((platform['id'], platform['name'])
+                          for platform in platforms)
+    stop_coords = dict((stop['id'], stop) for stop in stops)
+    route_stops = defaultdict(list)
+    for (route_id, stop_id, direction, order, time_, geo_direction,
+         angle, on_demand) in RoutePoint.objects\
+            .filter(lap=0)\
+            .order_by('route', 'order')\
+            .values_list('route_id', 'stop_id', 'direction', 'order',
+                         'time', 'geo_direction', 'angle', 'on_demand'):
+        stop = stop_coords[stop_id]
+        route_stops[route_id].append({
+            'stop': stop_id,
+            'platform': stop['platform'],
+            'name': platform_names.get(stop['platform']),
+            'lon': stop['lon'],
+            'lat': stop['lat'],
+            'direction': direction,
+            'order': order,
+            'time': _format(time_),
+            'geo_direction': geo_direction,
+            'angle': angle,
+            'on_demand': on_demand,
+        })
+
+    # schedule trips are laps from 1, see sync.process_route_schedule
+    route_schedules = defaultdict(lambda: defaultdict(list))
+    last_trip = None
+    for route_id, weekday, lap, stop_id, direction, time_ in RoutePoint\
+            .objects\
+            .filter(lap__gt=0, skip=False)\
+            .order_by('route', 'week_dimension__weekday', 'lap', 'order')\
+            .values_list('route_id', 'week_dimension__weekday', 'lap',
+                         'stop_id', 'direction', 'time'):
+        trips = route_schedules[route_id][str(weekday)]
+        if (route_id, weekday, lap) != last_trip:
+            trips.append({'direction': direction, 'stops': []})
+            last_trip = (route_id, weekday, lap)
+        trips[-1]['stops'].append([stop_id, time_.strftime('%H:%M')])
+
+    documents = OrderedDict()
+    documents['meta'] = {
+        'run': run.pk if run is not None else None,
+        'built': _format(timezone.now()),
+    }
+    documents['routes'] = routes
+    documents['stops'] = stops
+    documents['platforms'] = platforms
+
+    located = [stop for stop in stops
+               if stop['lon'] is not None and stop['lat'] is not None]
+    documents['transfers'] = [
+        [located[index]['id'], located[other]['id'], minutes]
+        for index, other, minutes in get_walking_transfers(
+            [stop['lon'] for stop in located],
+            [stop['lat'] for stop in located])]
+
+    for route in routes:
+        documents['routes/{}'.format(route['id'])] = dict(
+            route, stops=route_stops[route['id']],
+            schedule=route_schedules.get(route['id'], {}))
+    return documents
+
+
+def publish_snapshot(run=None, root=None):
+    """
+    build API documents and replace current snapshot with them,
+    the snapshot file is replaced atomically
+
+    :param run: sync run snapshot is built after
+    :type run: .models.SyncRun
+    :param root: snapshots directory, from settings if not set
+    :type root: str
+    :return: path of snapshot | None if snapshots are switched off
+    :rtype: str|None
+    """
+    root = root or get_snapshot_root()
+    if not root:
+        return None
+
+    os.makedirs(root, exist_ok=True)
+    path = os.path.join(root, CURRENT)
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+
+    documents = build_documents(run)
+    with open(tmp_path, 'wb') as f:
+        for name, data in documents.items():
+            f.write(name.encode('utf-8') + b'\t' + serialize(data) + b'\n')
+    os.replace(tmp_path, path)
+
+    logger.info('API snapshot published: %s documents' % len(documents))
+    return path
+
+
+def publish_run_snapshot(run, changes):
+    """
+    publish snapshot after sync run if run changed anything
+    or there is no snapshot yet
+
+    :param run: finished sync run
+    :type run: .models.SyncRun
+    :param changes: count of changes of run
+    :type changes: int
+    :rtype: str|None
+    """
+    root = get_snapshot_root()
+    if not root:
+        return None
+    if not changes and os.path.exists(os.path.join(root, CURRENT)):
+        return None
+    return publish_snapshot(run, root)
+
+
+class Snapshot(object):
+    """
+    API documents read into memory with their ETags,
+    every lookup is a dict access. Indexes built from documents
+    are kept with the snapshot, so they are replaced together with it.
+    """
+
+    def __init__(self, documents=None):
+        self.documents = documents or {}
+        self._indexes = {}
+
+    @classmethod
+    def read(cls, path):
+        documents = {}
+        with open(path, 'rb') as f:
+            for line in f:
+                name, body = line.rstrip(b'\n').split(b'\t', 1)
+                documents[name.decode('utf-8')] = Document(
+                    body, hashlib.sha1(body).hexdigest())
+        return cls(documents)
+
+    def get(self, name):
+        """
+        return document by name or None
+
+        :rtype: Document|None
+        """
+        return self.documents.get(name)
+
+    def get_data(self, name, default=None):
+        """
+        return deserialized document by name or default
+        """
+        document = self.documents.get(name)
+        if document is None:
+            return default
+        return json.loads(document.body.decode('utf-8'))
+
+    def get_index(self, index_class):
+        """
+        return index of snapshot built by index_class.load(snapshot),
+        the index is built once per snapshot
+        """
+        index = self._indexes.get(index_class)
+        if index is None:
+            index = self._indexes[index_class] = index_class.load(self)
+        return index
+
+
+class SnapshotLoader(object):
+    """
+    Keeps the current snapshot in memory of web process and reads it
+    again when sync publishes new one, the snapshot file is checked
+    not more often than once per interval.
+    """
+
+    def __init__(self, root=None, interval=None):
+        self.root = root
+        self.interval = interval
+        self._snapshot = Snapshot()
+        self._stamp = None
+        self._checked = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        """
+        return current snapshot
+
+        :rtype: Snapshot
+        """
+        interval = self.interval
+        if interval is None:
+            interval = getattr(settings, 'API_SNAPSHOT_CHECK_INTERVAL', 5.0)
+
+        now = time.time()
+        if self._checked is not None and now - self._checked < interval:
+            return self._snapshot
+
+        with self._lock:
+            if self._checked is None or now - self._checked >= interval:
+                self._reload()
+                self._checked = now
+        return self._snapshot
+
+    def _reload(self):
+        root = self.root or get_snapshot_root()
+        if not root:
+            return
+
+        path = os.path.join(root, CURRENT)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return
+
+        stamp = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        if stamp != self._stamp:
+            self._snapshot = Snapshot.read(path)
+            self._stamp = stamp
+            logger.info('API snapshot loaded: %s documents'
+                        % len(self._snapshot.documents))
+
+
+loader = SnapshotLoader()
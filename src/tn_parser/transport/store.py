@@ -0,0 +1,240 @@
+# coding=utf-8
+
+import gzip
+import hashlib
+import json
+import logging
+import os
+
+import requests
+from django.conf import settings
+from django.utils import timezone
+
+from .fetch import FetchResult, normalize_url
+
+logger = logging.getLogger(__name__)
+
+LATEST = 'latest'
+
+_STORED_HEADERS = ('Content-Type', 'ETag', 'Last-Modified')
+
+
+def get_payload_store():
+    """
+    return payload store configured in settings or None
+    if storing is switched off
+
+    :rtype: PayloadStore|None
+    """
+    root = getattr(settings, 'PAYLOAD_STORE_ROOT', '')
+    return PayloadStore(root) if root else None
+
+
+def open_payload_store(replay=None):
+    """
+    return store to save fetched payloads to and snapshot to replay,
+    only one of them is set depending on replay mode
+
+    :param replay: name of snapshot to replay
+    :type replay: str|None
+    :return: (store, snapshot)
+    :rtype: tuple
+    """
+    store = get_payload_store()
+    if not replay:
+        return store, None
+
+    if store is None:
+        raise ValueError('Payload store is switched off, nothing to replay')
+    return None, store.open(replay)
+
+
+class PayloadStore(object):
+    """
+    Local store of fetched payloads. Payloads are gzipped and stored once
+    by digest of their content, every fetch is appended to the manifest
+    of snapshot with url, provider, route and fetch time. Not modified
+    responses refer to the payload stored for the url before, so every
+    snapshot is complete and could be replayed alone.
+
+    root/
+        objects/ab/cdef....gz
+        snapshots/20170625T185700.jsonl
+    """
+
+    def __init__(self, root, snapshot=None):
+        """
+        :param root: directory of store
+        :type root: str
+        :param snapshot: name of snapshot to record fetches into,
+        by default current time
+        :type snapshot: str
+        """
+        self.root = root
+        self.snapshot = snapshot or timezone.now().strftime('%Y%m%dT%H%M%S')
+        # the latest manifest entry by url, loaded on the first 304
+        self._latest = None
+
+    def _object_path(self, digest):
+        return os.path.join(self.root, 'objects', digest[:2], digest[2:] + '.gz')
+
+    def _snapshot_path(self, snapshot):
+        return os.path.join(self.root, 'snapshots', snapshot + '.jsonl')
+
+    def save(self, url, response, provider='', route=''):
+        """
+        store payload of successful response, not modified response
+        is recorded with the payload stored for url before
+
+        :param url: fetched url
+        :type url: str
+        :param response: response
+        :type response: requests.Response
+        :param provider: data provider type
+        :type provider: str
+        :param route: route code the payload belongs to
+        :type route: str
+        :return: digest of payload | None
+        :rtype: str|None
+        """
+        url = normalize_url(url)
+        headers = dict((name, response.headers[name])
+                       for name in _STORED_HEADERS
+                       if name in response.headers)
+
+        if response.status_code == 304:
+            previous = self._get_latest().get(url)
+            if previous is None:
+                logger.warning('No stored payload of not modified url: '
+                               '{}'.format(url))
+                return None
+            digest = previous['digest']
+            headers = dict(previous['headers'], **headers)
+        elif response.status_code != 200:
+            return None
+        else:
+            digest = self._write_object(response.content)
+
+        entry = {
+            'url': url,
+            'provider': provider,
+            'route': route,
+            'fetched': timezone.now().isoformat(),
+            'digest': digest,
+            'headers': headers,
+        }
+        if response.status_code == 304:
+            entry['not_modified'] = True
+
+        path = self._snapshot_path(self.snapshot)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'a') as fp:
+            fp.write(json.dumps(entry, sort_keys=True) + '\n')
+
+        if self._latest is not None:
+            self._latest[url] = entry
+        return digest
+
+    def _write_object(self, content):
+        digest = hashlib.sha1(content).hexdigest()
+        path = self._object_path(digest)
+        if not os.path.exists(path):
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with gzip.open(path + '.tmp', 'wb') as fp:
+                fp.write(content)
+            os.rename(path + '.tmp', path)
+        return digest
+
+    def _get_latest(self):
+        if self._latest is None:
+            self._latest = self._read_entries(self.snapshots())
+        return self._latest
+
+    def _read_entries(self, names):
+        entries = {}
+        for name in names:
+            with open(self._snapshot_path(name)) as fp:
+                for line in fp:
+                    entry = json.loads(line)
+                    entries[entry['url']] = entry
+        return entries
+
+    def snapshots(self):
+        """
+        return names of recorded snapshots, oldest first
+
+        :rtype: list
+        """
+        path = os.path.join(self.root, 'snapshots')
+        if not os.path.isdir(path):
+            return []
+        return sorted(name[:-len('.jsonl')] for name in os.listdir(path)
+                      if name.endswith('.jsonl'))
+
+    def open(self, snapshot):
+        """
+        return snapshot for replaying, 'latest' merges all snapshots
+        so the most recent payload of each url is replayed
+
+        :param snapshot: name of snapshot or 'latest'
+        :type snapshot: str
+        :rtype: Snapshot
+        """
+        if snapshot == LATEST:
+            names = self.snapshots()
+        else:
+            names = [snapshot]
+            if not os.path.exists(self._snapshot_path(snapshot)):
+                raise ValueError('No snapshot found: {}'.format(snapshot))
+
+        return Snapshot(self, self._read_entries(names))
+
+    def read(self, digest):
+        with gzip.open(self._object_path(digest), 'rb') as fp:
+            return fp.read()
+
+
+class Snapshot(object):
+    """
+    Stored payloads served as responses, so it could be used
+    in place of fetcher to replay syncing without network.
+    """
+
+    def __init__(self, store, entries):
+        self.store = store
+        self.entries = entries
+
+    def get(self, url):
+        """
+        return stored response of url or None
+
+        :param url: url to look up
+        :type url: str
+        :rtype: requests.Response|None
+        """
+        entry = self.entries.get(normalize_url(url))
+        if entry is None:
+            return None
+
+        response = requests.Response()
+        response.url = url
+        response.status_code = 200
+        response.headers.update(entry['headers'])
+        response._content = self.store.read(entry['digest'])
+        return response
+
+    def iter_results(self, jobs, ordered=False):
+        for job in jobs:
+            key, url = job[:2]
+            response = self.get(url)
+            error = None
+            if response is None:
+                error = requests.ConnectionError(
+                    'Not found in snapshot: {}'.format(normalize_url(url)))
+                logger.warning(error)
+            yield FetchResult(key, url, response, error)
+
+    def fetch_all(self, jobs):
+        return list(self.iter_results(jobs))
@@ -6,15 +6,44 @@ import datetime
 import re
 from collections import defaultdict, OrderedDict
 from copy import copy
+from functools import lru_cache
 
-import requests
+from django.db import transaction
+from django.utils import timezone
 
 from .models import Route, DataProviderUrl,\
     DataProviderTypes as p_types, RouteTypes, Point, Platform, Directions, RoutePoint, RouteWeekDimension, GeoDirections, \
-    PlatformAlias, Stop
+    PlatformAlias, Stop, RouteDateDimension, RouteSchedule, \
+    ChangeOperations as ops
+from .bulk import BATCH_SIZE, bulk_create_with_pks, bulk_update, \
+    bulk_create_inherited, bulk_delete_inherited
+from .fetch import AsyncFetcher, DEFAULT_TIMEOUT, charsets, get_session, \
+    get_conditional_headers, get_digest, is_not_modified
+from .geometry import PointArray, compute_route_geometry, offset_to_time
+from .matchers import save_aliases
+from .resolvers import PlatformResolver, ProviderRegistry, StopIndex, \
+    STOP_TOLERANCE, normalize_name
 
 logger = logging.getLogger(__name__)
 
+_ROUTE_POINT_FIELDS = ('time', 'lap_start', 'direction',
+                       'geo_direction', 'angle', 'on_demand')
+
+
+def get_week_dimension(weekday):
+    """
+    return week dimension of day of week, date dimensions
+    which are week dimensions too are not taken into account
+
+    :param weekday: day of week from 1 to 7
+    :type weekday: int
+    :rtype: .models.RouteWeekDimension
+    """
+    week_dim, _ = RouteWeekDimension.objects\
+        .filter(routedatedimension__isnull=True)\
+        .get_or_create(weekend=weekday >= 6, weekday=weekday)
+    return week_dim
+
 
 def _adds_count_of_sets_to_dict(datadict):
     res = dict()
@@ -25,64 +54,184 @@ def _adds_count_of_sets_to_dict(datadict):
     return res
 
 
-def get_routes_raw_data():
+def get_routes_raw_data(store=None, replay=None):
+    """
+    return routes HTML page
+
+    :param store: store to save fetched page to
+    :type store: .store.PayloadStore
+    :param replay: snapshot to read page from instead of fetching
+    :type replay: .store.Snapshot
+    :rtype: str
+    """
     try:
         data_provider = DataProviderUrl.objects.get(
             type=p_types.ROUTES_HTML_PAGE)
 
-        resp = requests.get(data_provider.link)
-        return resp.content.decode(data_provider.coding)
+        if replay is not None:
+            resp = replay.get(data_provider.link)
+            if resp is None:
+                logger.error('No routes HTML page found in snapshot')
+                return ''
+        else:
+            resp = get_session().get(data_provider.link,
+                                     timeout=DEFAULT_TIMEOUT)
+            if store is not None:
+                store.save(data_provider.link, resp,
+                           provider=data_provider.type)
+
+        charsets.seed([data_provider])
+        return charsets.decode(resp, data_provider.type, data_provider.link)
     except DataProviderUrl.DoesNotExist:
         logger.error(
             'No data providers found for Routes HTML page type of data')
         return ''
 
 
-def process_parsed_routes(routes, transport_type):
-    parsed = set([route['code'].split('_')[0] for route in routes])
-    exists = set(Route.objects
-                 .filter(type=transport_type)
-                 .values_list('code', flat=True))
+def _get_route_code(code):
+    return code.split('_')[0]
+
+
+def process_parsed_routes(routes_by_type, journal=None):
+    """
+    reconcile routes in DB with routes parsed from routes page:
+    add new routes, update changed names and types, cancel routes
+    which are gone and revive canceled routes which are back.
+    Routes of types missing in routes_by_type are left as is
+
+    :param routes_by_type: parsed routes by route type
+    :type routes_by_type: dict
+    :param journal: journal of sync run to record changes to
+    :type journal: .journal.Journal
+    :return: stats of each route type
+    :rtype: OrderedDict
+    """
+    parsed = OrderedDict()
+    for transport_type, routes in routes_by_type.items():
+        for route in routes:
+            code = _get_route_code(route['code'])
+            if code not in parsed:
+                parsed[code] = (transport_type, route['name'])
+
+    existing = dict(
+        (route.code, route)
+        for route in Route.objects.only('id', 'code', 'name',
+                                        'type', 'canceled'))
+
+    stats = OrderedDict(
+        (transport_type, dict(added=set(), updated=set(), exists=set(),
+                              renamed=set(), revived=set(),
+                              canceled=set(), canceled_total=set()))
+        for transport_type in routes_by_type)
+
+    def add_stat(transport_type, key, code):
+        if transport_type in stats:
+            stats[transport_type][key].add(code)
+
+    created, changed, revived = [], [], []
+    for code, (transport_type, name) in parsed.items():
+        route = existing.get(code)
+        if route is None:
+            created.append(Route(code=code, name=name, type=transport_type))
+            add_stat(transport_type, 'added', code)
+            continue
+
+        add_stat(transport_type, 'updated', code)
+        fields = [field for field, value in (('name', name),
+                                             ('type', transport_type))
+                  if getattr(route, field) != value]
+        if fields:
+            route.name = name
+            route.type = transport_type
+            changed.append((route, fields))
+            add_stat(transport_type, 'renamed', code)
+        if route.canceled is not None:
+            revived.append(route.pk)
+            add_stat(transport_type, 'revived', code)
+
+    today = datetime.datetime.now().date()
+    canceled = []
+    for code, route in existing.items():
+        add_stat(route.type, 'exists', code)
+        if route.canceled is not None:
+            add_stat(route.type, 'canceled_total', code)
+        elif route.type in stats and code not in parsed:
+            canceled.append(route.pk)
+            add_stat(route.type, 'canceled', code)
+
+    with transaction.atomic():
+        bulk_create_with_pks(Route, created, key=lambda route: route.code)
+        bulk_update([route for route, _ in changed], ('name', 'type'))
+        for start in range(0, len(canceled), BATCH_SIZE):
+            Route.objects.filter(pk__in=canceled[start:start + BATCH_SIZE])\
+                .update(canceled=today)
+        for start in range(0, len(revived), BATCH_SIZE):
+            Route.objects.filter(pk__in=revived[start:start + BATCH_SIZE])\
+                .update(canceled=None)
+
+    if journal is not None:
+        journal.created(created)
+        for route, fields in changed:
+            journal.updated([route], fields)
+        journal.record('Route', canceled + revived, ops.UPDATE, ['canceled'])
+
+    return OrderedDict(
+        (transport_type, _adds_count_of_sets_to_dict(type_stats))
+        for transport_type, type_stats in stats.items())
+
+
+def get_2gis_provider(route, registry=None):
+    """
+    return 2GIS data provider linked with route
+
+    :param route: route model for using to look up
+    data provider in DB
+    :type route: .models.Route
+    :param registry: preloaded data providers, if not set providers
+    of route are loaded and found link is saved right away
+    :type registry: .resolvers.ProviderRegistry
+    :return: data provider | None
+    :rtype: DataProviderUrl|None
+    """
+    save_links = registry is None
+    if save_links:
+        registry = ProviderRegistry.load([p_types.TWOGIS_ROUTE_API], [route])
+
+    data_provider = registry.get(route, p_types.TWOGIS_ROUTE_API)
+    if save_links:
+        registry.save_links()
 
-    diff = parsed - exists
-    canceled_now = exists - parsed
+    if not data_provider:
+        logger.error(
+            'No data providers found for route: {}'.format(route.name))
 
-    canceled_already = set(Route.objects
-        .filter(type=transport_type)
-        .exclude(canceled=None)
-        .values_list('code', flat=True))
+    return data_provider
 
-    create_batch = []
-    for route_dict in routes:
-        route = dict(**route_dict)
-        route.update({
-            'code': route['code'].split('_')[0],
-            'type': transport_type,
-        })
-        if route['code'] in diff:
-            create_batch.append(Route(**route))
 
-    canceled = [route_code
-                for route_code in canceled_now
-                if route_code not in canceled_already]
+def fetch_2gis_data(api_key, data_provider, session=None):
+    """
+    return route data got from 2gis API, touches no DB
+    so it is safe to be called from worker threads
 
-    if canceled:
-        Route.objects.filter(code__in=canceled)\
-            .update(canceled=datetime.datetime.now().date())
+    :param api_key: key for connecting to API
+    :type str
+    :param data_provider: 2GIS data provider of route
+    :type data_provider: .models.DataProviderUrl
+    :param session: shared keep-alive session
+    :type session: requests.Session
+    :return: json dict from api
+    :rtype: dict
+    """
+    resp = (session or get_session()).get(
+        get_2gis_url(api_key, data_provider), timeout=DEFAULT_TIMEOUT)
+    return resp.json()
 
-    if len(create_batch):
-        Route.objects.bulk_create(create_batch)
 
-    return _adds_count_of_sets_to_dict({
-        'added': diff,
-        'updated': parsed - diff,
-        'exists': exists,
-        'canceled': canceled,
-        'canceled_total': canceled_already,
-    })
+def get_2gis_url(api_key, data_provider):
+    return '{}&key={}'.format(data_provider.link, api_key)
 
 
-def get_2gis_data(api_key, route):
+def get_2gis_data(api_key, route, session=None):
     """
     return None or route data got from 2gis API
 
@@ -91,129 +240,59 @@ def get_2gis_data(api_key, route):
     :param route: route model for using to look up
     data provider in DB
     :type route: .models.Route
+    :param session: shared keep-alive session
+    :type session: requests.Session
     :return: json dict from api | None
     :rtype: dict|None
     """
-    data_provider = None
-    try:
-        data_provider = route.data_providers.get(
-            type=p_types.TWOGIS_ROUTE_API)
-    except DataProviderUrl.DoesNotExist:
-        pass
-
-    try:
-        data_provider = DataProviderUrl.objects.get(
-            route_code=route.code,
-            type=p_types.TWOGIS_ROUTE_API)
-
-        data_provider.route = route
-        data_provider.save()
-    except DataProviderUrl.DoesNotExist:
-        pass
+    data_provider = get_2gis_provider(route)
 
     if not data_provider:
-        logger.error(
-            'No data providers found for route: {}'.format(route.name))
         return None
     else:
-        resp = requests.get('{}&key={}'.format(data_provider.link, api_key))
-        return resp.json()
+        return fetch_2gis_data(api_key, data_provider, session)
 
 
-def _find_platform(name, to_create_list):
-    """
-    get or create platform
+def process_route_platforms_with_2gis(api_key, route, session=None,
+                                      resolver=None, stop_index=None,
+                                      journal=None):
+    json = get_2gis_data(api_key, route, session)
+    return process_route_2gis_data(route, json, resolver, stop_index,
+                                   journal)
 
-    :param name: look up name
-    :type:  str | unicode
-    :param to_create_list: list of created but not wrote instances
-    :type:  list
-    :return: (platform, alias, created)
-    :rtype: tuple
-    """
-    alias = None
-    alias_list = None
-    created = False
-    platform = None
-
-    for pl in to_create_list:
-        if pl.name == name:
-            platform = pl
-            # created = True
-            break
-    else:
-        try:
-            platform = Platform.objects.get(name=name)
-        except Platform.DoesNotExist:
-            alias_list = PlatformAlias.objects.filter(name=name)
-
-    if not platform:
-        if alias_list and len(alias_list):
-            alias = alias_list[0]
 
-        if alias:
-            platform = alias.platform
-        else:
-            platform = Platform(name=name)
-            created = True
-
-    return platform, alias, created
-
-
-def _find_stop(platform, point, to_create_list, alias=None):
+def process_route_2gis_data(route, json, resolver=None, stop_index=None,
+                            journal=None):
     """
-    get or create Stop
-
-    :param platform:
-    :type platform: Platform
-    :param point: GEO point
-    :type point: Point
-    :param to_create_list: list of created but not wrote instances
-    :type to_create_list: list
-    :param alias:
-    :type alias: PlatformAlias
-    :return: return tuple(Stop, created)
-    :rtype: tuple
-    """
-    # Platform
-    create = False
-
-    stop = Stop(
-        platform=platform,
-        longitude=point.lon,
-        latitude=point.lat,
-        alias=alias
-    )
-
-    for st in to_create_list:
-        if st == stop:
-            stop = st
-            break
-    else:
-        try:
-            stop = Stop.objects.get(
-                longitude=point.lon,
-                latitude=point.lat)
-        except Stop.DoesNotExist:
-            create = True
-
-    if alias:
-        stop.alias = alias
-
-    return stop, create
-
+    sync platforms, stops and route points of route
+    with data got from 2gis API
 
-def process_route_platforms_with_2gis(api_key, route):
-    json = get_2gis_data(api_key, route)
+    :param route: route to sync
+    :type route: .models.Route
+    :param json: json dict from api
+    :type json: dict|None
+    :param resolver: platforms index shared by sync run
+    :type resolver: .resolvers.PlatformResolver
+    :param stop_index: stops index shared by sync run
+    :type stop_index: .resolvers.StopIndex
+    :param journal: journal of sync run to record changes to
+    :type journal: .journal.Journal
+    :return: stats dict | None
+    :rtype: dict|None
+    """
     if json:
-        week_dim, _ = RouteWeekDimension.objects.get_or_create(
-            weekend=False,
-            weekday=1)
+        if resolver is None:
+            resolver = PlatformResolver.load()
+        if stop_index is None:
+            stop_index = StopIndex.load()
+
+        week_dim = get_week_dimension(1)
 
         dir_ind = 'undefined'
         stats = {
             'created': 0,
             'updated': 0,
+            'skipped': False,
         }
         platforms = {
             'new': [],
@@ -253,12 +332,13 @@ def process_route_platforms_with_2gis(api_key, route):
                 logger.warning('Skip this direction: {}'.format(direction['type']))
                 continue
 
-            for r_stop in direction['platforms']:
-                pnt = Point(repr=r_stop['geometry']['centroid'])
-
+            centroids = PointArray.from_wkt(
+                [r_stop['geometry']['centroid']
+                 for r_stop in direction['platforms']])
+            for r_stop, pnt in zip(direction['platforms'], centroids):
                 # find platform
-                platform, alias, platform_crtd = _find_platform(r_stop['name'], platforms['new'])
-                stop, stop_crt = _find_stop(platform, pnt, stops['new'], alias)
+                platform, alias, platform_crtd = resolver.resolve(r_stop['name'])
+                stop, stop_crt = stop_index.resolve(platform, pnt, alias)
 
                 if platform_crtd:
                     platforms['new'].append(platform)
@@ -277,71 +357,48 @@ def process_route_platforms_with_2gis(api_key, route):
 
         logger.info('Route: %s \t platforms: %s'
                     % (route.name, len(platforms['common'])))
-        for platform in platforms['new']:
-            platform.save()
 
-        # creating route points
-        order = 0
-        last = None
-        time = datetime.time(0, 0, 0, 0)
+        # calculating route points
+        sequence = []
         for key, batch in directions.items():
             logger.info('Route: %s \tDirection: %s\t stops: %s'
                         % (route.name, key, len(batch['common'])))
-            for stop in batch['common']:
-                if not stop.pk:
-                    stop.platform = stop.platform
-                    stop.save()
-
-                # calculate angel between prev and current stop
-                pnt = Point(
-                    lon=stop.longitude,
-                    lat=stop.latitude)
-                if last:
-                    last_pnt = Point(
-                        lon=last.stop.longitude,
-                        lat=last.stop.latitude)
-                    angle = pnt.angle(last_pnt)
-                    angle += last.angle
-                    angle = GeoDirections.normalize_angle(angle)
-                else:
-                    last_pnt = Point(0, 0)
-                    angle = 0
-
-                geo_direction = GeoDirections.from_angle(angle)
-
-                if order > 0:
-                    time_delta = (pnt - last_pnt).length * 10000
-                    # logger.debug('Timedelta : %s' % time_delta)
-                    dt = datetime.datetime\
-                        .combine(datetime.datetime.today(), time)\
-                        + datetime.timedelta(0, int(time_delta))
-                    time = dt.time()
-
-                last, last_crtd = RoutePoint.objects.update_or_create(
-                    route=route,
-                    stop=stop,
-                    week_dimension=week_dim,
-                    lap=0,
-                    order=order,
-                    defaults={
-                        'time': time,
-                        'lap_start': order <= 0,
-                        'direction': key,
-                        'geo_direction': geo_direction,
-                        'angle': angle,
-                        'on_demand': stop.platform.name.lower().find(u'по требованию')>=0
-                    }
-                )
-
-                if last_crtd:
-                    stats['created'] += 1
-                else:
-                    stats['updated'] += 1
-
-                # status = 'created' if last_crtd else 'updated'
-                # # logger.info('Order %s, %s, route: %s, platforms: %s, angle %s'
-                # #             % (order, status, route.name, platform.name, angle,))
-                order += 1
+            sequence.extend((key, stop) for stop in batch['common'])
+
+        geometry = compute_route_geometry(
+            [stop.longitude for _, stop in sequence],
+            [stop.latitude for _, stop in sequence])
+
+        points = []
+        for order, (key, stop) in enumerate(sequence):
+            points.append((stop, order, {
+                'time': offset_to_time(geometry.offsets[order]),
+                'lap_start': order <= 0,
+                'direction': key,
+                'geo_direction': geometry.geo_directions[order],
+                'angle': float(geometry.angles[order]),
+                'on_demand': stop.platform.name.lower().find(u'по требованию')>=0
+            }))
+
+        with transaction.atomic():
+            bulk_create_with_pks(
+                Platform, platforms['new'],
+                key=lambda platform: normalize_name(platform.name))
+
+            for stop in stops['new']:
+                # refresh platform_id of just created platform
+                stop.platform = stop.platform
+            bulk_create_with_pks(
+                Stop, stops['new'],
+                key=lambda stop: (stop.platform_id,
+                                  stop.longitude, stop.latitude))
+
+            stats.update(_sync_route_points(route, week_dim, points,
+                                            journal))
+
+        if journal is not None:
+            journal.created(platforms['new'])
+            journal.created(stops['new'])
 
         logger.info('Route: %s,\t created: %s,\t updated: %s,\t'
                     'platforms: new: %s,\t exists: %s'
@@ -353,84 +410,448 @@ def process_route_platforms_with_2gis(api_key, route):
         return None
 
 
-def process_routes_with_2gis(api_key, routes):
+def _sync_route_points(route, week_dim, points, journal=None):
+    """
+    write lap 0 route points of route: the existing points are diffed
+    in memory with calculated ones, new are bulk created, changed are
+    bulk updated and the rest are deleted
+
+    :param route: synced route
+    :type route: .models.Route
+    :param week_dim: week dimension of route points
+    :type week_dim: .models.RouteWeekDimension
+    :param points: list of (stop, order, values)
+    :type points: list
+    :param journal: journal of sync run to record changes to
+    :type journal: .journal.Journal
+    :return: stats dict with created and updated counts
+    :rtype: dict
+    """
+    existing = {}
+    stale = []
+    for rp in RoutePoint.objects.filter(
+            route=route, week_dimension=week_dim, lap=0):
+        key = (rp.stop_id, rp.order)
+        if key in existing:
+            stale.append(rp.pk)
+        else:
+            existing[key] = rp
+
+    to_create = []
+    to_update = []
+    for stop, order, values in points:
+        rp = existing.pop((stop.pk, order), None)
+        if rp is None:
+            to_create.append(RoutePoint(
+                route=route,
+                stop=stop,
+                week_dimension=week_dim,
+                lap=0,
+                order=order,
+                **values))
+            continue
+
+        changed = []
+        for field, value in values.items():
+            if getattr(rp, field) != value:
+                setattr(rp, field, value)
+                changed.append(field)
+        if changed:
+            to_update.append((rp, changed))
+
+    stale.extend(rp.pk for rp in existing.values())
+
+    bulk_create_with_pks(RoutePoint, to_create,
+                         key=lambda rp: (rp.route_id, rp.week_dimension_id,
+                                         rp.lap, rp.stop_id, rp.order))
+    bulk_update([rp for rp, _ in to_update], _ROUTE_POINT_FIELDS)
+    if stale:
+        RoutePoint.objects.filter(pk__in=stale).delete()
+
+    if journal is not None:
+        journal.created(to_create)
+        for rp, changed in to_update:
+            journal.updated([rp], changed)
+        journal.record('RoutePoint', stale, ops.DELETE)
+
+    logger.debug('Route: %s,\t route points changed: %s,\t deleted: %s'
+                 % (route.name, len(to_update), len(stale)))
+
+    return {
+        'created': len(to_create),
+        'updated': len(points) - len(to_create),
+    }
+
+
+def store_fetch_state(data_provider, response, digest, coding=None):
+    """
+    remember digest and validators of synced payload,
+    should be called only after payload was processed
+
+    :param data_provider: data provider payload was fetched from
+    :type data_provider: .models.DataProviderUrl
+    :param response: response of data provider
+    :type response: requests.Response
+    :param digest: digest of payload
+    :type digest: str
+    :param coding: charset payload was decoded with
+    :type coding: str
+    """
+    data_provider.digest = digest
+    data_provider.etag = response.headers.get('ETag', '')
+    data_provider.last_modified = response.headers.get('Last-Modified', '')
+    data_provider.fetched = timezone.now()
+    update_fields = ['digest', 'etag', 'last_modified', 'fetched']
+    if coding and coding != data_provider.coding:
+        data_provider.coding = coding
+        update_fields.append('coding')
+    data_provider.save(update_fields=update_fields)
+
+
+def process_routes_with_2gis(api_key, routes, workers=1,
+                             stop_tolerance=STOP_TOLERANCE, force=False,
+                             store=None, replay=None, journal=None):
+    """
+    sync routes with 2gis API data. HTTP fetches overlap on the async
+    fetcher, while route data is still written to DB one route
+    at a time, in routes order. Routes whose payload is not changed
+    since the last sync or failed to fetch are skipped
+
+    :param api_key: key for connecting to API
+    :type api_key: str
+    :param routes: routes to sync
+    :type routes: iterable
+    :param workers: count of concurrent fetches
+    :type workers: int
+    :param stop_tolerance: max distance in meters between coordinates
+    of the same stop
+    :type stop_tolerance: float
+    :param force: sync even not changed payloads
+    :type force: bool
+    :param store: store to save fetched payloads to
+    :type store: .store.PayloadStore
+    :param replay: snapshot to read payloads from instead of fetching,
+    replayed payloads are always synced
+    :type replay: .store.Snapshot
+    :param journal: journal of sync run to record changes to
+    :type journal: .journal.Journal
+    :return: list of stats per route
+    :rtype: list
+    """
+    resolver = PlatformResolver.load()
+    stop_index = StopIndex.load(stop_tolerance)
     stats = []
+
+    # DB lookups stay in the main thread
+    registry = ProviderRegistry.load([p_types.TWOGIS_ROUTE_API])
+    providers = []
     for route in routes:
-        stats.append(process_route_platforms_with_2gis(api_key, route))
+        provider = registry.get(route, p_types.TWOGIS_ROUTE_API)
+        if not provider:
+            logger.error(
+                'No data providers found for route: {}'.format(route.name))
+        providers.append((route, provider))
+    registry.save_links()
+
+    if replay is not None:
+        fetcher = replay
+        force = True
+    else:
+        fetcher = AsyncFetcher(concurrency=workers, per_host=workers,
+                               session=get_session(workers))
+    fetched = fetcher.iter_results(
+        [(route, get_2gis_url(api_key, provider),
+          {} if force else get_conditional_headers(provider))
+         for route, provider in providers if provider],
+        ordered=True)
+
+    for route, provider in providers:
+        if not provider:
+            stats.append(None)
+            continue
+
+        result = next(fetched)
+        if not result.ok:
+            # error message has url with API key in it
+            error = type(result.error).__name__ if result.error \
+                else 'HTTP {}'.format(result.response.status_code)
+            logger.warning('Route: %s,\t failed to fetch: %s'
+                           % (route.name, error))
+            stats.append({'created': 0, 'updated': 0, 'skipped': True,
+                          'failed': '{}\t{}'.format(route.name, error)})
+            continue
+        if store is not None:
+            store.save(result.url, result.response,
+                       provider=provider.type, route=route.code)
+
+        json = None
+        digest = provider.digest
+        if not is_not_modified(result.response):
+            json = result.response.json()
+            # meta part differs from request to request
+            digest = get_digest(json.get('result', json))
+
+        if not force and digest == provider.digest:
+            logger.info('Route: %s,\t skipped, not changed' % route.name)
+            stats.append({'created': 0, 'updated': 0, 'skipped': True})
+            continue
+
+        route_stats = process_route_2gis_data(
+            route, json, resolver, stop_index, journal)
+        if route_stats is not None:
+            store_fetch_state(provider, result.response, digest)
+        stats.append(route_stats)
 
     return stats
 
 
-def sync_platforms_from_2gis_api(api_key, type):
+def sync_platforms_from_2gis_api(api_key, type, workers=1,
+                                 stop_tolerance=STOP_TOLERANCE, force=False,
+                                 store=None, replay=None, journal=None):
     routes = Route.objects.filter(type=type)
 
-    return process_routes_with_2gis(api_key, routes=routes)
+    return process_routes_with_2gis(api_key, routes=routes, workers=workers,
+                                    stop_tolerance=stop_tolerance,
+                                    force=force, store=store, replay=replay,
+                                    journal=journal)
 
 
-def process_platform_input(raw_platform):
-    result = {
-        'raw': raw_platform.strip(),
-        'raw_aliases': set(),
-        'aliases': set(),
-        'parts': set(),
-        'extreme': None,
-    }
+# extreme stop marks of schedule headers, looked up in this order
+_EXTREME_MARKS = (('отпр', 'start'), ('приб', 'finish'))
+_SUBALIAS_RE = re.compile(r'\((.+?)\)')
+# street, lane, square, etc. prefixes of platform names
+_PLATFORM_PREFIXES = frozenset(('ул', 'п', 'пл', 'пер', 'пр'))
+_PLATFORM_WORD_PREFIXES = _PLATFORM_PREFIXES | frozenset(
+    '{}.'.format(prefix) for prefix in _PLATFORM_PREFIXES)
+
+PLATFORM_INPUT_CACHE_SIZE = 4096
+
+
+def _strip_platform_prefixes(name):
+    words = [word for word in name.strip().split(' ')
+             if word.lower() not in _PLATFORM_WORD_PREFIXES]
+    name = ' '.join(words).strip()
+
+    parts = [part for part in name.split('.')
+             if part.lower() not in _PLATFORM_PREFIXES]
+    return name, '.'.join(parts).strip()
 
-    _map = {'отпр': 'start', 'приб': 'finish'}
-    for k, v in _map.items():
-        if k in raw_platform:
-            raw_platform = raw_platform.replace('{}.'.format(k), '')
-            raw_platform = raw_platform.replace(k, '')
-            result['extreme'] = v
+
+@lru_cache(maxsize=PLATFORM_INPUT_CACHE_SIZE)
+def _parse_platform_input(raw_platform):
+    extreme = None
+    for mark, value in _EXTREME_MARKS:
+        if mark in raw_platform:
+            raw_platform = raw_platform.replace('{}.'.format(mark), '')
+            raw_platform = raw_platform.replace(mark, '')
+            extreme = value
             break
 
-    alias = None
-    _subaliase = re.compile('\((.+?)\)')
-    res = _subaliase.search(raw_platform)
+    raw_aliases = {raw_platform.strip()}
+    res = _SUBALIAS_RE.search(raw_platform)
     if res:
         alias = res.group(1)
         raw_platform = raw_platform.replace('({})'.format(alias), '')
+        raw_aliases = {raw_platform.strip(), alias}
+
+    aliases = set()
+    for pltf in raw_aliases:
+        aliases.update(_strip_platform_prefixes(pltf))
+
+    return frozenset(raw_aliases), frozenset(aliases), extreme
+
 
-    result['raw_aliases'].add(raw_platform.strip())
-    if alias:
-        result['raw_aliases'].add(alias)
-        # result['aliases'].add(alias)
-
-    _platform_prefix = ('ул', 'п', 'пл', 'пер', 'пр')
-
-    pltfs = []
-    for pltf in result['raw_aliases']:
-        parts = pltf.strip().split(' ')
-        platform = []
-        # clear raw
-        for part in parts:
-            skip = False
-            for w in _platform_prefix:
-                if part.lower() == w or part.lower() == '{}.'.format(w):
-                    skip = True
-                    break
-
-            if not skip:
-                platform.append(part)
-
-        pltf = ' '.join(platform).strip()
-        result['aliases'].add(pltf)
-
-        parts = pltf.strip().split('.')
-        platform = []
-        # clear raw
-        for part in parts:
-            skip = False
-            for w in _platform_prefix:
-                if part.lower() == w:
-                    skip = True
-                    break
-
-            if not skip:
-                platform.append(part)
-
-        sterilized = '.'.join(platform).strip()
-        result['aliases'].add(sterilized)
-
-    return result
+def process_platform_input(raw_platform):
+    """
+    return names platform could be known by from schedule header:
+    the header itself, its alias in parentheses and both of them
+    without street and alike prefixes. Parsed headers are cached
+
+    :param raw_platform: schedule stops header
+    :type raw_platform: str
+    :return: dict with raw, raw_aliases, aliases, parts and extreme
+    :rtype: dict
+    """
+    raw_aliases, aliases, extreme = _parse_platform_input(raw_platform)
+    return {
+        'raw': raw_platform.strip(),
+        'raw_aliases': set(raw_aliases),
+        'aliases': set(aliases),
+        'parts': set(),
+        'extreme': extreme,
+    }
+
+
+def process_platform_inputs(raw_platforms):
+    """
+    return parsed schedule headers of the whole header row
+
+    :param raw_platforms: schedule stops headers
+    :type raw_platforms: iterable
+    :rtype: list
+    """
+    return [process_platform_input(raw_platform)
+            for raw_platform in raw_platforms]
 
+
+def get_schedule_route_points(routes):
+    """
+    return lap 0 route points of routes ordered by direction and order,
+    with stops, platforms and names of platform aliases
+
+    :param routes: routes to load route points of
+    :type routes: iterable
+    :return: dict of route id -> list of route points
+    :rtype: dict
+    """
+    route_points = defaultdict(list)
+    for rp in RoutePoint.objects\
+            .filter(route__in=routes, lap=0)\
+            .select_related('stop__platform', 'stop__alias')\
+            .order_by('route', 'direction', 'order'):
+        route_points[rp.route_id].append(rp)
+
+    platform_ids = set(rp.stop.platform_id
+                       for rps in route_points.values() for rp in rps)
+    aliases = defaultdict(set)
+    for platform_id, name in PlatformAlias.objects\
+            .filter(platform_id__in=platform_ids)\
+            .values_list('platform_id', 'name'):
+        aliases[platform_id].add(normalize_name(name))
+
+    for rps in route_points.values():
+        for rp in rps:
+            rp.names = set(aliases[rp.stop.platform_id])
+            rp.names.add(normalize_name(rp.stop.platform.name))
+            if rp.stop.alias is not None:
+                rp.names.add(normalize_name(rp.stop.alias.name))
+
+    return route_points
+
+
+def get_schedule_dimensions(weekday, on_date, cache=None):
+    """
+    return week and date dimensions of schedule
+
+    :param weekday: day of week from 1 to 7
+    :type weekday: int
+    :param on_date: date schedule is actual since
+    :type on_date: datetime.date
+    :param cache: dimensions got already
+    :type cache: dict
+    :return: (week dimension, date dimension)
+    :rtype: tuple
+    """
+    if cache is None:
+        cache = {}
+
+    key = (weekday, on_date)
+    if key not in cache:
+        date_dim, _ = RouteDateDimension.objects.get_or_create(
+            weekend=weekday >= 6,
+            weekday=weekday,
+            date=timezone.make_aware(
+                datetime.datetime.combine(on_date, datetime.time())),
+            defaults={
+                'year': on_date.year,
+                'month': on_date.month,
+                'day': on_date.day,
+                'week': on_date.isocalendar()[1],
+            })
+        cache[key] = (get_week_dimension(weekday), date_dim)
+
+    return cache[key]
+
+
+def process_route_schedule(route, day, page, matcher, dimensions=None,
+                           review=None, journal=None, matchers=None):
+    """
+    replace schedule of route for the day of week with trips parsed
+    from schedule page, each trip is a lap of route starting from 1
+    (lap 0 is kept for route points itself). Timetable columns are
+    matched with route points by matcher, new names of matched platforms
+    are saved as platform aliases
+
+    :param route: route of schedule page
+    :type route: .models.Route
+    :param day: day of week from 1 to 7
+    :type day: int
+    :param page: parsed schedule page
+    :type page: dict
+    :param matcher: matcher of route headers
+    :type matcher: .matchers.AliasMatcher
+    :param dimensions: cache of get_schedule_dimensions
+    :type dimensions: dict
+    :param review: list to queue ambiguous headers to
+    :type review: list
+    :param journal: journal of sync run to record changes to
+    :type journal: .journal.Journal
+    :param matchers: all matchers of sync run to add new aliases to,
+    matcher only by default
+    :type matchers: iterable
+    :return: stats dict
+    :rtype: dict
+    """
+    matches, ambiguous = matcher.match(process_platform_inputs(page['stops']))
+    if review is not None:
+        review.extend(ambiguous)
+
+    columns = [match.route_point if match is not None else None
+               for match in matches]
+    unknown = [header for header, rp in zip(page['stops'], columns)
+               if rp is None]
+    if unknown:
+        logger.warning('Route: {},\t not recognized stops: {}'.format(
+            route, ', '.join(unknown)))
+
+    week_dim, date_dim = get_schedule_dimensions(
+        day, page['last_update'] or datetime.date.today(), dimensions)
+
+    schedules = []
+    for lap, trip in enumerate(page['trips'], 1):
+        lap_start = True
+        for column, time, note in trip:
+            rp = columns[column] if column < len(columns) else None
+            if rp is None:
+                continue
+
+            schedules.append(RouteSchedule(
+                week_dimension=week_dim,
+                date_dimension=date_dim,
+                route=route,
+                stop_id=rp.stop_id,
+                time=time,
+                skip=time is None,
+                lap=lap,
+                lap_start=lap_start,
+                direction=rp.direction,
+                order=rp.order,
+                geo_direction=rp.geo_direction,
+                angle=rp.angle,
+                on_demand=rp.on_demand))
+            lap_start = False
+
+    with transaction.atomic():
+        aliases = save_aliases(
+            matches, [matcher] if matchers is None else matchers)
+        deleted = bulk_delete_inherited(RouteSchedule.objects.filter(
+            route=route, week_dimension=week_dim))
+        bulk_create_inherited(
+            RouteSchedule, schedules,
+            key_fields=('route', 'week_dimension', 'lap', 'order'))
+
+    if journal is not None:
+        journal.created(aliases)
+        # schedule rows are replaced as a whole, so the change
+        # is recorded once per route and day
+        journal.record('RouteSchedule', [route.pk], ops.REPLACE,
+                       ['week_dimension={}'.format(week_dim.pk)])
+
+    return {
+        'trips': len(page['trips']),
+        'created': len(schedules),
+        'deleted': deleted,
+        'unknown': len(unknown),
+        'review': len(ambiguous),
+        'aliases': len(aliases),
+    }
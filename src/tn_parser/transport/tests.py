@@ -1,3 +1,775 @@
-from django.test import TestCase
+# coding=utf-8
 
-# Create your tests here.
+import datetime
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import requests
+from django.test import SimpleTestCase, TestCase
+
+from .bulk import bulk_create_inherited, bulk_create_with_pks, \
+    bulk_delete_inherited, bulk_update
+from .departures import DeparturesIndex
+from .fetch import AsyncFetcher
+from .geometry import accumulate_angles, haversine
+from .journal import Journal, get_changes_since, get_last_sequence
+from .journeys import JourneyPlanner, Leg
+from .matchers import ACCEPT_SCORE, REVIEW_SCORE, AliasMatcher, Match, \
+    save_aliases
+from .models import ChangeOperations, Directions, GeoDirections, \
+    NameAlias, Platform, PlatformAlias, Point, Route, RoutePoint, \
+    RouteTypes, Stop
+from .nearest import NearestStopIndex
+from .parsers import OptionsScanner, get_routes_by_type_from_page
+from .snapshots import Document, Snapshot, serialize
+from .store import PayloadStore
+from .sync import get_schedule_route_points, get_week_dimension, \
+    process_platform_inputs
+
+
+class _DelayHandler(BaseHTTPRequestHandler):
+    """
+    Answers /?id=<id>&delay=<seconds> with id after the delay
+    and counts requests in flight. ETag of response is the id,
+    so conditional requests are answered with 304.
+    """
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight,
+                                       server.in_flight)
+        try:
+            query = parse_qs(urlparse(self.path).query)
+            time.sleep(float(query.get('delay', ['0'])[0]))
+            body = query.get('id', [''])[0].encode('utf-8')
+            etag = '"{}"'.format(body.decode('utf-8'))
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.end_headers()
+                return
+
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; charset=utf-8')
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+
+class _DelayServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), _DelayHandler)
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def handle_error(self, request, client_address):
+        # timed out clients hang up before the delayed answer
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            HTTPServer.handle_error(self, request, client_address)
+
+
+class ServerTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.server = _DelayServer()
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def get_url(self, key, delay=0):
+        return 'http://127.0.0.1:{}/?id={}&delay={}'.format(
+            self.server.server_port, key, delay)
+
+
+class AsyncFetcherTest(ServerTestCase):
+
+    def test_ordered_results(self):
+        # the first jobs complete last
+        jobs = [(key, self.get_url(key, 0.05 * (5 - key)))
+                for key in range(6)]
+        results = list(AsyncFetcher(concurrency=6).iter_results(
+            jobs, ordered=True))
+
+        self.assertEqual([result.key for result in results], list(range(6)))
+        self.assertEqual([result.response.text for result in results],
+                         [str(key) for key in range(6)])
+        self.assertTrue(all(result.ok for result in results))
+
+    def test_per_host_limit(self):
+        jobs = [(key, self.get_url(key, 0.1)) for key in range(8)]
+        results = AsyncFetcher(concurrency=8, per_host=2).fetch_all(jobs)
+
+        self.assertEqual(len(results), 8)
+        self.assertEqual(self.server.max_in_flight, 2)
+
+    def test_timeout_is_result_error(self):
+        jobs = [('slow', self.get_url('slow', 1)),
+                ('fast', self.get_url('fast', 0))]
+        slow, fast = AsyncFetcher(concurrency=2, timeout=0.2).fetch_all(jobs)
+
+        self.assertIsInstance(slow.error, requests.Timeout)
+        self.assertIsNone(slow.response)
+        self.assertFalse(slow.ok)
+        self.assertTrue(fast.ok)
+        self.assertEqual(fast.response.text, 'fast')
+
+    def test_requests_overlap(self):
+        delay = 0.2
+        jobs = [(key, self.get_url(key, delay)) for key in range(6)]
+
+        started = time.time()
+        results = AsyncFetcher(concurrency=6, per_host=6).fetch_all(jobs)
+        elapsed = time.time() - started
+
+        self.assertTrue(all(result.ok for result in results))
+        self.assertLess(elapsed, delay * len(jobs) / 2)
+        self.assertGreater(self.server.max_in_flight, 1)
+
+
+class PayloadStoreTest(ServerTestCase):
+
+    def setUp(self):
+        super(PayloadStoreTest, self).setUp()
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+        super(PayloadStoreTest, self).tearDown()
+
+    def fetch(self, snapshot, jobs):
+        store = PayloadStore(self.root, snapshot)
+        results = AsyncFetcher().fetch_all(jobs)
+        for result in results:
+            store.save(result.url, result.response)
+        return results
+
+    def test_replay_after_conditional_fetch(self):
+        first, second = self.get_url('first'), self.get_url('second')
+        self.fetch('1', [('first', first), ('second', second)])
+
+        # only the first payload is changed since the last fetch
+        results = self.fetch('2', [('first', first),
+                                   ('second', second,
+                                    {'If-None-Match': '"second"'})])
+        self.assertEqual([result.response.status_code
+                          for result in results], [200, 304])
+
+        snapshot = PayloadStore(self.root).open('2')
+        replayed = snapshot.fetch_all([('first', first), ('second', second)])
+
+        self.assertTrue(all(result.ok for result in replayed))
+        self.assertEqual([result.response.text for result in replayed],
+                         ['first', 'second'])
+        self.assertEqual(replayed[1].response.headers['ETag'], '"second"')
+
+
+class AccumulateAnglesTest(SimpleTestCase):
+
+    @staticmethod
+    def accumulate(steps):
+        angles = []
+        angle = 0
+        for step in steps:
+            angle = GeoDirections.normalize_angle(angle + step)
+            angles.append(angle)
+        return angles
+
+    def test_same_as_scalar(self):
+        rnd = random.Random(8)
+        for _ in range(100):
+            # small angles get negative often, and wrap to [360, 720)
+            steps = [0] + [rnd.uniform(-57.3, 57.3)
+                           for _ in range(rnd.randint(0, 60))]
+            expected = self.accumulate(steps)
+            angles = accumulate_angles(np.array(steps))
+
+            self.assertTrue(np.allclose(angles, expected, rtol=0,
+                                        atol=1e-9))
+            self.assertEqual([angle >= 360 for angle in angles],
+                             [angle >= 360 for angle in expected])
+
+
+class PointTest(SimpleTestCase):
+
+    def test_wkt(self):
+        point = Point(repr='POINT(31.275 58.52)')
+        self.assertEqual((point.lon, point.lat), (31.275, 58.52))
+
+    def test_wrong_wkt(self):
+        for wkt in ('POINT EMPTY', 'POINT(31.275)', 'POINT(31 58 1)',
+                    'POINT(lon lat)', ''):
+            with self.assertRaisesRegex(ValueError, 'Wrong WKT point'):
+                Point(repr=wkt)
+
+
+class NearestStopsViewTest(SimpleTestCase):
+
+    def test_not_finite_params(self):
+        for query in ('lon=nan&lat=58.52', 'lon=31.27&lat=inf',
+                      'lon=31.27&lat=58.52&radius=nan',
+                      'lon=31.27&lat=58.52&radius=inf'):
+            response = self.client.get('/api/stops/nearest/?' + query)
+            self.assertEqual(response.status_code, 400, query)
+
+
+class BulkTest(TestCase):
+
+    def test_bulk_create_with_pks(self):
+        Route.objects.create(name='0', code='0')
+        routes = [Route(name=str(number), code=str(number))
+                  for number in range(1, 5)]
+
+        created = bulk_create_with_pks(Route, routes,
+                                       key=lambda route: route.code,
+                                       batch_size=2)
+
+        self.assertIs(created, routes)
+        self.assertEqual(
+            list(Route.objects.filter(code__gt='0').order_by('code')
+                 .values_list('pk', 'code')),
+            [(route.pk, route.code) for route in routes])
+
+    def test_bulk_update(self):
+        routes = [Route.objects.create(name=str(number), code=str(number))
+                  for number in range(5)]
+        for route in routes[1:]:
+            route.name = 'new {}'.format(route.name)
+            route.type = RouteTypes.TROLLEYBUS
+            route.code = 'not updated'
+
+        updated = bulk_update(routes[1:], ('name', 'type'), batch_size=2)
+
+        self.assertEqual(updated, 4)
+        self.assertEqual(
+            list(Route.objects.order_by('pk')
+                 .values_list('name', 'code', 'type')),
+            [('0', '0', RouteTypes.BUS)] +
+            [('new {}'.format(number), str(number), RouteTypes.TROLLEYBUS)
+             for number in range(1, 5)])
+
+    def test_bulk_update_null(self):
+        platform = Platform.objects.create(name='Platform')
+        stops = [Stop.objects.create(platform=platform, longitude=31.27,
+                                     latitude=58.52)
+                 for _ in range(2)]
+        stops[0].longitude = None
+        stops[1].latitude = 58.53
+
+        bulk_update(stops, ('longitude', 'latitude'))
+
+        self.assertEqual(list(Stop.objects.order_by('pk')
+                              .values_list('longitude', 'latitude')),
+                         [(None, 58.52), (31.27, 58.53)])
+
+    def test_bulk_create_inherited(self):
+        platforms = [Platform.objects.create(name=str(number))
+                     for number in range(2)]
+        NameAlias.objects.create(name='not an alias')
+        aliases = [PlatformAlias(name='alias {}'.format(number),
+                                 platform=platforms[number % 2])
+                   for number in range(5)]
+
+        created = bulk_create_inherited(PlatformAlias, aliases,
+                                        key_fields=('name', ), batch_size=2)
+
+        self.assertIs(created, aliases)
+        self.assertTrue(all(alias.pk for alias in aliases))
+        self.assertEqual(
+            list(PlatformAlias.objects.order_by('pk')
+                 .values_list('pk', 'name', 'platform')),
+            [(alias.pk, alias.name, alias.platform_id) for alias in aliases])
+        self.assertEqual(NameAlias.objects.count(), 6)
+
+    def test_bulk_create_inherited_of_not_inherited(self):
+        with self.assertRaises(ValueError):
+            bulk_create_inherited(Route, [Route(code='1')], ('code', ))
+
+    def test_bulk_delete_inherited(self):
+        platform = Platform.objects.create(name='Platform')
+        aliases = bulk_create_inherited(
+            PlatformAlias, [PlatformAlias(name=str(number), platform=platform)
+                            for number in range(3)], ('name', ))
+
+        deleted = bulk_delete_inherited(
+            PlatformAlias.objects.filter(pk__in=[aliases[0].pk,
+                                                 aliases[2].pk]))
+
+        self.assertEqual(deleted, 2)
+        self.assertEqual(list(NameAlias.objects.values_list('pk', 'name')),
+                         [(aliases[1].pk, '1')])
+
+
+ROUTES_PAGE = (
+    "<html><body><form action='/rasp'>"
+    "<select class='route' name='avt' onchange='go()'>"
+    "<option value='1_r'>1</option>\n"
+    "<option value=\"2a_v\" selected>2а <b>express</b> </option>\n"
+    "<option value=10>10</option>"
+    "</select>"
+    "<SELECT NAME='trol'><option value='1_r'>1<option value='3_r'>3"
+    "</SELECT>"
+    "</form></body></html>")
+
+ROUTES_OPTIONS = {
+    'avt': [{'code': '1', 'name': '1'},
+            {'code': '2a', 'name': '2а <b>express</b>'},
+            {'code': '10', 'name': '10'}],
+    'trol': [{'code': '1', 'name': '1'}, {'code': '3', 'name': '3'}],
+}
+
+
+class OptionsScannerTest(SimpleTestCase):
+
+    @staticmethod
+    def scan(chunks):
+        scanner = OptionsScanner()
+        for chunk in chunks:
+            scanner.feed(chunk)
+        return scanner.close(), dict(scanner.counts)
+
+    def test_whole_page(self):
+        self.assertEqual(self.scan([ROUTES_PAGE]),
+                         (ROUTES_OPTIONS, {'avt': 1, 'trol': 1}))
+
+    def test_split_anywhere(self):
+        expected = self.scan([ROUTES_PAGE])
+        for index in range(len(ROUTES_PAGE) + 1):
+            self.assertEqual(self.scan([ROUTES_PAGE[:index],
+                                        ROUTES_PAGE[index:]]),
+                             expected, index)
+
+    def test_chunks(self):
+        expected = self.scan([ROUTES_PAGE])
+        # chars one by one first, then random sizes
+        self.assertEqual(self.scan(ROUTES_PAGE), expected)
+
+        rnd = random.Random(13)
+        for _ in range(100):
+            cuts = sorted(rnd.sample(range(len(ROUTES_PAGE)), 5))
+            chunks = [ROUTES_PAGE[start:end] for start, end
+                      in zip([0] + cuts, cuts + [len(ROUTES_PAGE)])]
+            self.assertEqual(self.scan(chunks), expected, cuts)
+
+    def test_routes_by_type(self):
+        routes = get_routes_by_type_from_page(iter([ROUTES_PAGE[:100],
+                                                    ROUTES_PAGE[100:]]))
+        self.assertEqual(routes, {RouteTypes.BUS: ROUTES_OPTIONS['avt'],
+                                  RouteTypes.TROLLEYBUS:
+                                      ROUTES_OPTIONS['trol']})
+
+        with self.assertRaises(RuntimeError):
+            get_routes_by_type_from_page(ROUTES_PAGE.replace('trol', 'x'))
+
+
+def _route_point(pk, order, name, direction=Directions.FORWARD):
+    rp = RoutePoint(pk=pk, order=order, direction=direction,
+                    stop=Stop(pk=pk, platform_id=pk))
+    rp.names = {name}
+    return rp
+
+
+class AliasMatcherTest(SimpleTestCase):
+
+    def match(self, route_points, headers):
+        return AliasMatcher(None, route_points).match(
+            process_platform_inputs(headers))
+
+    def test_scores(self):
+        route_points = [_route_point(1, 0, 'вокзал'),
+                        _route_point(2, 1, 'ломоносова'),
+                        _route_point(3, 2, 'победы')]
+        matches, review = self.match(route_points, [
+            'Вокзал', 'Ломоносово', 'Площадь Победы', 'Зелёная'])
+
+        exact, similar, doubtful, unknown = matches
+        self.assertIs(exact.route_point, route_points[0])
+        self.assertTrue(exact.exact)
+        self.assertEqual(exact.score, 1.0)
+
+        self.assertIs(similar.route_point, route_points[1])
+        self.assertFalse(similar.exact)
+        self.assertTrue(ACCEPT_SCORE <= similar.score < 1.0)
+
+        # similar not enough to accept, but enough to ask
+        self.assertIsNone(doubtful)
+        self.assertEqual(len(review), 1)
+        self.assertEqual(review[0].column, 2)
+        rp, score = review[0].candidates[0]
+        self.assertIs(rp, route_points[2])
+        self.assertTrue(REVIEW_SCORE <= score < ACCEPT_SCORE)
+
+        self.assertIsNone(unknown)
+
+    def test_ambiguous(self):
+        # both namesakes are behind the previous match in route order
+        route_points = [_route_point(1, 5, 'вокзал'),
+                        _route_point(2, 1, 'центр'),
+                        _route_point(3, 2, 'центр')]
+        matches, review = self.match(route_points, ['Вокзал', 'Центр'])
+
+        self.assertIs(matches[0].route_point, route_points[0])
+        self.assertIsNone(matches[1])
+        self.assertEqual([rp for rp, _ in review[0].candidates],
+                         route_points[1:])
+
+    def test_direction(self):
+        route_points = [
+            _route_point(1, 0, 'вокзал'),
+            _route_point(2, 1, 'центр'),
+            _route_point(3, 0, 'центр', Directions.BACKWARD),
+            _route_point(4, 1, 'вокзал', Directions.BACKWARD),
+            _route_point(5, 2, 'рынок', Directions.BACKWARD)]
+        matches, _ = self.match(route_points,
+                                ['Центр', 'Вокзал', 'Рынок'])
+
+        self.assertEqual([match.route_point for match in matches],
+                         route_points[2:])
+
+    def test_whole_header(self):
+        # part of header before parentheses is a name of the other platform
+        route_points = [
+            _route_point(1, 0, 'зелинского'),
+            _route_point(2, 1, 'ул. зелинского (по требованию)'),
+            _route_point(3, 2, 'вокзал')]
+        matches, review = self.match(route_points, [
+            'ул. Зелинского (по требованию)', 'Вокзал'])
+
+        self.assertEqual([match.route_point for match in matches],
+                         route_points[1:])
+        self.assertTrue(matches[0].exact)
+        self.assertEqual(review, [])
+
+
+class SaveAliasesTest(TestCase):
+
+    def setUp(self):
+        week_dim = get_week_dimension(1)
+        self.platforms = [Platform.objects.create(name=name)
+                          for name in ('Вокзал', 'Центр')]
+        stops = [Stop.objects.create(platform=platform)
+                 for platform in self.platforms]
+        self.routes = [Route.objects.create(name=code, code=code)
+                       for code in ('1', '2')]
+        # both routes stop on both platforms
+        for route in self.routes:
+            for order, stop in enumerate(stops):
+                RoutePoint.objects.create(
+                    route=route, stop=stop, week_dimension=week_dim,
+                    lap=0, order=order, direction=Directions.FORWARD)
+
+    def get_matchers(self):
+        route_points = get_schedule_route_points(self.routes)
+        return [AliasMatcher(route, route_points[route.pk])
+                for route in self.routes]
+
+    @staticmethod
+    def get_match(matcher, order, name):
+        return Match(order, name, matcher.route_points[order], 0.8,
+                     name, False)
+
+    def test_shared_platform(self):
+        matchers = self.get_matchers()
+        aliases = save_aliases(
+            [self.get_match(matcher, 0, 'Автовокзал ')
+             for matcher in matchers], matchers)
+
+        self.assertEqual([(alias.platform_id, alias.name)
+                          for alias in aliases],
+                         [(self.platforms[0].pk, 'Автовокзал')])
+        for matcher in matchers:
+            self.assertIn('автовокзал', matcher.route_points[0].names)
+            self.assertNotIn('автовокзал', matcher.route_points[1].names)
+
+        # the next page of the other route is matched exactly
+        matches, _ = matchers[1].match(
+            process_platform_inputs(['Автовокзал']))
+        self.assertTrue(matches[0].exact)
+
+    def test_saved_before(self):
+        first, second = self.get_matchers()
+        save_aliases([self.get_match(first, 0, 'Автовокзал')],
+                     [first])
+
+        # the other route does not know the alias saved by the first one
+        aliases = save_aliases(
+            [self.get_match(second, 0, 'автовокзал')], [second])
+
+        self.assertEqual(aliases, [])
+        self.assertEqual(PlatformAlias.objects.count(), 1)
+
+    def test_same_name_of_platforms(self):
+        matcher = self.get_matchers()[0]
+        aliases = save_aliases([self.get_match(matcher, 0, 'Остановка'),
+                                self.get_match(matcher, 1, 'Остановка')],
+                               [matcher])
+
+        self.assertEqual(len(aliases), 2)
+        self.assertEqual(
+            sorted(PlatformAlias.objects.values_list('pk', 'platform_id')),
+            sorted((alias.pk, alias.platform_id) for alias in aliases))
+
+
+class JournalTest(TestCase):
+
+    @staticmethod
+    def get_changes(sequence):
+        return [(change.run_id, change.entity_id)
+                for change in get_changes_since(sequence)]
+
+    def test_overlapping_runs(self):
+        first = Journal.start('sync_week_schedule')
+        second = Journal.start('sync_platforms')
+        first.record('Route', [1, 2], ChangeOperations.UPDATE, ['name'])
+        second.record('Route', [3], ChangeOperations.CREATE)
+
+        self.assertEqual(second.finish(), 1)
+        self.assertEqual(self.get_changes(0), [(second.run.pk, 3)])
+        seen = get_last_sequence()
+
+        # started earlier, but finished after the consumer has read
+        self.assertEqual(first.finish(), 2)
+        self.assertEqual(self.get_changes(seen),
+                         [(first.run.pk, 1), (first.run.pk, 2)])
+        self.assertEqual(self.get_changes(get_last_sequence()), [])
+        self.assertEqual(self.get_changes(0), [(second.run.pk, 3),
+                                               (first.run.pk, 1),
+                                               (first.run.pk, 2)])
+
+    def test_not_finished_run(self):
+        journal = Journal.start('sync_routes')
+        journal.record('Route', [1], ChangeOperations.DELETE)
+
+        self.assertEqual(get_last_sequence(), 0)
+        self.assertEqual(self.get_changes(0), [])
+
+
+def _make_snapshot(documents):
+    return Snapshot(dict((name, Document(serialize(data), name))
+                         for name, data in documents.items()))
+
+
+def _make_schedules(rnd, stops, days):
+    # day of schedule -> trips of random stops at random times
+    schedule = {}
+    for day in days:
+        trips = []
+        for _ in range(rnd.randint(1, 8)):
+            minutes = sorted(rnd.sample(range(24 * 60), 3))
+            trips.append({
+                'direction': rnd.choice(('forward', 'backward')),
+                'stops': [[stop_id, '{}:{:02}'.format(*divmod(m, 60))]
+                          for stop_id, m in zip(rnd.sample(stops, 3),
+                                                minutes)]})
+        schedule[str(day)] = trips
+    return schedule
+
+
+class DeparturesIndexTest(SimpleTestCase):
+
+    # route id -> (days of schedule, canceled)
+    ROUTES = {1: ((1, 6), None), 2: ((1, 6, 7), None), 3: ((1, ), None),
+              4: ((1, 6, 7), '2017-06-01')}
+
+    def setUp(self):
+        rnd = random.Random(21)
+        self.stops = list(range(1, 7))
+        documents = {'stops': [{'id': stop_id} for stop_id in self.stops],
+                     'routes': []}
+        for route_id, (days, canceled) in self.ROUTES.items():
+            route = {'id': route_id, 'code': str(route_id),
+                     'canceled': canceled}
+            documents['routes'].append(route)
+            documents['routes/{}'.format(route_id)] = dict(
+                route, schedule=_make_schedules(rnd, self.stops, days))
+        self.documents = documents
+        self.index = DeparturesIndex.load(_make_snapshot(documents))
+
+    def get_departures(self, stop_id, when, n):
+        """
+        return departures scanning every trip of every day of week
+        """
+        midnight = when.replace(hour=0, minute=0, second=0, microsecond=0)
+        departures = []
+        for offset in range(8):
+            day = midnight + datetime.timedelta(days=offset)
+            weekday = day.isoweekday()
+            for route_id, (days, canceled) in self.ROUTES.items():
+                schedule = self.documents['routes/{}'.format(route_id)][
+                    'schedule']
+                # workdays by monday, sunday by saturday unless it has own
+                if weekday < 6:
+                    trips = schedule['1']
+                else:
+                    trips = schedule.get(str(weekday), schedule.get('6'))
+                if canceled or trips is None:
+                    continue
+                for trip in trips:
+                    for stop, time in trip['stops']:
+                        hours, minutes = map(int, time.split(':'))
+                        moment = day + datetime.timedelta(hours=hours,
+                                                          minutes=minutes)
+                        if stop == stop_id and \
+                                moment >= when.replace(second=0):
+                            departures.append(
+                                (moment, route_id, trip['direction']))
+        return sorted(departures)[:n]
+
+    def test_same_as_brute_force(self):
+        rnd = random.Random(1)
+        for _ in range(300):
+            stop_id = rnd.choice(self.stops)
+            # 2017-07-03 is monday
+            when = datetime.datetime(2017, 7, 3) + datetime.timedelta(
+                minutes=rnd.randrange(7 * 24 * 60), seconds=rnd.randrange(60))
+            n = rnd.randint(1, 20)
+
+            self.assertEqual(
+                [tuple(departure) for departure
+                 in self.index.next_departures(stop_id, when, n)],
+                self.get_departures(stop_id, when, n),
+                (stop_id, when, n))
+
+    def test_routes(self):
+        self.assertEqual(self.index.routes, {1: '1', 2: '2', 3: '3'})
+        self.assertEqual(self.index.stops, frozenset(self.stops))
+
+
+class NearestStopIndexTest(SimpleTestCase):
+
+    def setUp(self):
+        rnd = random.Random(22)
+        stops = [{'id': stop_id, 'platform': stop_id // 2,
+                  'lon': 31.27 + rnd.uniform(-0.1, 0.1),
+                  'lat': 58.52 + rnd.uniform(-0.06, 0.06)}
+                 for stop_id in range(500)]
+        stops.append({'id': 500, 'platform': 250, 'lon': None, 'lat': None})
+        self.index = NearestStopIndex(stops)
+        self.lons = np.array([stop['lon'] for stop in self.index.stops])
+        self.lats = np.array([stop['lat'] for stop in self.index.stops])
+
+    def test_same_as_brute_force(self):
+        rnd = random.Random(2)
+        for _ in range(200):
+            lon = 31.27 + rnd.uniform(-0.12, 0.12)
+            lat = 58.52 + rnd.uniform(-0.08, 0.08)
+            distances = haversine(self.lons, self.lats, lon, lat)
+
+            k = rnd.randint(1, 20)
+            nearest = np.argsort(distances)[:k]
+            found = self.index.nearest(lon, lat, k)
+            self.assertEqual([stop.stop for stop in found],
+                             [self.index.stops[i]['id'] for i in nearest])
+            self.assertTrue(np.allclose([stop.distance for stop in found],
+                                        distances[nearest]))
+
+            radius = rnd.uniform(0, 2000)
+            within = self.index.within(lon, lat, radius)
+            self.assertEqual(
+                sorted(stop.stop for stop in within),
+                sorted(self.index.stops[i]['id']
+                       for i in np.nonzero(distances <= radius)[0]))
+            self.assertEqual([stop.distance for stop in within],
+                             sorted(stop.distance for stop in within))
+
+    def test_not_located_stop(self):
+        self.assertIsNone(self.index.get(500))
+        self.assertEqual(len(self.index.nearest(31.27, 58.52, 1000)), 500)
+
+
+def _trip(*stops):
+    return {'direction': 'forward', 'stops': [list(stop) for stop in stops]}
+
+
+class JourneyPlannerTest(SimpleTestCase):
+    """
+    Route A goes 1 - 2 - 4, route B goes from 3 on the platform of 2
+    to 5, slow route C goes 1 - 5 directly, canceled route D
+    is the fastest one. Stop 6 is a walk from stop 4.
+    """
+
+    DOCUMENTS = {
+        'routes': [{'id': 10, 'code': 'A', 'canceled': None},
+                   {'id': 20, 'code': 'B', 'canceled': None},
+                   {'id': 30, 'code': 'C', 'canceled': None},
+                   {'id': 40, 'code': 'D', 'canceled': '2017-06-01'}],
+        'routes/10': {'schedule': {'1': [
+            _trip((1, '8:00'), (2, '8:10'), (4, '8:20')),
+            _trip((1, '8:30'), (2, '8:40'), (4, '8:50'))]}},
+        'routes/20': {'schedule': {'1': [
+            _trip((3, '8:15'), (5, '8:25')),
+            _trip((3, '8:45'), (5, '8:55'))]}},
+        'routes/30': {'schedule': {'1': [_trip((1, '8:05'), (5, '9:30'))]}},
+        'routes/40': {'schedule': {'1': [_trip((1, '7:58'), (5, '8:01'))]}},
+        'platforms': [{'id': 1, 'stops': [1]}, {'id': 2, 'stops': [2, 3]},
+                      {'id': 4, 'stops': [4]}, {'id': 5, 'stops': [5]},
+                      {'id': 6, 'stops': [6]}],
+        'transfers': [[4, 6, 5], [6, 4, 5]],
+    }
+
+    def setUp(self):
+        self.planner = JourneyPlanner.load(_make_snapshot(self.DOCUMENTS))
+
+    @staticmethod
+    def at(hour, minute, day=3):
+        # 2017-07-03 is monday
+        return datetime.datetime(2017, 7, day, hour, minute)
+
+    def get_journeys(self, origin, destination, when, **kwargs):
+        return [(journey.transfers, journey.legs) for journey
+                in self.planner.plan(origin, destination, when, **kwargs)]
+
+    def test_transfer_on_platform(self):
+        direct = Leg(30, 'forward', 1, 5, self.at(8, 5), self.at(9, 30))
+        self.assertEqual(self.get_journeys(1, 5, self.at(7, 55)), [
+            (0, [direct]),
+            (1, [Leg(10, 'forward', 1, 2, self.at(8, 0), self.at(8, 10)),
+                 Leg(None, None, 2, 3, self.at(8, 10), self.at(8, 12)),
+                 Leg(20, 'forward', 3, 5, self.at(8, 15), self.at(8, 25))]),
+        ])
+        self.assertEqual(self.get_journeys(1, 5, self.at(7, 55),
+                                           max_transfers=0),
+                         [(0, [direct])])
+
+    def test_walk(self):
+        self.assertEqual(self.get_journeys(1, 6, self.at(7, 55)), [
+            (0, [Leg(10, 'forward', 1, 4, self.at(8, 0), self.at(8, 20)),
+                 Leg(None, None, 4, 6, self.at(8, 20), self.at(8, 25))]),
+        ])
+        self.assertEqual(self.get_journeys(4, 6, self.at(9, 0)), [
+            (0, [Leg(None, None, 4, 6, self.at(9, 0), self.at(9, 5))]),
+        ])
+
+    def test_later_trips(self):
+        # tuesday is served by monday schedule
+        journeys = self.planner.plan(1, 5, self.at(8, 20, day=4))
+        self.assertEqual([(journey.departure, journey.arrival,
+                           journey.transfers) for journey in journeys],
+                         [(self.at(8, 30, day=4), self.at(8, 55, day=4), 1)])
+
+        self.assertEqual(self.planner.plan(1, 5, self.at(9, 0)), [])
+        # no schedule on sunday
+        self.assertEqual(self.planner.plan(1, 5, self.at(7, 55, day=9)), [])
@@ -0,0 +1,15 @@
+from django.conf.urls import url
+
+from . import views
+
+urlpatterns = [
+    url(r'^routes/$', views.routes, name='routes'),
+    url(r'^routes/(?P<route_id>\d+)/$', views.route, name='route'),
+    url(r'^stops/$', views.stops, name='stops'),
+    url(r'^stops/nearest/$', views.nearest_stops, name='nearest_stops'),
+    url(r'^stops/(?P<stop_id>\d+)/departures/$', views.departures,
+        name='departures'),
+    url(r'^platforms/$', views.platforms, name='platforms'),
+    url(r'^journeys/$', views.journeys, name='journeys'),
+    url(r'^isochrones/$', views.isochrones, name='isochrones'),
+]
@@ -1,3 +1,241 @@
-from django.shortcuts import render
+# coding=utf-8
 
-# Create your views here.
+import math
+
+from django.http import HttpResponse
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.views.decorators.http import condition, require_safe
+
+from .departures import DEFAULT_DEPARTURES, MAX_DEPARTURES, \
+    get_departures_index
+from .isochrones import DEFAULT_DURATION, MAX_DURATION, get_isochrone, \
+    to_geojson
+from .journeys import MAX_TRANSFERS, get_journey_planner
+from .nearest import DEFAULT_NEAREST, MAX_NEAREST, MAX_RADIUS, \
+    get_nearest_stop_index
+from .snapshots import loader, serialize
+
+JSON_CONTENT_TYPE = 'application/json; charset=utf-8'
+
+
+def json_response(data, status=200):
+    return HttpResponse(serialize(data), status=status,
+                        content_type=JSON_CONTENT_TYPE)
+
+
+def _get_etag(request, name, **kwargs):
+    document = loader.get().get(name.format(**kwargs))
+    return document.etag if document is not None else None
+
+
+def snapshot_view(name):
+    """
+    return view of snapshot document, name is formatted with
+    URL kwargs. Documents are served as they were serialized by sync,
+    with strong ETag, so clients revalidating get 304
+    """
+    @require_safe
+    @condition(etag_func=lambda request, **kwargs: _get_etag(
+        request, name, **kwargs))
+    def view(request, **kwargs):
+        document = loader.get().get(name.format(**kwargs))
+        if document is None:
+            return json_response({'detail': 'Not found'}, status=404)
+        return HttpResponse(document.body, content_type=JSON_CONTENT_TYPE)
+
+    return view
+
+
+routes = snapshot_view('routes')
+route = snapshot_view('routes/{route_id}')
+stops = snapshot_view('stops')
+platforms = snapshot_view('platforms')
+
+
+def _get_int(request, name, default):
+    try:
+        return int(request.GET.get(name, default))
+    except (TypeError, ValueError):
+        return None
+
+
+def _get_float(request, name):
+    """
+    return finite float query parameter, None if it is not set or wrong
+    """
+    try:
+        value = float(request.GET[name])
+    except (KeyError, ValueError):
+        return None
+    return value if math.isfinite(value) else None
+
+
+def _get_when(request):
+    """
+    return moment of when query parameter in ISO 8601,
+    now if it is not set, None if it is wrong
+    """
+    if not request.GET.get('when'):
+        return timezone.localtime(timezone.now())
+    try:
+        when = parse_datetime(request.GET['when'])
+    except ValueError:
+        return None
+    if when is not None and timezone.is_naive(when):
+        when = timezone.make_aware(when)
+    return when
+
+
+@require_safe
+def departures(request, stop_id):
+    """
+    return the next departures from stop, query parameters are
+    when (ISO 8601 date and time, now by default) and n
+    """
+    stop_id = int(stop_id)
+    index = get_departures_index()
+    if stop_id not in index.stops:
+        return json_response({'detail': 'Not found'}, status=404)
+
+    when = _get_when(request)
+    if when is None:
+        return json_response({'detail': 'Wrong when'}, status=400)
+
+    n = _get_int(request, 'n', DEFAULT_DEPARTURES)
+    if n is None:
+        return json_response({'detail': 'Wrong n'}, status=400)
+    n = max(1, min(n, MAX_DEPARTURES))
+
+    return json_response({
+        'stop': stop_id,
+        'departures': [
+            {'time': departure.time.isoformat(),
+             'route': departure.route,
+             'code': index.routes[departure.route],
+             'direction': departure.direction}
+            for departure in index.next_departures(stop_id, when, n)],
+    })
+
+
+@require_safe
+def nearest_stops(request):
+    """
+    return stops nearest to point, query parameters are lon, lat and
+    either k (count of stops) or radius in meters
+    """
+    lon = _get_float(request, 'lon')
+    lat = _get_float(request, 'lat')
+    if lon is None or lat is None \
+            or not -180 <= lon <= 180 or not -90 <= lat <= 90:
+        return json_response({'detail': 'Wrong lon or lat'}, status=400)
+
+    index = get_nearest_stop_index()
+    if 'radius' in request.GET:
+        radius = _get_float(request, 'radius')
+        if radius is None or radius < 0:
+            return json_response({'detail': 'Wrong radius'}, status=400)
+        found = index.within(lon, lat, min(radius, MAX_RADIUS))
+    else:
+        k = _get_int(request, 'k', DEFAULT_NEAREST)
+        if k is None:
+            return json_response({'detail': 'Wrong k'}, status=400)
+        found = index.nearest(lon, lat, max(1, min(k, MAX_NEAREST)))
+
+    return json_response({
+        'stops': [
+            {'stop': stop.stop,
+             'distance': round(stop.distance, 1),
+             'lon': stop.lon,
+             'lat': stop.lat,
+             'platform': stop.platform,
+             'name': stop.name,
+             'routes': [{'id': route_id, 'code': code}
+                        for route_id, code in stop.routes]}
+            for stop in found],
+    })
+
+
+@require_safe
+def journeys(request):
+    """
+    return journeys between stops, query parameters are from and to
+    (ids of stops), when (ISO 8601 date and time, now by default)
+    and transfers (max count of them)
+    """
+    planner = get_journey_planner()
+    origin = _get_int(request, 'from', None)
+    destination = _get_int(request, 'to', None)
+    if origin not in planner.stop_platforms \
+            or destination not in planner.stop_platforms:
+        return json_response({'detail': 'Wrong from or to'}, status=400)
+
+    when = _get_when(request)
+    if when is None:
+        return json_response({'detail': 'Wrong when'}, status=400)
+
+    transfers = _get_int(request, 'transfers', MAX_TRANSFERS)
+    if transfers is None or transfers < 0:
+        return json_response({'detail': 'Wrong transfers'}, status=400)
+
+    return json_response({
+        'journeys': [
+            {'departure': journey.departure.isoformat(),
+             'arrival': journey.arrival.isoformat(),
+             'transfers': journey.transfers,
+             'legs': [
+                 {'route': leg.route,
+                  'code': planner.routes.get(leg.route),
+                  'direction': leg.direction,
+                  'from': leg.from_stop,
+                  'to': leg.to_stop,
+                  'departure': leg.departure.isoformat(),
+                  'arrival': leg.arrival.isoformat()}
+                 for leg in journey.legs]}
+            for journey in planner.plan(origin, destination, when,
+                                        min(transfers, MAX_TRANSFERS))],
+    })
+
+
+@require_safe
+def isochrones(request):
+    """
+    return stops reachable within duration, query parameters are
+    either stop (id) or lon and lat of the start, when (ISO 8601 date
+    and time, now by default), duration (minutes), transfers (max count
+    of them) and format, "geojson" for GeoJSON feature collection
+    """
+    stop_id = _get_int(request, 'stop', None)
+    lon = _get_float(request, 'lon')
+    lat = _get_float(request, 'lat')
+    if stop_id is not None:
+        if stop_id not in get_journey_planner().stop_platforms:
+            return json_response({'detail': 'Not found'}, status=404)
+    elif lon is None or lat is None \
+            or not -180 <= lon <= 180 or not -90 <= lat <= 90:
+        return json_response({'detail': 'Wrong stop or lon and lat'},
+                             status=400)
+
+    when = _get_when(request)
+    if when is None:
+        return json_response({'detail': 'Wrong when'}, status=400)
+
+    duration = _get_int(request, 'duration', DEFAULT_DURATION)
+    if duration is None or duration < 0:
+        return json_response({'detail': 'Wrong duration'}, status=400)
+
+    transfers = _get_int(request, 'transfers', MAX_TRANSFERS)
+    if transfers is None or transfers < 0:
+        return json_response({'detail': 'Wrong transfers'}, status=400)
+
+    isochrone = get_isochrone(when, min(duration, MAX_DURATION), stop_id,
+                              lon, lat, min(transfers, MAX_TRANSFERS))
+    if request.GET.get('format') == 'geojson':
+        return json_response(to_geojson(isochrone))
+
+    return json_response({
+        'departure': isochrone.departure.isoformat(),
+        'duration': isochrone.duration,
+        'stops': [{'stop': stop, 'arrival': arrival.isoformat()}
+                  for stop, arrival in isochrone.arrivals],
+    })